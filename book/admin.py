@@ -1,6 +1,14 @@
 from django.contrib import admin
 
-from .models import Book, Review, UserRecommendationPreference
+from .models import (
+    Book,
+    BookRatingAggregate,
+    BookSimilarity,
+    Review,
+    UserAuthorTaste,
+    UserGenreTaste,
+    UserRecommendationPreference,
+)
 
 
 class BookAdmin(admin.ModelAdmin):
@@ -15,6 +23,26 @@ class UserRecommendationPreferenceAdmin(admin.ModelAdmin):
     pass
 
 
+class BookRatingAggregateAdmin(admin.ModelAdmin):
+    pass
+
+
+class BookSimilarityAdmin(admin.ModelAdmin):
+    pass
+
+
+class UserGenreTasteAdmin(admin.ModelAdmin):
+    pass
+
+
+class UserAuthorTasteAdmin(admin.ModelAdmin):
+    pass
+
+
 admin.site.register(Book, BookAdmin)
 admin.site.register(Review, ReviewAdmin)
 admin.site.register(UserRecommendationPreference, UserRecommendationPreferenceAdmin)
+admin.site.register(BookRatingAggregate, BookRatingAggregateAdmin)
+admin.site.register(BookSimilarity, BookSimilarityAdmin)
+admin.site.register(UserGenreTaste, UserGenreTasteAdmin)
+admin.site.register(UserAuthorTaste, UserAuthorTasteAdmin)
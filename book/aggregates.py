@@ -0,0 +1,212 @@
+from collections import defaultdict
+
+from .leaderboards import scores_changed
+
+# first key of the pg_advisory_xact_lock of the taste profile of a user, the
+# second one is the user id
+TASTE_LOCK_NAMESPACE = 25
+
+
+def apply_rating_change(cursor, user_id, book_id, old_rating, new_rating):
+    """
+    Keep the per-book rating aggregate and the taste profile of the user in
+    step with a single review write.
+
+    •  add: old_rating is None
+
+    •  update: both ratings are given
+
+    •  delete: new_rating is None
+
+    It must run on the cursor of the transaction that writes the review.
+    """
+    if old_rating == new_rating:
+        return
+
+    changes = []
+    if old_rating is not None:
+        changes.append((user_id, book_id, old_rating, -1))
+    if new_rating is not None:
+        changes.append((user_id, book_id, new_rating, 1))
+
+    apply_rating_deltas(cursor, changes)
+
+
+def apply_rating_deltas(cursor, changes, tastes=True):
+    """
+    Apply many (user_id, book_id, rating, sign) changes, sign being 1 for an
+    added and -1 for a removed rating, to book_bookratingaggregate and, unless
+    tastes is False, to the genre and author taste profiles of the users
+    with one upsert each.
+
+    The new averages are moved to the genre and author leaderboards once the
+    transaction is committed.
+    """
+    _apply_book_deltas(cursor, changes)
+    if tastes:
+        _apply_taste_deltas(cursor, changes)
+
+
+def rebuild_taste_profiles(cursor, user_ids):
+    """
+    Recompute the taste profiles of user_ids from their reviews, after the
+    genre or author of a book they reviewed changed or the book was deleted.
+
+    It must run in a transaction: the taste locks of the users are held
+    until it ends, so a concurrent review write of one of them lands either
+    before the reviews are read or on the rebuilt rows.
+    """
+    if not user_ids:
+        return
+
+    user_ids = list(user_ids)
+    lock_tastes(cursor, user_ids)
+    cursor.execute(
+        """
+        DELETE FROM book_usergenretaste WHERE user_id = ANY(%s);
+        DELETE FROM book_userauthortaste WHERE user_id = ANY(%s);
+        INSERT INTO book_usergenretaste (user_id, genre, rating_sum, review_count)
+        SELECT r.user_id, b.genre, SUM(r.rating), COUNT(*)
+        FROM book_review r
+        JOIN book_book b ON b.id = r.book_id
+        WHERE r.user_id = ANY(%s)
+        GROUP BY r.user_id, b.genre;
+        INSERT INTO book_userauthortaste (user_id, author, rating_sum, review_count)
+        SELECT r.user_id, b.author, SUM(r.rating), COUNT(*)
+        FROM book_review r
+        JOIN book_book b ON b.id = r.book_id
+        WHERE r.user_id = ANY(%s)
+        GROUP BY r.user_id, b.author;
+        """,
+        [user_ids] * 4,
+    )
+
+
+def lock_tastes(cursor, user_ids):
+    """
+    Take the transaction level advisory locks of the taste profiles of
+    user_ids, in key order so two writers never deadlock. The user ids past
+    the int range share keys, which only makes them wait on each other.
+    """
+    # the keys are sorted in a subquery, the locks are taken as it is scanned
+    cursor.execute(
+        """
+        SELECT pg_advisory_xact_lock(%s, k.key)
+        FROM (
+            SELECT DISTINCT (user_id %% 2147483647)::int AS key
+            FROM unnest(%s::bigint[]) AS user_id
+            ORDER BY key
+        ) AS k;
+        """,
+        [TASTE_LOCK_NAMESPACE, list(user_ids)],
+    )
+
+
+def _apply_book_deltas(cursor, changes):
+    deltas = defaultdict(lambda: [0, 0, 0, 0, 0, 0, 0])
+    for _, book_id, rating, sign in changes:
+        delta = deltas[int(book_id)]
+        delta[0] += sign
+        delta[1] += sign * int(rating)
+        delta[1 + int(rating)] += sign
+
+    # the rows are locked in book_id order, two batches sharing books in a
+    # different order would otherwise deadlock
+    deltas = {book_id: delta for book_id, delta in sorted(deltas.items()) if any(delta)}
+    if not deltas:
+        return
+
+    book_ids = list(deltas)
+    columns = list(zip(*deltas.values()))
+
+    cursor.execute(
+        """
+        INSERT INTO book_bookratingaggregate AS agg (
+            book_id, review_count, rating_sum, average_rating,
+            rating_1_count, rating_2_count, rating_3_count,
+            rating_4_count, rating_5_count
+        )
+        SELECT d.book_id, d.review_count, d.rating_sum,
+            d.rating_sum::float / NULLIF(d.review_count, 0),
+            d.r1, d.r2, d.r3, d.r4, d.r5
+        FROM unnest(
+            %s::bigint[], %s::int[], %s::int[],
+            %s::int[], %s::int[], %s::int[], %s::int[], %s::int[]
+        ) AS d(book_id, review_count, rating_sum, r1, r2, r3, r4, r5)
+        ORDER BY d.book_id
+        ON CONFLICT (book_id) DO UPDATE SET
+            review_count = agg.review_count + EXCLUDED.review_count,
+            rating_sum = agg.rating_sum + EXCLUDED.rating_sum,
+            average_rating = (agg.rating_sum + EXCLUDED.rating_sum)::float
+                / NULLIF(agg.review_count + EXCLUDED.review_count, 0),
+            rating_1_count = agg.rating_1_count + EXCLUDED.rating_1_count,
+            rating_2_count = agg.rating_2_count + EXCLUDED.rating_2_count,
+            rating_3_count = agg.rating_3_count + EXCLUDED.rating_3_count,
+            rating_4_count = agg.rating_4_count + EXCLUDED.rating_4_count,
+            rating_5_count = agg.rating_5_count + EXCLUDED.rating_5_count
+        RETURNING agg.book_id, COALESCE(agg.average_rating, 0);
+        """,
+        [book_ids, *[list(column) for column in columns]],
+    )
+    scores_changed(dict(cursor.fetchall()))
+
+
+def _apply_taste_deltas(cursor, changes):
+    """
+    Add the (review_count, rating_sum) deltas of the changes to the
+    book_usergenretaste and book_userauthortaste rows of the users, under the
+    genre and author the book has at the time of the write.
+
+    The taste locks of the users are taken first, a rebuild of their
+    profiles waits for the write, and the rows are locked in
+    (user_id, genre) and (user_id, author) order, like the book aggregates,
+    so concurrent batches do not deadlock.
+    """
+    deltas = defaultdict(lambda: [0, 0])
+    for user_id, book_id, rating, sign in changes:
+        delta = deltas[(int(user_id), int(book_id))]
+        delta[0] += sign
+        delta[1] += sign * int(rating)
+
+    deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+
+    user_ids, book_ids = zip(*deltas)
+    review_counts, rating_sums = zip(*deltas.values())
+
+    lock_tastes(cursor, set(user_ids))
+
+    cursor.execute(
+        """
+        WITH d AS (
+            SELECT d.user_id, b.genre, b.author, d.review_count, d.rating_sum
+            FROM unnest(%s::bigint[], %s::bigint[], %s::int[], %s::int[])
+                AS d(user_id, book_id, review_count, rating_sum)
+            JOIN book_book b ON b.id = d.book_id
+        ),
+        genres AS (
+            INSERT INTO book_usergenretaste AS t (
+                user_id, genre, rating_sum, review_count
+            )
+            SELECT user_id, genre, SUM(rating_sum), SUM(review_count)
+            FROM d
+            GROUP BY user_id, genre
+            ORDER BY user_id, genre
+            ON CONFLICT (user_id, genre) DO UPDATE SET
+                rating_sum = t.rating_sum + EXCLUDED.rating_sum,
+                review_count = t.review_count + EXCLUDED.review_count
+        )
+        INSERT INTO book_userauthortaste AS t (
+            user_id, author, rating_sum, review_count
+        )
+        SELECT user_id, author, SUM(rating_sum), SUM(review_count)
+        FROM d
+        GROUP BY user_id, author
+        ORDER BY user_id, author
+        ON CONFLICT (user_id, author) DO UPDATE SET
+            rating_sum = t.rating_sum + EXCLUDED.rating_sum,
+            review_count = t.review_count + EXCLUDED.review_count;
+        """,
+        [list(user_ids), list(book_ids), list(review_counts), list(rating_sums)],
+    )
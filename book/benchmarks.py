@@ -0,0 +1,477 @@
+import json
+import random
+import resource
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.signals import request_finished, request_started
+from django.db import connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .aggregates import apply_rating_deltas
+from .catalog import catalog_changed
+from .leaderboards import rebuild_leaderboards
+from .models import Book
+from .services import BookRecommendationServiceFactory
+from .suggestions import get_suggestion_cache_key
+from .views import BookListView, BookSuggestView, ReviewAddView
+
+# the synthetic users and books are told apart from real ones by this prefix
+# of their user_name / title (no LIKE wildcard in it)
+BENCH_PREFIX = "bench-"
+
+INSERT_CHUNK_SIZE = 10000
+
+VIEW_SCENARIOS = ["book_list", "book_suggest", "book_suggest_cached", "review_add"]
+
+SCENARIOS = [
+    "book_list",
+    "book_suggest",
+    "book_suggest_cached",
+    "review_add",
+    *[f"service_{name}" for name in BookRecommendationServiceFactory.service_types],
+]
+
+
+# ----------------------------------------------------------------
+# -------------------     SYNTHETIC DATASET         --------------
+# ----------------------------------------------------------------
+
+
+def seed_dataset(num_users, num_books, num_reviews, zipf_exponent=1.1, seed=0):
+    """
+    Replace the synthetic dataset with num_users users, num_books books and
+    up to num_reviews reviews.
+
+    •  popularity: the number of reviews of the book of rank k is proportional
+       to 1 / k ** zipf_exponent, ranks being shuffled over the books.
+
+    •  ratings: every book has a hidden quality the ratings of its reviews are
+       drawn around, so averages and similarities are not pure noise.
+
+    Returns:
+    •  dict: the size of the seeded dataset.
+    """
+    rng = np.random.default_rng(seed)
+    flush_dataset()
+
+    User = get_user_model()
+    User.objects.bulk_create(
+        [
+            User(
+                user_name=f"{BENCH_PREFIX}{i}",
+                email=f"{BENCH_PREFIX}{i}@bench.local",
+                phone_number=f"b{i:010d}",
+                password="!",
+            )
+            for i in range(num_users)
+        ],
+        batch_size=INSERT_CHUNK_SIZE,
+    )
+
+    num_authors = max(1, num_books // 10)
+    num_genres = max(1, min(30, num_books // 50))
+    authors = rng.integers(num_authors, size=num_books)
+    genres = rng.integers(num_genres, size=num_books)
+    Book.objects.bulk_create(
+        [
+            Book(
+                title=f"{BENCH_PREFIX}{i}",
+                author=f"{BENCH_PREFIX}author-{authors[i]}",
+                genre=f"{BENCH_PREFIX}genre-{genres[i]}",
+            )
+            for i in range(num_books)
+        ],
+        batch_size=INSERT_CHUNK_SIZE,
+    )
+    # bulk_create() sends no post_save signal
+    catalog_changed()
+
+    user_ids = np.asarray(get_bench_user_ids(), dtype=np.int64)
+    book_ids = np.asarray(get_bench_book_ids(), dtype=np.int64)
+
+    popularity = 1.0 / np.arange(1, num_books + 1) ** zipf_exponent
+    popularity = rng.permutation(popularity / popularity.sum())
+    quality = rng.uniform(2.0, 4.5, size=num_books)
+
+    # draw (user, book) pairs until there are enough distinct ones
+    num_reviews = min(num_reviews, num_users * num_books)
+    pairs = np.empty(0, dtype=np.int64)
+    for _ in range(20):
+        missing = num_reviews - len(pairs)
+        if missing <= 0:
+            break
+        users = rng.integers(num_users, size=missing * 2)
+        books = rng.choice(num_books, size=missing * 2, p=popularity)
+        drawn = np.concatenate([pairs, users * num_books + books])
+        _, first = np.unique(drawn, return_index=True)
+        pairs = drawn[np.sort(first)][:num_reviews]
+
+    users, books = np.divmod(pairs, num_books)
+    ratings = np.clip(np.rint(rng.normal(quality[books], 1.0)), 1, 5).astype(int)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(pairs), INSERT_CHUNK_SIZE):
+            chunk = slice(start, start + INSERT_CHUNK_SIZE)
+            review_user_ids = user_ids[users[chunk]].tolist()
+            review_book_ids = book_ids[books[chunk]].tolist()
+            review_ratings = ratings[chunk].tolist()
+
+            cursor.execute(
+                """
+                INSERT INTO book_review (user_id, book_id, rating)
+                SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::int[]);
+                """,
+                [review_user_ids, review_book_ids, review_ratings],
+            )
+            apply_rating_deltas(
+                cursor,
+                [
+                    (user_id, book_id, rating, 1)
+                    for user_id, book_id, rating in zip(
+                        review_user_ids, review_book_ids, review_ratings
+                    )
+                ],
+            )
+
+    # the books of bulk_create() are on no leaderboard yet
+    rebuild_leaderboards()
+
+    return {
+        "users": num_users,
+        "books": num_books,
+        "reviews": len(pairs),
+        "zipf_exponent": zipf_exponent,
+        "seed": seed,
+    }
+
+
+def flush_dataset():
+    """Remove the synthetic users and books with everything that refers to them."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            DELETE FROM book_review
+            WHERE user_id IN (SELECT id FROM accounts_user WHERE user_name LIKE %s)
+               OR book_id IN (SELECT id FROM book_book WHERE title LIKE %s);
+            """,
+            [f"{BENCH_PREFIX}%", f"{BENCH_PREFIX}%"],
+        )
+
+    get_user_model().objects.filter(user_name__startswith=BENCH_PREFIX).delete()
+    Book.objects.filter(title__startswith=BENCH_PREFIX).delete()
+
+
+def get_bench_user_ids():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM accounts_user WHERE user_name LIKE %s ORDER BY id;",
+            [f"{BENCH_PREFIX}%"],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_bench_book_ids():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM book_book WHERE title LIKE %s ORDER BY id;",
+            [f"{BENCH_PREFIX}%"],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_dataset_size():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM accounts_user WHERE user_name LIKE %s),
+                (SELECT COUNT(*) FROM book_book WHERE title LIKE %s),
+                (SELECT COUNT(*) FROM book_review r
+                 JOIN accounts_user u ON u.id = r.user_id
+                 WHERE u.user_name LIKE %s);
+            """,
+            [f"{BENCH_PREFIX}%", f"{BENCH_PREFIX}%", f"{BENCH_PREFIX}%"],
+        )
+        users, books, reviews = cursor.fetchone()
+
+    return {"users": users, "books": books, "reviews": reviews}
+
+
+# ----------------------------------------------------------------
+# -------------------     SCENARIOS         ----------------------
+# ----------------------------------------------------------------
+
+
+class BenchmarkRunner:
+    """
+    Drive the views and services in-process against the synthetic dataset.
+
+    Views are called through the DRF request factory with throttling turned
+    off and the response rendered, so a request costs what it costs behind
+    the WSGI handler minus the network and the authentication.
+
+    •  review_add: every request reviews a book the user has not reviewed, in
+       a transaction that is rolled back so runs are repeatable. The
+       after-commit tasks are therefore not measured.
+
+    •  book_suggest: the cached suggestion list of the user is dropped before
+       every request, book_suggest_cached measures the cache hit path.
+
+    •  queries: only the queries of the request connections are counted, not
+       those of the suggestion thread pool when BOOK_SUGGEST_PARALLEL is on.
+    """
+
+    def __init__(self, num_requests, warmup=10, num_items=10, seed=0):
+        self.num_requests = num_requests
+        self.warmup = warmup
+        self.num_items = num_items
+        self.random = random.Random(seed)
+        self.factory = APIRequestFactory()
+
+        User = get_user_model()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT DISTINCT r.user_id
+                FROM book_review r
+                JOIN accounts_user u ON u.id = r.user_id
+                WHERE u.user_name LIKE %s
+                ORDER BY r.user_id
+                LIMIT 1000;
+                """,
+                [f"{BENCH_PREFIX}%"],
+            )
+            user_ids = [row[0] for row in cursor.fetchall()]
+
+        if not user_ids:
+            raise ValueError("There is no synthetic dataset, seed it first")
+
+        self.users = list(User.objects.filter(id__in=user_ids))
+        self.book_ids = get_bench_book_ids()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id, book_id FROM book_review WHERE user_id = ANY(%s);",
+                [user_ids],
+            )
+            self.reviewed = set(cursor.fetchall())
+
+    def run(self, scenarios=None):
+        return {
+            name: self.measure(self.get_prepare(name))
+            for name in scenarios or SCENARIOS
+        }
+
+    def get_prepare(self, name):
+        if name.startswith("service_"):
+            return self.prepare_service(name[len("service_") :])
+        return getattr(self, f"prepare_{name}")()
+
+    def measure(self, prepare):
+        """
+        Run warmup + num_requests calls, each prepare() returning the call to
+        time and whether its result is an error.
+        """
+        latencies = []
+        queries = []
+        errors = 0
+
+        for i in range(self.warmup + self.num_requests):
+            call = prepare()
+            with ExitStack() as stack:
+                # the replica and the primary queries are both counted
+                contexts = [
+                    stack.enter_context(CaptureQueriesContext(conn))
+                    for conn in connections.all()
+                ]
+                started = time.perf_counter()
+                failed = call()
+                elapsed = time.perf_counter() - started
+
+            if i < self.warmup:
+                continue
+            latencies.append(elapsed * 1000)
+            queries.append(sum(len(context.captured_queries) for context in contexts))
+            errors += bool(failed)
+
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {
+            "requests": self.num_requests,
+            "errors": errors,
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "mean_ms": round(float(np.mean(latencies)), 3),
+            "queries_per_request": round(float(np.mean(queries)), 2),
+            "peak_rss_mb": get_peak_rss_mb(),
+        }
+
+    def prepare_book_list(self):
+        view = BookListView.as_view(throttle_classes=[])
+        cursors = [0, *self.book_ids]
+
+        def prepare():
+            after = self.random.choice(cursors)
+            return self.get_view(view, "/api/book/list/", {"after": after})
+
+        return prepare
+
+    def prepare_book_suggest(self):
+        view = BookSuggestView.as_view(throttle_classes=[])
+
+        def prepare():
+            user = self.random.choice(self.users)
+            cache.delete(get_suggestion_cache_key(user.id))
+            return self.get_view(view, "/api/suggest/", user=user)
+
+        return prepare
+
+    def prepare_book_suggest_cached(self):
+        view = BookSuggestView.as_view(throttle_classes=[])
+
+        def prepare():
+            user = self.random.choice(self.users)
+            if cache.get(get_suggestion_cache_key(user.id)) is None:
+                self.get_view(view, "/api/suggest/", user=user)()
+            return self.get_view(view, "/api/suggest/", user=user)
+
+        return prepare
+
+    def prepare_review_add(self):
+        view = ReviewAddView.as_view(throttle_classes=[])
+
+        def prepare():
+            user = self.random.choice(self.users)
+            book_id = self.random.choice(self.book_ids)
+            while (user.id, book_id) in self.reviewed:
+                book_id = self.random.choice(self.book_ids)
+            data = {"book": book_id, "rating": self.random.randint(1, 5)}
+
+            def call():
+                with request_cycle(), transaction.atomic():
+                    request = self.factory.post("/api/review/add/", data, format="json")
+                    force_authenticate(request, user=user)
+                    response = view(request)
+                    response.render()
+                    transaction.set_rollback(True)
+                return response.status_code >= 400
+
+            return call
+
+        return prepare
+
+    def prepare_service(self, service_name):
+        service = BookRecommendationServiceFactory.create_service(service_name)
+
+        def prepare():
+            user = self.random.choice(self.users)
+
+            def call():
+                service.get_recommended_books(user.id, self.num_items)
+                return False
+
+            return call
+
+        return prepare
+
+    def get_view(self, view, path, params=None, user=None):
+        user = user or self.random.choice(self.users)
+
+        def call():
+            with request_cycle():
+                request = self.factory.get(path, params)
+                force_authenticate(request, user=user)
+                response = view(request)
+                response.render()
+            return response.status_code >= 400
+
+        return call
+
+
+@contextmanager
+def request_cycle():
+    """
+    Send the signals of the request handler around a view call, so database
+    connections are closed, reused or returned to their pool as they are
+    behind the WSGI handler.
+    """
+    request_started.send(sender=BenchmarkRunner)
+    try:
+        yield
+    finally:
+        request_finished.send(sender=BenchmarkRunner)
+
+
+def set_conn_max_age(conn_max_age):
+    """Change CONN_MAX_AGE of every connection, closing the open ones."""
+    for conn in connections.all():
+        conn.close()
+        conn.settings_dict["CONN_MAX_AGE"] = conn_max_age
+
+
+def get_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+# ----------------------------------------------------------------
+# -------------------     RESULTS         ------------------------
+# ----------------------------------------------------------------
+
+
+def build_report(dataset, results):
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "dataset": dataset,
+        "settings": {
+            "CONN_MAX_AGE": connection.settings_dict["CONN_MAX_AGE"],
+            "CONN_HEALTH_CHECKS": connection.settings_dict["CONN_HEALTH_CHECKS"],
+            "DB_POOL": "pool" in connection.settings_dict["OPTIONS"],
+            "CACHE_LOCAL": settings.CACHE_LOCAL,
+            "BOOK_RECOMMENDATION_BACKEND": settings.BOOK_RECOMMENDATION_BACKEND,
+            "BOOK_SUGGEST_PARALLEL": settings.BOOK_SUGGEST_PARALLEL,
+            "BOOK_PAGE_SIZE": settings.BOOK_PAGE_SIZE,
+        },
+        "peak_rss_mb": get_peak_rss_mb(),
+        "scenarios": results,
+    }
+
+
+def load_report(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_report(report, path):
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+        file.write("\n")
+
+
+def compare_reports(report, baseline, metrics=("p50_ms", "p95_ms", "p99_ms")):
+    """
+    Compare the scenarios of a report to those of a baseline report.
+
+    Returns:
+    •  list: (scenario, metric, baseline, current, ratio) rows, ratio being
+       current / baseline (None for a scenario missing from the baseline).
+    """
+    rows = []
+    for name, result in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        for metric in (*metrics, "queries_per_request"):
+            current = result[metric]
+            previous = base.get(metric) if base else None
+            ratio = round(current / previous, 3) if previous else None
+            rows.append((name, metric, previous, current, ratio))
+    return rows
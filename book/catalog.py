@@ -0,0 +1,65 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .replicas import get_read_alias, uses_replica
+
+# version of the catalog, every cached catalog response is keyed by it so
+# bumping it invalidates them all at once
+CATALOG_VERSION_KEY = "CatalogVersion"
+
+# set for DB_READ_YOUR_WRITES_TIMEOUT seconds after a change, the cache of the
+# new version is then filled from the primary instead of a lagging replica
+CATALOG_CHANGED_KEY = "CatalogChanged"
+
+
+def get_catalog_cache_key(version, name, *parts):
+    return "_".join(["Catalog", str(version), name, *map(str, parts)])
+
+
+def get_catalog_state():
+    """
+    Read the catalog version and the alias to fill its cache from in one
+    round trip.
+
+    Returns:
+    •  tuple: (version, using)
+    """
+    state = cache.get_many([CATALOG_VERSION_KEY, CATALOG_CHANGED_KEY])
+
+    version = state.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, _new_version(), None)
+        version = cache.get(CATALOG_VERSION_KEY)
+
+    using = DEFAULT_DB_ALIAS if CATALOG_CHANGED_KEY in state else get_read_alias()
+    return version, using
+
+
+def get_catalog_read_alias():
+    """The alias to read books from, the primary right after a change."""
+    if uses_replica() and cache.get(CATALOG_CHANGED_KEY):
+        return DEFAULT_DB_ALIAS
+    return get_read_alias()
+
+
+def catalog_changed():
+    """Bump the catalog version once the current transaction is committed."""
+    transaction.on_commit(bump_catalog_version, robust=True)
+
+
+def bump_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # the version was evicted, restart from a value no old key can have
+        cache.set(CATALOG_VERSION_KEY, _new_version(), None)
+
+    if uses_replica():
+        cache.set(CATALOG_CHANGED_KEY, 1, settings.DB_READ_YOUR_WRITES_TIMEOUT)
+
+
+def _new_version():
+    return time.time_ns() // 1000
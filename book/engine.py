@@ -0,0 +1,282 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+RATING_LEVELS = 5
+
+_engine = None
+_engine_lock = threading.Lock()
+_reload_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Return the per-process engine, loading it from the database when it is
+    missing.
+
+    Once it is older than BOOK_ENGINE_TTL seconds, one background thread
+    loads the next one while the requests keep being answered by the old
+    one, the reference is swapped when the load is done.
+    """
+    global _engine
+
+    engine = _engine
+    if engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RecommendationEngine.load()
+        return _engine
+
+    if engine.is_expired() and _reload_lock.acquire(blocking=False):
+        threading.Thread(target=_reload_engine, daemon=True).start()
+
+    return engine
+
+
+def _reload_engine():
+    global _engine
+
+    try:
+        _engine = RecommendationEngine.load()
+    except Exception:
+        logger.exception("reloading the recommendation engine failed")
+    finally:
+        # the thread opened its own connection
+        connection.close()
+        _reload_lock.release()
+
+
+class RecommendationEngine:
+    """
+    In-memory snapshot of book_review that answers the genre, author and
+    similar_user recommendations with NumPy / SciPy operations.
+
+    •  ratings: CSR user x book matrix of the ratings.
+
+    •  matches: CSR user x (book, rating) binary matrix, so the number of
+       books two users rated the same is a single sparse dot product.
+
+    •  genre_order / author_order: book columns grouped by genre / author and
+       ranked by average rating in each group like the leaderboards of
+       book/leaderboards.py, with offsets of each genre / author in them.
+    """
+
+    def __init__(self, books, genre_order, author_order, reviews):
+        book_ids, titles, authors, genres = books
+        self.loaded_at = time.monotonic()
+
+        self.book_ids = np.asarray(book_ids, dtype=np.int64)
+        self.titles = titles
+        self.authors = authors
+        self.genres = genres
+        book_index = {book_id: col for col, book_id in enumerate(book_ids)}
+
+        self.genre_codes, self.genre_order, self.genre_offsets = self._encode(
+            genres, [book_index[book_id] for book_id in genre_order]
+        )
+        self.author_codes, self.author_order, self.author_offsets = self._encode(
+            authors, [book_index[book_id] for book_id in author_order]
+        )
+
+        user_ids = sorted({user_id for user_id, _, _ in reviews})
+        self.user_index = {user_id: row for row, user_id in enumerate(user_ids)}
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+
+        rows = np.fromiter(
+            (self.user_index[user_id] for user_id, _, _ in reviews),
+            dtype=np.int64,
+            count=len(reviews),
+        )
+        cols = np.fromiter(
+            (book_index[book_id] for _, book_id, _ in reviews),
+            dtype=np.int64,
+            count=len(reviews),
+        )
+        values = np.fromiter(
+            (rating for _, _, rating in reviews), dtype=np.float32, count=len(reviews)
+        )
+        shape = (len(user_ids), len(book_ids))
+
+        self.ratings = sparse.csr_matrix((values, (rows, cols)), shape=shape)
+        self.matches = sparse.csr_matrix(
+            (
+                np.ones(len(reviews), dtype=np.float32),
+                (rows, cols * RATING_LEVELS + values.astype(np.int64) - 1),
+            ),
+            shape=(shape[0], shape[1] * RATING_LEVELS),
+        )
+
+    @classmethod
+    def load(cls):
+        """
+        Read the books with their position in the genre and author orders in
+        one statement, so they share a snapshot, and then the reviews. The
+        reviews of books created after the first read are left out, the next
+        reload ranks them.
+        """
+        with connection.cursor() as cursor:
+            # the books of a group ranked like on the leaderboards: by
+            # average rating, the ties by id as a string descending like
+            # ZREVRANGE orders equal scores
+            cursor.execute(
+                """
+                SELECT b.id, b.title, b.author, b.genre,
+                    ROW_NUMBER() OVER (
+                        ORDER BY b.genre, s.score DESC, b.id::text COLLATE "C" DESC
+                    ),
+                    ROW_NUMBER() OVER (
+                        ORDER BY b.author, s.score DESC, b.id::text COLLATE "C" DESC
+                    )
+                FROM book_book b
+                LEFT JOIN book_bookratingaggregate agg ON agg.book_id = b.id,
+                LATERAL (SELECT COALESCE(agg.average_rating, 0) AS score) s;
+                """
+            )
+            rows = cursor.fetchall()
+
+            cursor.execute("SELECT user_id, book_id, rating FROM book_review;")
+            reviews = cursor.fetchall()
+
+        books = list(zip(*[row[:4] for row in rows])) or [(), (), (), ()]
+        genre_order = [row[0] for row in sorted(rows, key=lambda row: row[4])]
+        author_order = [row[0] for row in sorted(rows, key=lambda row: row[5])]
+
+        book_ids = set(books[0])
+        reviews = [review for review in reviews if review[1] in book_ids]
+
+        return cls(books, genre_order, author_order, reviews)
+
+    def is_expired(self):
+        return time.monotonic() - self.loaded_at > settings.BOOK_ENGINE_TTL
+
+    def recommend(self, service_type, user_id, num_items):
+        if service_type == "genre":
+            return self.recommend_by_group(
+                user_id,
+                num_items,
+                self.genre_codes,
+                self.genre_order,
+                self.genre_offsets,
+            )
+
+        elif service_type == "author":
+            return self.recommend_by_group(
+                user_id,
+                num_items,
+                self.author_codes,
+                self.author_order,
+                self.author_offsets,
+            )
+
+        elif service_type == "similar_user":
+            return self.recommend_by_similar_users(user_id, num_items)
+
+        raise ValueError(f"Unknown service type: {service_type}")
+
+    def recommend_by_group(self, user_id, num_items, codes, order, offsets):
+        """
+        Rank the groups (genres or authors) of the user by their average
+        rating and return the best rated books of the best groups, like the
+        leaderboard services.
+        """
+        row = self.user_index.get(user_id)
+        if row is None or num_items <= 0:
+            return []
+
+        user_ratings = self.ratings.getrow(row)
+        user_codes = codes[user_ratings.indices]
+        sums = np.bincount(user_codes, weights=user_ratings.data)
+        counts = np.bincount(user_codes)
+
+        present = np.flatnonzero(counts)
+        averages = sums[present] / counts[present]
+        ranked = present[np.lexsort((present, -averages))]
+
+        cols = []
+        remaining = num_items
+        for code in ranked:
+            group = order[offsets[code] : offsets[code + 1]][:remaining]
+            cols.append(group)
+            remaining -= len(group)
+            if remaining == 0:
+                break
+
+        return self.format_books(np.concatenate(cols))
+
+    def recommend_by_similar_users(self, user_id, num_items, num_users=10):
+        """
+        Find the users that gave the same rating to the most books and return
+        the books they rated 4 or 5 that the user has not rated yet.
+        """
+        row = self.user_index.get(user_id)
+        if row is None or num_items <= 0:
+            return []
+
+        similarity = (self.matches @ self.matches.getrow(row).T).toarray().ravel()
+        similarity[row] = 0
+        candidates = np.flatnonzero(similarity)
+        if not len(candidates):
+            return []
+
+        similar_rows = self._top_k(candidates, similarity[candidates], num_users)
+
+        similar_ratings = self.ratings[similar_rows]
+        liked = similar_ratings.multiply(similar_ratings >= 4).tocsr()
+        sums = np.asarray(liked.sum(axis=0)).ravel()
+        counts = np.asarray((liked > 0).sum(axis=0)).ravel()
+
+        counts[self.ratings.getrow(row).indices] = 0
+        cols = np.flatnonzero(counts)
+        if not len(cols):
+            return []
+
+        averages = sums[cols] / counts[cols]
+        return self.format_books(self._top_k(cols, averages, num_items))
+
+    def format_books(self, cols):
+        return [
+            {
+                "id": int(self.book_ids[col]),
+                "title": self.titles[col],
+                "author": self.authors[col],
+                "genre": self.genres[col],
+            }
+            for col in cols
+        ]
+
+    def _top_k(self, items, scores, k):
+        """Return the k items with the highest scores, best first."""
+        if len(items) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            items, scores = items[top], scores[top]
+        return items[np.argsort(-scores, kind="stable")]
+
+    def _encode(self, values, sorted_cols):
+        """
+        Encode the group values of the books as integer codes that follow the
+        SQL sort order, and return the codes, the sorted book columns and the
+        offset of every group in them.
+        """
+        sorted_cols = np.asarray(sorted_cols, dtype=np.int64)
+        codes = np.empty(len(values), dtype=np.int64)
+        offsets = [0]
+
+        code = -1
+        previous = None
+        for position, col in enumerate(sorted_cols):
+            if position == 0 or values[col] != previous:
+                code += 1
+                previous = values[col]
+                if position:
+                    offsets.append(position)
+            codes[col] = code
+        offsets.append(len(sorted_cols))
+
+        return codes, sorted_cols, np.asarray(offsets, dtype=np.int64)
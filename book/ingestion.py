@@ -0,0 +1,166 @@
+from django.db import connection, transaction
+
+from .aggregates import apply_rating_deltas
+from .review_events import review_written
+
+CREATED = "created"
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+def ingest_reviews(user_id, rows, update_existing=False):
+    """
+    Add the reviews of many books for one user with a constant number of
+    queries, whatever the number of rows is.
+
+    •  rows: a list of {"book": book_id, "rating": rating} dicts.
+
+    •  update_existing: if True the rating of an already reviewed book is
+       replaced, else the row fails like a single add would.
+
+    Rows are validated in Python, the books are checked with one query, and
+    the reviews are written with one INSERT ... ON CONFLICT statement. The
+    rating aggregates are then updated once for the whole batch.
+
+    Returns:
+    •  list: one {"index", "book", "rating", "status"} result per row, with an
+       "errors" list for the failed ones.
+    """
+    results = [{"index": index, "status": FAILED} for index in range(len(rows))]
+    valid = {}
+
+    # ----------------------------------------------------------------
+    #  validate the rows, the first row of a book wins
+    # ----------------------------------------------------------------
+    for result, row in zip(results, rows):
+        book_id, rating, errors = _parse_row(row)
+        result["book"], result["rating"] = book_id, rating
+
+        if not errors and book_id in valid:
+            errors.append("This book appears more than once in the batch")
+        if errors:
+            result["errors"] = errors
+        else:
+            valid[book_id] = result
+
+    if not valid:
+        return results
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # ----------------------------------------------------------------
+        #  check the books in one query
+        # ----------------------------------------------------------------
+        cursor.execute(
+            "SELECT id FROM book_book WHERE id = ANY(%s);",
+            [list(valid)],
+        )
+        existing_books = {row[0] for row in cursor.fetchall()}
+
+        for book_id in list(valid):
+            if book_id not in existing_books:
+                valid.pop(book_id)["errors"] = ["There are no books with this id"]
+
+        if not valid:
+            return results
+
+        # ----------------------------------------------------------------
+        #  write the reviews in one statement, returning the old ratings
+        # ----------------------------------------------------------------
+        on_conflict = (
+            """
+            DO UPDATE SET rating = EXCLUDED.rating
+            WHERE book_review.rating <> EXCLUDED.rating
+            """
+            if update_existing
+            else "DO NOTHING"
+        )
+        cursor.execute(
+            f"""
+            WITH input (book_id, rating) AS (
+                SELECT * FROM unnest(%s::bigint[], %s::int[])
+            ),
+            existing AS (
+                SELECT r.book_id, r.rating
+                FROM book_review r
+                JOIN input i ON i.book_id = r.book_id
+                WHERE r.user_id = %s
+            ),
+            written AS (
+                INSERT INTO book_review (user_id, book_id, rating)
+                SELECT %s, book_id, rating FROM input
+                ON CONFLICT (book_id, user_id) {on_conflict}
+                RETURNING book_id
+            )
+            SELECT i.book_id, e.rating, w.book_id IS NOT NULL
+            FROM input i
+            LEFT JOIN existing e ON e.book_id = i.book_id
+            LEFT JOIN written w ON w.book_id = i.book_id;
+            """,
+            [
+                list(valid),
+                [result["rating"] for result in valid.values()],
+                user_id,
+                user_id,
+            ],
+        )
+
+        changes = []
+        for book_id, old_rating, written in cursor.fetchall():
+            result = valid[book_id]
+            new_rating = result["rating"]
+
+            if written and old_rating is None:
+                result["status"] = CREATED
+                changes.append((user_id, book_id, new_rating, 1))
+            elif written:
+                result["status"] = UPDATED
+                changes.append((user_id, book_id, old_rating, -1))
+                changes.append((user_id, book_id, new_rating, 1))
+            elif update_existing and old_rating is not None:
+                result["status"] = UNCHANGED
+            else:
+                result["errors"] = ["User has already reviewed this book"]
+
+        # ----------------------------------------------------------------
+        #  update the rating aggregates once for the batch
+        # ----------------------------------------------------------------
+        if changes:
+            apply_rating_deltas(cursor, changes)
+            review_written(user_id)
+
+    return results
+
+
+def summarize_results(results):
+    summary = {CREATED: 0, UPDATED: 0, UNCHANGED: 0, FAILED: 0}
+    for result in results:
+        summary[result["status"]] += 1
+    return summary
+
+
+def _parse_row(row):
+    errors = []
+    if not isinstance(row, dict):
+        return None, None, ["Each review must be an object with book and rating"]
+
+    book_id = _parse_int(row.get("book"))
+    if book_id is None or book_id < 1:
+        errors.append("A valid book id is required")
+
+    rating = _parse_int(row.get("rating"))
+    if rating is None:
+        errors.append("A valid integer rating is required")
+    elif rating < 1 or rating > 5:
+        errors.append("Rating must be between 1 and 5")
+
+    return book_id, rating, errors
+
+
+def _parse_int(value):
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,301 @@
+import json
+import time
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django_redis import get_redis_connection
+
+from .hydration import get_books
+
+# a sorted set of books scored by average rating per genre and per author,
+# the books with no review scored 0, and the set of the existing boards
+LEADERBOARD_PREFIXES = {"genre": "GenreBooks", "author": "AuthorBooks"}
+LEADERBOARDS_KEY = "Leaderboards"
+
+# ranked values whose boards get_top_book_ids reads per round trip
+LEADERBOARD_READ_CHUNK_SIZE = 5
+
+# books read per fetch and sent per ZADD, and keys per DEL, by
+# rebuild_leaderboards
+LEADERBOARD_REBUILD_CHUNK_SIZE = 1000
+
+# stream of the books the writers moved on the boards, with the boards they
+# left, so a rebuild re-applies the changes made while it ran, the entries
+# are kept LEADERBOARD_CHANGES_RETENTION seconds
+LEADERBOARD_CHANGES_KEY = "LeaderboardChanges"
+LEADERBOARD_CHANGES_RETENTION = 3600
+
+LEADERBOARD_BOOKS_QUERY = """
+    SELECT b.id, b.genre, b.author, COALESCE(agg.average_rating, 0)
+    FROM book_book b
+    LEFT JOIN book_bookratingaggregate agg ON agg.book_id = b.id
+    """
+
+
+def get_leaderboard_key(kind, value):
+    return f"{LEADERBOARD_PREFIXES[kind]}_{value}"
+
+
+def get_leaderboard_book_ids(kind, values, num_items):
+    """
+    The ids of the num_items best rated books of the ranked genres or authors
+    of values, the books of the first value first, with one ZREVRANGE per
+    value sent in a single round trip.
+
+    Returns:
+    •  dict: {value: book ids} of every value of values.
+    """
+    values = list(dict.fromkeys(values))
+    if not values or num_items <= 0:
+        return {value: [] for value in values}
+
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for value in values:
+        pipe.zrevrange(get_leaderboard_key(kind, value), 0, num_items - 1)
+
+    return {
+        value: [int(book_id) for book_id in book_ids]
+        for value, book_ids in zip(values, pipe.execute())
+    }
+
+
+def get_top_book_ids(kind, values, num_items):
+    """
+    The num_items best rated books across the ranked values, in order.
+
+    The boards are read LEADERBOARD_READ_CHUNK_SIZE values at a time, asking
+    each chunk for the ids still missing only, until num_items ids are
+    collected, the favorite values of a user usually fill the list alone.
+    """
+    values = list(dict.fromkeys(values))
+    chunk_size = LEADERBOARD_READ_CHUNK_SIZE
+
+    book_ids = []
+    for start in range(0, len(values), chunk_size):
+        if len(book_ids) >= num_items:
+            break
+
+        boards = get_leaderboard_book_ids(
+            kind, values[start : start + chunk_size], num_items - len(book_ids)
+        )
+        for board in boards.values():
+            book_ids.extend(board)
+
+    return book_ids[:num_items]
+
+
+def scores_changed(scores):
+    """
+    Move the books of {book_id: average_rating} to their new score once the
+    current transaction is committed.
+    """
+    if scores:
+        transaction.on_commit(lambda: update_leaderboards(scores), robust=True)
+
+
+def update_leaderboards(scores):
+    books = get_books(scores)
+    if not books:
+        return
+
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for book_id, book in books.items():
+        for kind in LEADERBOARD_PREFIXES:
+            key = get_leaderboard_key(kind, book[kind])
+            pipe.zadd(key, {book_id: scores[book_id]})
+            pipe.sadd(LEADERBOARDS_KEY, key)
+    log_changes(pipe, books)
+    pipe.execute()
+
+
+def books_changed(books, deleted=False):
+    """
+    Add new books of (book_id, genre, author) to their boards with no score,
+    or remove deleted ones, once the current transaction is committed.
+    """
+
+    def apply():
+        pipe = get_redis_connection("default").pipeline(transaction=False)
+        left = []
+        for book_id, genre, author in books:
+            for kind, value in (("genre", genre), ("author", author)):
+                key = get_leaderboard_key(kind, value)
+                if deleted:
+                    pipe.zrem(key, book_id)
+                    left.append((key, book_id))
+                else:
+                    pipe.zadd(key, {book_id: 0}, nx=True)
+                    pipe.sadd(LEADERBOARDS_KEY, key)
+        log_changes(pipe, [book_id for book_id, _, _ in books], left)
+        pipe.execute()
+
+    if books:
+        transaction.on_commit(apply, robust=True)
+
+
+def book_moved(book_id, old, new):
+    """
+    Move a book whose (genre, author) changed from old to new from its old
+    boards to the new ones with its current score, once the current
+    transaction is committed.
+    """
+
+    def apply():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT COALESCE(average_rating, 0)
+                FROM book_bookratingaggregate
+                WHERE book_id = %s;
+                """,
+                [book_id],
+            )
+            row = cursor.fetchone()
+        score = row[0] if row else 0
+
+        pipe = get_redis_connection("default").pipeline(transaction=True)
+        left = []
+        for kind, old_value, new_value in zip(("genre", "author"), old, new):
+            if old_value == new_value:
+                continue
+            old_key = get_leaderboard_key(kind, old_value)
+            pipe.zrem(old_key, book_id)
+            left.append((old_key, book_id))
+            key = get_leaderboard_key(kind, new_value)
+            pipe.zadd(key, {book_id: score})
+            pipe.sadd(LEADERBOARDS_KEY, key)
+        log_changes(pipe, [book_id], left)
+        pipe.execute()
+
+    transaction.on_commit(apply, robust=True)
+
+
+def log_changes(pipe, book_ids, left=()):
+    """
+    Log in the pipeline of a writer the book_ids it moved on the boards and
+    the (key, book_id) of the boards they left.
+    """
+    pipe.xadd(
+        LEADERBOARD_CHANGES_KEY,
+        {"book_ids": json.dumps(list(book_ids)), "left": json.dumps(list(left))},
+        minid=int((time.time() - LEADERBOARD_CHANGES_RETENTION) * 1000),
+        approximate=True,
+    )
+
+
+def get_rebuild_key(key):
+    return f"{key}_rebuild"
+
+
+def rebuild_leaderboards():
+    """
+    Rebuild every board from the catalog and the rating aggregates, this
+    drops the books that moved to another genre or author and the updates
+    applied out of order by concurrent review writes.
+
+    •  The books are streamed from a server side cursor
+       LEADERBOARD_REBUILD_CHUNK_SIZE at a time into a temporary key per
+       board, RENAMEd over the live one at the end, so readers see either
+       board whole and Redis is never blocked by one giant MULTI.
+
+    •  The books the writers moved while the boards were built are read
+       again and re-applied to the renamed boards, the updates made after
+       the catalog was read are not lost.
+
+    •  The boards of the genres and authors no book has anymore are deleted
+       afterwards, in chunks too. The existing boards are listed before the
+       catalog is read, a board created meanwhile is not taken for stale.
+
+    Returns:
+    •  int: the number of books ranked.
+    """
+    redis = get_redis_connection("default")
+    chunk_size = LEADERBOARD_REBUILD_CHUNK_SIZE
+
+    old_keys = {key.decode() for key in redis.smembers(LEADERBOARDS_KEY)}
+    seconds, microseconds = redis.time()
+    started = f"{seconds * 1000 + microseconds // 1000}-0"
+
+    keys, num_books = _build_boards(redis, chunk_size)
+
+    pipe = redis.pipeline(transaction=False)
+    for start in range(0, len(keys), chunk_size):
+        for key in keys[start : start + chunk_size]:
+            pipe.rename(get_rebuild_key(key), key)
+            pipe.sadd(LEADERBOARDS_KEY, key)
+        pipe.execute()
+
+    _reapply_changes(redis, started)
+
+    stale_keys = list(old_keys - set(keys))
+    for start in range(0, len(stale_keys), chunk_size):
+        chunk = stale_keys[start : start + chunk_size]
+        pipe.srem(LEADERBOARDS_KEY, *chunk)
+        pipe.delete(*chunk)
+        pipe.execute()
+
+    return num_books
+
+
+def _build_boards(redis, chunk_size):
+    """
+    Stream the catalog into the temporary keys of the boards.
+
+    Returns:
+    •  tuple: (keys of the boards built, number of books).
+    """
+    keys = {}
+    num_books = 0
+
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(LEADERBOARD_BOOKS_QUERY + ";")
+        while rows := cursor.fetchmany(chunk_size):
+            boards = defaultdict(dict)
+            for book_id, genre, author, score in rows:
+                for kind, value in (("genre", genre), ("author", author)):
+                    boards[get_leaderboard_key(kind, value)][book_id] = score
+
+            pipe = redis.pipeline(transaction=False)
+            for key, scores in boards.items():
+                if key not in keys:
+                    # left over by a rebuild that died
+                    pipe.delete(get_rebuild_key(key))
+                    keys[key] = None
+                pipe.zadd(get_rebuild_key(key), scores)
+            pipe.execute()
+
+            num_books += len(rows)
+
+    return list(keys), num_books
+
+
+def _reapply_changes(redis, started):
+    """
+    Move the books logged by the writers since started to the boards and
+    scores they have now in the database.
+    """
+    changes = redis.xrange(LEADERBOARD_CHANGES_KEY, min=started)
+    if not changes:
+        return
+
+    book_ids = set()
+    left = set()
+    for _, fields in changes:
+        book_ids.update(json.loads(fields[b"book_ids"]))
+        left.update(tuple(pair) for pair in json.loads(fields[b"left"]))
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            LEADERBOARD_BOOKS_QUERY + "WHERE b.id = ANY(%s);", [sorted(book_ids)]
+        )
+        rows = cursor.fetchall()
+
+    pipe = redis.pipeline(transaction=False)
+    for key, book_id in left:
+        pipe.zrem(key, book_id)
+    for book_id, genre, author, score in rows:
+        for kind, value in (("genre", genre), ("author", author)):
+            key = get_leaderboard_key(kind, value)
+            pipe.zadd(key, {book_id: score})
+            pipe.sadd(LEADERBOARDS_KEY, key)
+    pipe.execute()
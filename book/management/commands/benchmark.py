@@ -0,0 +1,195 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from book.benchmarks import (
+    SCENARIOS,
+    VIEW_SCENARIOS,
+    BenchmarkRunner,
+    build_report,
+    compare_reports,
+    flush_dataset,
+    get_dataset_size,
+    load_report,
+    save_report,
+    seed_dataset,
+    set_conn_max_age,
+)
+from book.tasks import build_item_similarity
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic dataset and measure the latency percentiles, queries "
+        "per request and peak RSS of the book endpoints and services in-process. "
+        "Results are written as JSON and can be compared to a baseline run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seed-data",
+            action="store_true",
+            help="(Re)seed the synthetic dataset before the run.",
+        )
+        parser.add_argument(
+            "--flush",
+            action="store_true",
+            help="Only remove the synthetic dataset.",
+        )
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--books", type=int, default=2000)
+        parser.add_argument("--reviews", type=int, default=50000)
+        parser.add_argument(
+            "--zipf",
+            type=float,
+            default=1.1,
+            help="Exponent of the Zipf distribution of the book popularity.",
+        )
+        parser.add_argument("--random-seed", type=int, default=0)
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=SCENARIOS,
+            help="Scenario to run, repeat for several (default: all).",
+        )
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--warmup", type=int, default=10)
+        parser.add_argument("--num-items", type=int, default=10)
+        parser.add_argument(
+            "--compare-connections",
+            action="store_true",
+            help=(
+                "Run the endpoint scenarios with a connection per request and "
+                "with persistent connections, and compare their latencies."
+            ),
+        )
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--baseline", help="Compare to this results JSON file.")
+        parser.add_argument(
+            "--max-regression",
+            type=float,
+            help="Fail if a latency percentile is more than this times the baseline.",
+        )
+
+    def handle(self, *args, **options):
+        if options["flush"]:
+            flush_dataset()
+            self.stdout.write("synthetic dataset removed")
+            return
+
+        if options["seed_data"]:
+            dataset = seed_dataset(
+                options["users"],
+                options["books"],
+                options["reviews"],
+                zipf_exponent=options["zipf"],
+                seed=options["random_seed"],
+            )
+            self.stdout.write(f"seeded {dataset}")
+            # the item_similarity service reads the offline model
+            self.stdout.write(f"similarities {build_item_similarity()}")
+        else:
+            dataset = get_dataset_size()
+
+        try:
+            runner = BenchmarkRunner(
+                options["requests"],
+                warmup=options["warmup"],
+                num_items=options["num_items"],
+                seed=options["random_seed"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options["compare_connections"]:
+            results = self.run_connection_modes(runner, options)
+        else:
+            results = runner.run(options["scenario"])
+        report = build_report(dataset, results)
+
+        self.stdout.write(
+            f"{'scenario':<34}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+            f"{'queries':>10}{'errors':>8}{'rss MB':>10}"
+        )
+        for name, result in report["scenarios"].items():
+            self.stdout.write(
+                f"{name:<34}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+                f"{result['p99_ms']:>10}{result['queries_per_request']:>10}"
+                f"{result['errors']:>8}{result['peak_rss_mb']:>10}"
+            )
+
+        if options["output"]:
+            save_report(report, options["output"])
+            self.stdout.write(f"results written to {options['output']}")
+
+        if options["baseline"]:
+            self.compare(report, load_report(options["baseline"]), options)
+
+    def run_connection_modes(self, runner, options):
+        """
+        Run the endpoint scenarios once per connection mode, the results are
+        named <scenario>@<mode>.
+
+        •  per-request: CONN_MAX_AGE=0, a connection is opened per request.
+
+        •  persistent: the configured CONN_MAX_AGE, or 600 seconds if it is 0.
+        """
+        configured = connection.settings_dict["CONN_MAX_AGE"]
+        modes = {"per-request": 0, "persistent": configured or 600}
+        scenarios = [
+            name
+            for name in options["scenario"] or VIEW_SCENARIOS
+            if name in VIEW_SCENARIOS
+        ]
+
+        if not scenarios:
+            raise CommandError(
+                f"--compare-connections runs the endpoint scenarios {VIEW_SCENARIOS}"
+            )
+
+        results = {}
+        try:
+            for mode, conn_max_age in modes.items():
+                set_conn_max_age(conn_max_age)
+                for name, result in runner.run(scenarios).items():
+                    results[f"{name}@{mode}"] = result
+        finally:
+            set_conn_max_age(configured)
+
+        self.stdout.write(
+            f"{'scenario':<34}{'p50 ms':>26}{'p95 ms':>26}\n"
+            f"{'':<34}{'per-request':>14}{'persistent':>12}"
+            f"{'per-request':>14}{'persistent':>12}"
+        )
+        for name in scenarios:
+            per_request = results[f"{name}@per-request"]
+            persistent = results[f"{name}@persistent"]
+            self.stdout.write(
+                f"{name:<34}{per_request['p50_ms']:>14}{persistent['p50_ms']:>12}"
+                f"{per_request['p95_ms']:>14}{persistent['p95_ms']:>12}"
+            )
+        self.stdout.write("")
+
+        return results
+
+    def compare(self, report, baseline, options):
+        self.stdout.write(
+            f"\n{'scenario':<34}{'metric':<22}{'baseline':>12}{'current':>12}{'ratio':>8}"
+        )
+
+        regressions = []
+        for name, metric, previous, current, ratio in compare_reports(report, baseline):
+            self.stdout.write(
+                f"{name:<34}{metric:<22}{str(previous):>12}{current:>12}{str(ratio):>8}"
+            )
+            if (
+                options["max_regression"]
+                and metric.endswith("_ms")
+                and ratio is not None
+                and ratio > options["max_regression"]
+            ):
+                regressions.append(f"{name} {metric} x{ratio}")
+
+        if regressions:
+            raise CommandError(
+                "Regressions over the baseline: " + ", ".join(regressions)
+            )
@@ -0,0 +1,239 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from book.popular import POPULAR_BOOKS_QUERY
+from book.services import (
+    AuthorBookRecommendationService,
+    GenreBookRecommendationService,
+    ItemSimilarityBookRecommendationService,
+    PopularBookRecommendationService,
+    SimilarUserBookRecommendationService,
+)
+from book.tasks import ITEM_SIMILARITY_BATCH_QUERY, create_book_norm
+from book.views import (
+    BookFilterView,
+    BookGenreListView,
+    BookListView,
+    BookSuggestView,
+    ReviewListView,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run EXPLAIN (ANALYZE, BUFFERS) on every hot raw-SQL query against the "
+        "current (seeded) database and fail if any of them uses a sequential scan."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user-id",
+            type=int,
+            help="user to explain the queries for (default: the user with most reviews)",
+        )
+        parser.add_argument("--num-items", type=int, default=10)
+        parser.add_argument(
+            "--planner-defaults",
+            action="store_true",
+            help=(
+                "keep sequential scans enabled in the planner. By default they are "
+                "disabled so a small seeded database still reports a missing index."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        failures = []
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not options["planner_defaults"]:
+                cursor.execute("SET LOCAL enable_seqscan = off;")
+
+            user_id = options["user_id"] or self.get_busiest_user(cursor)
+            if user_id is None:
+                raise CommandError("There are no reviews, seed the database first.")
+
+            for label, query, params in self.get_queries(
+                cursor, user_id, options["num_items"]
+            ):
+                plan = self.explain(cursor, query, params)
+                seq_scans = sorted(set(self.find_seq_scans(plan["Plan"])))
+
+                self.stdout.write(
+                    f"{label}: {plan['Execution Time']:.2f} ms, "
+                    f"shared hit {plan['Plan'].get('Shared Hit Blocks', 0)}, "
+                    f"read {plan['Plan'].get('Shared Read Blocks', 0)}"
+                )
+                if seq_scans:
+                    failures.append(f"{label}: Seq Scan on {', '.join(seq_scans)}")
+                    self.stdout.write(self.style.ERROR(f"  Seq Scan on {seq_scans}"))
+
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(
+                "Sequential scans found:\n" + "\n".join(failures),
+            )
+
+        self.stdout.write(self.style.SUCCESS("No sequential scans found."))
+
+    def get_busiest_user(self, cursor):
+        cursor.execute(
+            """
+            SELECT user_id FROM book_review
+            GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1;
+            """
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_queries(self, cursor, user_id, num_items):
+        """
+        Return (label, query, params) for every hot query. Queries that depend
+        on the result of a previous step get their params from running it.
+
+        The item similarity build reads the book_norm temporary table, it is
+        created here and dropped with the rolled back transaction.
+        """
+        genre_service = GenreBookRecommendationService
+        author_service = AuthorBookRecommendationService
+        similar_service = SimilarUserBookRecommendationService
+        item_service = ItemSimilarityBookRecommendationService
+        popular_service = PopularBookRecommendationService
+        top_n = settings.POPULAR_BOOKS_TOP_N
+        popular_params = [settings.POPULAR_BOOKS_PRIOR_COUNT, top_n, top_n, top_n]
+
+        cursor.execute(genre_service.favorite_genres_query, [user_id])
+        genres = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute(similar_service.similar_users_query, [user_id, user_id])
+        similar_user_ids = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute(POPULAR_BOOKS_QUERY, popular_params)
+        popular_book_ids = [row[0] for row in cursor.fetchall()]
+
+        create_book_norm(cursor)
+        cursor.execute(
+            "SELECT book_id FROM book_review WHERE user_id = %s LIMIT 1;", [user_id]
+        )
+        first_book_id = cursor.fetchone()[0]
+        similarity_params = [
+            first_book_id,
+            first_book_id + settings.ITEM_SIMILARITY_BATCH_SIZE,
+            settings.ITEM_SIMILARITY_MIN_SUPPORT,
+            settings.ITEM_SIMILARITY_TOP_K,
+        ]
+
+        page_query = "LIMIT %s"
+        genre = genres[0] if genres else ""
+
+        return [
+            (
+                "genre: favorite genres",
+                genre_service.favorite_genres_query,
+                [user_id],
+            ),
+            (
+                "genre: favorite genres batch",
+                genre_service.favorite_genres_batch_query,
+                [[user_id]],
+            ),
+            (
+                "author: favorite authors",
+                author_service.favorite_authors_query,
+                [user_id],
+            ),
+            (
+                "author: favorite authors batch",
+                author_service.favorite_authors_batch_query,
+                [[user_id]],
+            ),
+            (
+                "similar_user: similar users",
+                similar_service.similar_users_query,
+                [user_id, user_id],
+            ),
+            (
+                "similar_user: books",
+                similar_service.books_query,
+                [similar_user_ids, user_id, num_items],
+            ),
+            (
+                "similar_user: books batch",
+                similar_service.books_batch_query,
+                [[user_id], num_items],
+            ),
+            (
+                "item_similarity: books",
+                item_service.books_query,
+                [user_id, user_id, num_items],
+            ),
+            (
+                "item_similarity: books batch",
+                item_service.books_batch_query,
+                [[user_id], num_items],
+            ),
+            (
+                "item_similarity: build batch",
+                ITEM_SIMILARITY_BATCH_QUERY,
+                similarity_params,
+            ),
+            (
+                "popular: ranking",
+                POPULAR_BOOKS_QUERY,
+                popular_params,
+            ),
+            (
+                "popular: reviewed",
+                popular_service.reviewed_query,
+                [user_id, popular_book_ids],
+            ),
+            (
+                "popular: reviewed batch",
+                popular_service.reviewed_batch_query,
+                [[user_id], popular_book_ids],
+            ),
+            (
+                "book list page",
+                BookListView.list_query + page_query,
+                [user_id, 0, num_items + 1],
+            ),
+            (
+                "book filter page",
+                BookFilterView.filter_query + page_query,
+                [genre, 0, num_items + 1],
+            ),
+            (
+                "genre list",
+                BookGenreListView.genres_query,
+                [],
+            ),
+            (
+                "review list",
+                ReviewListView.list_query,
+                [user_id],
+            ),
+            (
+                "suggest: user review count",
+                BookSuggestView.review_count_query,
+                [user_id],
+            ),
+        ]
+
+    def explain(self, cursor, query, params):
+        cursor.execute(
+            "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query.strip().rstrip(";"),
+            params,
+        )
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]
+
+    def find_seq_scans(self, node):
+        if node["Node Type"] == "Seq Scan":
+            yield node["Relation Name"]
+        for child in node.get("Plans", []):
+            yield from self.find_seq_scans(child)
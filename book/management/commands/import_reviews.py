@@ -0,0 +1,76 @@
+import csv
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import User
+from book.ingestion import FAILED, ingest_reviews, summarize_results
+
+
+class Command(BaseCommand):
+    help = (
+        "Import the reviews of a user from a CSV file with book and rating "
+        "columns, in batches validated and written with a constant number of "
+        "queries each."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="CSV file to import, - for stdin.")
+        parser.add_argument("--user-id", type=int, required=True)
+        parser.add_argument(
+            "--update-existing",
+            action="store_true",
+            help="Replace the rating of the books the user already reviewed.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.REVIEW_BULK_MAX_ROWS,
+            help="Rows written per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        if not User.objects.filter(id=options["user_id"]).exists():
+            raise CommandError(f"There is no user with the id {options['user_id']}")
+
+        if options["file"] == "-":
+            self.import_file(sys.stdin, options)
+        else:
+            with open(options["file"], newline="") as file:
+                self.import_file(file, options)
+
+    def import_file(self, file, options):
+        reader = csv.DictReader(file)
+        if not {"book", "rating"} <= set(reader.fieldnames or ()):
+            raise CommandError("The CSV file must have book and rating columns")
+
+        totals = summarize_results([])
+        batch = []
+        line = 1
+
+        for row in reader:
+            batch.append(row)
+            if len(batch) == options["batch_size"]:
+                line = self.import_batch(batch, line, totals, options)
+                batch = []
+
+        if batch:
+            self.import_batch(batch, line, totals, options)
+
+        self.stdout.write(str(totals))
+
+    def import_batch(self, batch, line, totals, options):
+        results = ingest_reviews(
+            options["user_id"], batch, update_existing=options["update_existing"]
+        )
+
+        for result in results:
+            if result["status"] == FAILED:
+                self.stderr.write(
+                    f"line {line + 1 + result['index']}: {'; '.join(result['errors'])}"
+                )
+        for status, count in summarize_results(results).items():
+            totals[status] += count
+
+        return line + len(batch)
@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from book.services import (
+    BookRecommendationServiceFactory,
+    get_recommended_books_batch,
+)
+from book.views import BookSuggestView
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute book suggestions for many users with the batch recommendation "
+        "API and write them to stdout as one JSON object per line."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user-ids",
+            type=lambda value: [int(user_id) for user_id in value.split(",")],
+            help="comma separated user ids (default: every user with a review)",
+        )
+        parser.add_argument(
+            "--service",
+            action="append",
+            dest="services",
+            choices=BookRecommendationServiceFactory.service_types,
+            help="service to use, can be repeated (default: genre, author, similar_user)",
+        )
+        parser.add_argument("--num-items", type=int, default=10)
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        services = options["services"] or BookSuggestView.list_services
+
+        for user_ids in self.get_user_batches(options):
+            suggestions = get_recommended_books_batch(
+                services, user_ids, options["num_items"]
+            )
+            for user_id in user_ids:
+                self.stdout.write(
+                    json.dumps({"user_id": user_id, **suggestions[user_id]})
+                )
+
+    def get_user_batches(self, options):
+        batch_size = options["batch_size"]
+
+        if options["user_ids"]:
+            user_ids = list(dict.fromkeys(options["user_ids"]))
+            for start in range(0, len(user_ids), batch_size):
+                yield user_ids[start : start + batch_size]
+            return
+
+        last_user_id = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT DISTINCT user_id FROM book_review
+                    WHERE user_id > %s
+                    ORDER BY user_id
+                    LIMIT %s;
+                    """,
+                    [last_user_id, batch_size],
+                )
+                user_ids = [row[0] for row in cursor.fetchall()]
+
+            if not user_ids:
+                return
+
+            yield user_ids
+            last_user_id = user_ids[-1]
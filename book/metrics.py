@@ -0,0 +1,32 @@
+from metrics.prometheus import Counter, Histogram
+
+SERVICE_LATENCY = Histogram(
+    "book_service_latency_seconds",
+    "Latency of a recommendation service answering for one user.",
+    ["service"],
+)
+
+SERVICE_REQUESTS = Counter(
+    "book_service_requests",
+    "Recommendation service calls for one user.",
+    ["service"],
+)
+
+SERVICE_EMPTY_RESULTS = Counter(
+    "book_service_empty_results",
+    "Recommendation service calls for one user that returned no book.",
+    ["service"],
+)
+
+SUGGESTION_CACHE_LOOKUPS = Counter(
+    "book_suggestion_cache_lookups",
+    "Lookups of the cached suggestion lists (RecommendationPreference_*).",
+    ["result"],
+)
+
+WEIGHT_UPDATE_USERS = Histogram(
+    "book_weight_update_users",
+    "Users whose service weights were recomputed per update_recommendation_weights run.",
+    buckets=(0, 10, 100, 1000, 10000, 100000),
+    shared=True,
+)
@@ -0,0 +1,54 @@
+# Generated by Django 5.0.6 on 2026-10-17 06:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("book", "0003_alter_userrecommendationpreference_author_weight_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BookRatingAggregate",
+            fields=[
+                (
+                    "book",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="book.book",
+                    ),
+                ),
+                ("review_count", models.IntegerField(default=0)),
+                ("rating_sum", models.IntegerField(default=0)),
+                ("average_rating", models.FloatField(null=True)),
+                ("rating_1_count", models.IntegerField(default=0)),
+                ("rating_2_count", models.IntegerField(default=0)),
+                ("rating_3_count", models.IntegerField(default=0)),
+                ("rating_4_count", models.IntegerField(default=0)),
+                ("rating_5_count", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO book_bookratingaggregate (
+                book_id, review_count, rating_sum, average_rating,
+                rating_1_count, rating_2_count, rating_3_count,
+                rating_4_count, rating_5_count
+            )
+            SELECT book_id, COUNT(*), SUM(rating), AVG(rating),
+                COUNT(*) FILTER (WHERE rating = 1),
+                COUNT(*) FILTER (WHERE rating = 2),
+                COUNT(*) FILTER (WHERE rating = 3),
+                COUNT(*) FILTER (WHERE rating = 4),
+                COUNT(*) FILTER (WHERE rating = 5)
+            FROM book_review
+            GROUP BY book_id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.0.6 on 2026-10-17 06:44
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("book", "0004_bookratingaggregate"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="book",
+            index=models.Index(
+                fields=["genre", "title"],
+                include=("id", "author"),
+                name="book_genre_title_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="book",
+            index=models.Index(
+                fields=["author", "title"],
+                include=("id", "genre"),
+                name="book_author_title_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="review",
+            index=models.Index(
+                fields=["user", "book", "rating"], name="review_user_book_rating_idx"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="review",
+            index=models.Index(
+                fields=["book", "rating", "user"], name="review_book_rating_user_idx"
+            ),
+        ),
+    ]
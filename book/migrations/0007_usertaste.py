@@ -0,0 +1,92 @@
+# Generated by Django 5.0.6 on 2026-10-17 07:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("book", "0006_booksimilarity"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserAuthorTaste",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("author", models.CharField(max_length=200)),
+                ("rating_sum", models.IntegerField(default=0)),
+                ("review_count", models.IntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "author")},
+            },
+        ),
+        migrations.CreateModel(
+            name="UserGenreTaste",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("genre", models.CharField(max_length=50)),
+                ("rating_sum", models.IntegerField(default=0)),
+                ("review_count", models.IntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "genre")},
+            },
+        ),
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO book_userauthortaste (user_id, author, rating_sum, review_count)
+            SELECT r.user_id, b.author, SUM(r.rating), COUNT(*)
+            FROM book_review r
+            JOIN book_book b ON b.id = r.book_id
+            GROUP BY r.user_id, b.author;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            sql="""
+            INSERT INTO book_usergenretaste (user_id, genre, rating_sum, review_count)
+            SELECT r.user_id, b.genre, SUM(r.rating), COUNT(*)
+            FROM book_review r
+            JOIN book_book b ON b.id = r.book_id
+            GROUP BY r.user_id, b.genre;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-17 09:12
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("book", "0007_usertaste"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="bookratingaggregate",
+            index=models.Index(
+                condition=models.Q(("review_count__gt", 0)),
+                fields=["book"],
+                include=("rating_sum", "review_count"),
+                name="bookrating_reviewed_idx",
+            ),
+        ),
+    ]
@@ -9,6 +9,18 @@ class Book(models.Model):
 
     class Meta:
         unique_together = ("title", "author", "genre")
+        indexes = [
+            models.Index(
+                fields=["genre", "title"],
+                include=["id", "author"],
+                name="book_genre_title_idx",
+            ),
+            models.Index(
+                fields=["author", "title"],
+                include=["id", "genre"],
+                name="book_author_title_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title} by {self.author}"
@@ -21,6 +33,16 @@ class Review(models.Model):
 
     class Meta:
         unique_together = ("book_id", "user_id")
+        indexes = [
+            models.Index(
+                fields=["user", "book", "rating"],
+                name="review_user_book_rating_idx",
+            ),
+            models.Index(
+                fields=["book", "rating", "user"],
+                name="review_book_rating_user_idx",
+            ),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=models.Q(rating__gte=1) & models.Q(rating__lte=5),
@@ -40,3 +62,82 @@ class UserRecommendationPreference(models.Model):
 
     def __str__(self):
         return f"Preferences for {self.user.user_name}"
+
+
+class BookRatingAggregate(models.Model):
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True)
+    review_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    average_rating = models.FloatField(null=True)
+    rating_1_count = models.IntegerField(default=0)
+    rating_2_count = models.IntegerField(default=0)
+    rating_3_count = models.IntegerField(default=0)
+    rating_4_count = models.IntegerField(default=0)
+    rating_5_count = models.IntegerField(default=0)
+
+    class Meta:
+        # the popular ranking reads the reviewed books only, index-only
+        indexes = [
+            models.Index(
+                fields=["book"],
+                include=["rating_sum", "review_count"],
+                condition=models.Q(review_count__gt=0),
+                name="bookrating_reviewed_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Ratings of {self.book_id}: {self.average_rating} ({self.review_count})"
+
+
+class UserGenreTaste(models.Model):
+    # the (user, genre) unique index serves the lookups by user
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False
+    )
+    genre = models.CharField(max_length=50)
+    rating_sum = models.IntegerField(default=0)
+    review_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "genre")
+
+    def __str__(self):
+        return f"{self.genre} for {self.user_id}: {self.rating_sum}/{self.review_count}"
+
+
+class UserAuthorTaste(models.Model):
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False
+    )
+    author = models.CharField(max_length=200)
+    rating_sum = models.IntegerField(default=0)
+    review_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "author")
+
+    def __str__(self):
+        return (
+            f"{self.author} for {self.user_id}: {self.rating_sum}/{self.review_count}"
+        )
+
+
+class BookSimilarity(models.Model):
+    book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name="+", db_index=False
+    )
+    neighbor = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["book", "-score"],
+                include=["neighbor"],
+                name="booksimilarity_book_score_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id} ~ {self.neighbor_id}: {self.score}"
@@ -0,0 +1,81 @@
+import json
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+
+STREAM_VALUES = ("1", "true", "ndjson")
+
+
+def get_page_params(request):
+    """
+    Read the keyset pagination parameters of a list request.
+
+    •  after: the last id of the previous page (default 0)
+
+    •  page_size: the number of rows of the page (default BOOK_PAGE_SIZE)
+
+    Returns:
+    •  tuple: (after, page_size)
+    """
+    after = _get_int_param(request, "after", 0, min_value=0)
+    page_size = _get_int_param(
+        request, "page_size", settings.BOOK_PAGE_SIZE, min_value=1
+    )
+    return after, min(page_size, settings.BOOK_MAX_PAGE_SIZE)
+
+
+def is_stream_request(request):
+    return request.query_params.get("stream", "").lower() in STREAM_VALUES
+
+
+def paginate_rows(rows, page_size, format_row):
+    """
+    Build the page body from rows fetched with LIMIT page_size + 1,
+    the extra row only tells us there is a next page.
+    """
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+
+    return {
+        "results": [format_row(row) for row in rows],
+        "next_cursor": rows[-1][0] if has_next else None,
+    }
+
+
+def stream_rows(query, params, format_row, using=DEFAULT_DB_ALIAS):
+    """
+    Stream the rows of the query as NDJSON, pulling them from a server-side
+    cursor of the database using in chunks of BOOK_STREAM_CHUNK_SIZE so memory
+    stays flat whatever the size of the result is.
+    """
+    chunk_size = settings.BOOK_STREAM_CHUNK_SIZE
+    connection = connections[using]
+
+    def generate():
+        with transaction.atomic(using=using), connection.chunked_cursor() as cursor:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield "".join(json.dumps(format_row(row)) + "\n" for row in rows)
+
+    return StreamingHttpResponse(generate(), content_type="application/x-ndjson")
+
+
+def _get_int_param(request, name, default, min_value):
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValidationError({name: "A valid integer is required."})
+
+    if value < min_value:
+        raise ValidationError({name: f"Ensure this value is at least {min_value}."})
+
+    return value
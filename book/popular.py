@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.db import connection
+from django_redis import get_redis_connection
+
+from .hydration import hydrate_books
+
+# sorted sets of the top books scored by Bayesian average rating, one for the
+# whole catalog and one per genre, and the set of the genres that have one
+POPULAR_BOOKS_KEY = "PopularBooks"
+POPULAR_GENRES_KEY = "PopularBooksGenres"
+
+# the books in the global or a genre top n by Bayesian average rating, params:
+# prior count (None for the mean review count), top n, top n, top n
+POPULAR_BOOKS_QUERY = """
+    WITH prior AS (
+        SELECT SUM(rating_sum)::float / SUM(review_count) AS mean_rating,
+            COALESCE(%s, AVG(review_count)) AS prior_count
+        FROM book_bookratingaggregate
+        WHERE review_count > 0
+    ),
+    ranked AS (
+        SELECT b.id, b.genre,
+            (p.prior_count * p.mean_rating + agg.rating_sum)
+                / (p.prior_count + agg.review_count) AS score
+        FROM book_bookratingaggregate agg
+        JOIN book_book b ON b.id = agg.book_id
+        CROSS JOIN prior p
+        WHERE agg.review_count > 0
+    ),
+    numbered AS (
+        SELECT id, genre, score,
+            ROW_NUMBER() OVER (ORDER BY score DESC, id) AS global_rank,
+            ROW_NUMBER() OVER (
+                PARTITION BY genre ORDER BY score DESC, id
+            ) AS genre_rank
+        FROM ranked
+    )
+    SELECT id, genre, score, global_rank <= %s
+    FROM numbered
+    WHERE global_rank <= %s OR genre_rank <= %s;
+    """
+
+
+def get_popular_books_key(genre=None):
+    if genre is None:
+        return POPULAR_BOOKS_KEY
+    return f"{POPULAR_BOOKS_KEY}_{genre}"
+
+
+def get_popular_book_ids(num_items, genre=None):
+    """The ids of the num_items most popular books, of a genre if given."""
+    if num_items <= 0:
+        return []
+    book_ids = get_redis_connection("default").zrevrange(
+        get_popular_books_key(genre), 0, num_items - 1
+    )
+    return [int(book_id) for book_id in book_ids]
+
+
+def get_popular_books(num_items, genre=None):
+    return hydrate_books(get_popular_book_ids(num_items, genre))
+
+
+def refresh_popular_books():
+    """
+    Rank the reviewed books by their Bayesian average rating
+
+        (prior_count * mean_rating + rating_sum) / (prior_count + review_count)
+
+    so a book with a few high ratings does not outrank a book with many good
+    ones, and replace the global and per genre top POPULAR_BOOKS_TOP_N sorted
+    sets in one MULTI, readers see either the old or the new lists.
+
+    prior_count is POPULAR_BOOKS_PRIOR_COUNT, the mean number of reviews of
+    a reviewed book if it is not set.
+
+    Returns:
+    •  int: the number of books ranked.
+    """
+    top_n = settings.POPULAR_BOOKS_TOP_N
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            POPULAR_BOOKS_QUERY,
+            [settings.POPULAR_BOOKS_PRIOR_COUNT, top_n, top_n, top_n],
+        )
+        rows = cursor.fetchall()
+
+    global_scores = {}
+    genre_scores = {}
+    for book_id, genre, score, in_global in rows:
+        if in_global:
+            global_scores[book_id] = score
+        genre_scores.setdefault(genre, {})[book_id] = score
+
+    redis = get_redis_connection("default")
+    old_genres = {genre.decode() for genre in redis.smembers(POPULAR_GENRES_KEY)}
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.delete(
+        POPULAR_BOOKS_KEY,
+        POPULAR_GENRES_KEY,
+        *[get_popular_books_key(genre) for genre in old_genres - set(genre_scores)],
+    )
+    if global_scores:
+        pipe.zadd(POPULAR_BOOKS_KEY, global_scores)
+    for genre, scores in genre_scores.items():
+        pipe.delete(get_popular_books_key(genre))
+        pipe.zadd(get_popular_books_key(genre), scores)
+    if genre_scores:
+        pipe.sadd(POPULAR_GENRES_KEY, *genre_scores)
+    pipe.execute()
+
+    return len(rows)
@@ -0,0 +1,110 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+# apps whose models are read from the replica by the ORM
+REPLICA_APP_LABELS = {"book"}
+
+_pinned = threading.local()
+
+
+def get_read_your_writes_key(user_id):
+    return f"ReadPrimary_{user_id}"
+
+
+def uses_replica():
+    return settings.DB_READ_ALIAS != DEFAULT_DB_ALIAS
+
+
+def in_primary_transaction():
+    # reads inside a write transaction must see its uncommitted rows
+    return connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+def get_read_alias(*user_ids):
+    """
+    The database alias the read-only queries about user_ids go to.
+
+    •  DB_READ_ALIAS (the replica) by default.
+
+    •  The primary inside a transaction of the primary, or if one of the users
+       wrote a review less than DB_READ_YOUR_WRITES_TIMEOUT seconds ago, so
+       they read their own writes whatever the replication lag is.
+
+    •  The alias of an enclosing use_read_alias() block of the thread.
+    """
+    pinned_alias = getattr(_pinned, "alias", None)
+    if pinned_alias is not None:
+        return pinned_alias
+
+    if not uses_replica() or in_primary_transaction():
+        return DEFAULT_DB_ALIAS
+
+    if user_ids and cache.get_many(
+        [get_read_your_writes_key(user_id) for user_id in user_ids]
+    ):
+        return DEFAULT_DB_ALIAS
+
+    return settings.DB_READ_ALIAS
+
+
+def get_read_connection(*user_ids):
+    """The connection of get_read_alias(*user_ids)."""
+    return connections[get_read_alias(*user_ids)]
+
+
+@contextmanager
+def use_read_alias(alias):
+    """
+    Send the reads of the current thread to alias while the block runs, so
+    the queries of a job go to the connection it was set up on.
+    """
+    previous_alias = getattr(_pinned, "alias", None)
+    _pinned.alias = alias
+    try:
+        yield connections[alias]
+    finally:
+        _pinned.alias = previous_alias
+
+
+def pin_to_primary(user_id):
+    """
+    Send the reads of the user to the primary for DB_READ_YOUR_WRITES_TIMEOUT
+    seconds, the time the replica is given to catch up with the write.
+    """
+    if not uses_replica():
+        return
+
+    transaction.on_commit(
+        lambda: cache.set(
+            get_read_your_writes_key(user_id),
+            1,
+            settings.DB_READ_YOUR_WRITES_TIMEOUT,
+        ),
+        robust=True,
+    )
+
+
+class ReplicaRouter:
+    """
+    Read the models of REPLICA_APP_LABELS from DB_READ_ALIAS, outside the
+    transactions of the primary, and write everything to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in REPLICA_APP_LABELS:
+            return get_read_alias()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
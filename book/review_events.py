@@ -0,0 +1,18 @@
+from django.db import transaction
+
+from .replicas import pin_to_primary
+from .suggestions import mark_users_dirty
+from .tasks import refresh_user_suggestions
+
+
+def review_written(user_id):
+    """
+    Schedule the side effects of a review add / update / delete of a user,
+    they run only once the transaction of the write is committed.
+    """
+    pin_to_primary(user_id)
+    transaction.on_commit(lambda: mark_users_dirty([user_id]), robust=True)
+    transaction.on_commit(
+        lambda: refresh_user_suggestions.delay(user_id),
+        robust=True,
+    )
@@ -0,0 +1,380 @@
+import json
+import logging
+import os
+import socket
+import uuid
+
+from django.conf import settings
+from django.db import connection, transaction
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+from .aggregates import apply_rating_deltas
+from .review_events import review_written
+from .serializers import REVIEW_BOOK_NOT_FOUND_ERROR, REVIEW_EXISTS_ERROR
+
+logger = logging.getLogger(__name__)
+
+# stream of the accepted review writes and consumer group of the flush task
+REVIEW_WRITES_STREAM = "ReviewWrites"
+REVIEW_WRITES_GROUP = "review-writers"
+
+# writes that failed REVIEW_WRITE_MAX_DELIVERIES times and then alone, kept
+# with their error for inspection
+REVIEW_WRITES_DEAD_LETTER_STREAM = "ReviewWritesDeadLetter"
+
+ADD = "add"
+UPDATE = "update"
+
+PENDING = "pending"
+CREATED = "created"
+UPDATED = "updated"
+FAILED = "failed"
+
+
+def get_write_status_key(write_id):
+    return f"ReviewWriteStatus_{write_id}"
+
+
+# ----------------------------------------------------------------
+# -------------------     REQUEST SIDE         -------------------
+# ----------------------------------------------------------------
+
+
+def enqueue_review_write(operation, user_id, **fields):
+    """
+    Append a validated review add / update to the stream and mark it pending.
+
+    Returns:
+    •  str: the id of the write, to poll its status with.
+    """
+    write_id = uuid.uuid4().hex
+    message = {"write_id": write_id, "operation": operation, "user_id": user_id}
+    message.update(fields)
+
+    pipe = get_redis_connection("default").pipeline()
+    pipe.set(
+        get_write_status_key(write_id),
+        json.dumps({"status": PENDING, "user_id": user_id}),
+        ex=settings.REVIEW_WRITE_STATUS_TIMEOUT,
+    )
+    pipe.xadd(REVIEW_WRITES_STREAM, {"data": json.dumps(message)})
+    pipe.execute()
+
+    return write_id
+
+
+def get_write_status(write_id):
+    status = get_redis_connection("default").get(get_write_status_key(write_id))
+    if status is None:
+        return None
+    return json.loads(status)
+
+
+# ----------------------------------------------------------------
+# -------------------     CONSUMER SIDE         ------------------
+# ----------------------------------------------------------------
+
+
+def flush_review_writes():
+    """
+    Drain the stream in micro-batches of REVIEW_WRITE_BEHIND_BATCH_SIZE writes,
+    each flushed in one transaction and acknowledged once committed.
+
+    Writes a consumer took but never acknowledged (it died mid batch or the
+    batch failed) are claimed back after REVIEW_WRITE_CLAIM_IDLE seconds. A
+    batch failing for the REVIEW_WRITE_MAX_DELIVERIES time is flushed write
+    by write, the writes still failing go to the dead letter stream.
+
+    A claimed back batch may have been committed by a consumer that died
+    before acknowledging it, its adds finding the review they would write
+    are reported created, see flush_review_batch.
+
+    Returns:
+    •  int: the number of writes flushed.
+    """
+    redis = get_redis_connection("default")
+    batch_size = settings.REVIEW_WRITE_BEHIND_BATCH_SIZE
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+    _create_group(redis)
+
+    _, entries, _ = redis.xautoclaim(
+        REVIEW_WRITES_STREAM,
+        REVIEW_WRITES_GROUP,
+        consumer,
+        min_idle_time=settings.REVIEW_WRITE_CLAIM_IDLE * 1000,
+        count=batch_size,
+    )
+
+    redelivered = True
+    flushed = 0
+    while True:
+        if not entries:
+            redelivered = False
+            response = redis.xreadgroup(
+                REVIEW_WRITES_GROUP,
+                consumer,
+                {REVIEW_WRITES_STREAM: ">"},
+                count=batch_size,
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                return flushed
+
+        try:
+            _flush_entries(redis, entries, redelivered)
+        except Exception:
+            logger.exception("flushing %s review writes failed", len(entries))
+            deliveries = _get_max_deliveries(redis, entries)
+            if deliveries < settings.REVIEW_WRITE_MAX_DELIVERIES:
+                # left unacknowledged, the batch is claimed back and retried
+                raise
+            _flush_entries_one_by_one(redis, entries, redelivered or deliveries > 1)
+
+        flushed += len(entries)
+        entries = []
+
+
+def _create_group(redis):
+    # looked up first, an XGROUP CREATE per run would answer BUSYGROUP errors
+    # once the group exists
+    if redis.exists(REVIEW_WRITES_STREAM):
+        groups = redis.xinfo_groups(REVIEW_WRITES_STREAM)
+        if any(group["name"] == REVIEW_WRITES_GROUP.encode() for group in groups):
+            return
+
+    try:
+        redis.xgroup_create(
+            REVIEW_WRITES_STREAM, REVIEW_WRITES_GROUP, id="0", mkstream=True
+        )
+    except ResponseError as e:
+        # created by a concurrent consumer
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _flush_entries(redis, entries, redelivered=False):
+    writes = [json.loads(fields[b"data"]) for _, fields in entries]
+    statuses = flush_review_batch(writes, redelivered)
+    _acknowledge(redis, entries, writes, statuses)
+
+
+def _flush_entries_one_by_one(redis, entries, redelivered=False):
+    """
+    Flush the writes of a batch that keeps failing alone, so one bad write
+    does not hold back the others, and move those that still fail to the
+    dead letter stream with a failed status.
+    """
+    for entry in entries:
+        try:
+            _flush_entries(redis, [entry], redelivered)
+        except Exception as e:
+            logger.exception(
+                "review write %s moved to the dead letter stream", entry[0]
+            )
+            _dead_letter(redis, entry, e)
+
+
+def _dead_letter(redis, entry, error):
+    entry_id, fields = entry
+
+    pipe = redis.pipeline()
+    pipe.xadd(
+        REVIEW_WRITES_DEAD_LETTER_STREAM,
+        {"entry_id": entry_id, "data": fields[b"data"], "error": repr(error)},
+    )
+    try:
+        write = json.loads(fields[b"data"])
+        status = _failed(500, {"message": "The review could not be written"})
+        status["user_id"] = write["user_id"]
+        pipe.set(
+            get_write_status_key(write["write_id"]),
+            json.dumps(status),
+            ex=settings.REVIEW_WRITE_STATUS_TIMEOUT,
+        )
+    except (ValueError, KeyError, TypeError):
+        # not even a write, nobody polls its status
+        pass
+    pipe.xack(REVIEW_WRITES_STREAM, REVIEW_WRITES_GROUP, entry_id)
+    pipe.xdel(REVIEW_WRITES_STREAM, entry_id)
+    pipe.execute()
+
+
+def _acknowledge(redis, entries, writes, statuses):
+    entry_ids = [entry_id for entry_id, _ in entries]
+
+    pipe = redis.pipeline()
+    for write, status in zip(writes, statuses):
+        status["user_id"] = write["user_id"]
+        pipe.set(
+            get_write_status_key(write["write_id"]),
+            json.dumps(status),
+            ex=settings.REVIEW_WRITE_STATUS_TIMEOUT,
+        )
+    pipe.xack(REVIEW_WRITES_STREAM, REVIEW_WRITES_GROUP, *entry_ids)
+    pipe.xdel(REVIEW_WRITES_STREAM, *entry_ids)
+    pipe.execute()
+
+
+def _get_max_deliveries(redis, entries):
+    """The most times a write of entries was delivered, from XPENDING."""
+    pending = redis.xpending_range(
+        REVIEW_WRITES_STREAM,
+        REVIEW_WRITES_GROUP,
+        min=entries[0][0],
+        max=entries[-1][0],
+        count=len(entries),
+    )
+    return max((message["times_delivered"] for message in pending), default=0)
+
+
+def flush_review_batch(writes, redelivered=False):
+    """
+    Apply a batch of writes in one transaction: one multi-row INSERT for the
+    adds, one multi-row UPDATE for the updates and one upsert of the rating
+    aggregates and of the taste profiles.
+
+    A redelivered batch may already be committed: an add finding a review of
+    the same user, book and rating is reported created with no new rating,
+    the updates set the rating they already set.
+
+    Returns:
+    •  list: the status of every write, in the same order.
+    """
+    statuses = [None] * len(writes)
+    adds = [(i, w) for i, w in enumerate(writes) if w["operation"] == ADD]
+    updates = [(i, w) for i, w in enumerate(writes) if w["operation"] == UPDATE]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        changes = []
+        changes += _flush_adds(cursor, adds, statuses, redelivered)
+        changes += _flush_updates(cursor, updates, statuses)
+
+        apply_rating_deltas(cursor, changes)
+
+        written_user_ids = {
+            write["user_id"]
+            for write, status in zip(writes, statuses)
+            if status["status"] != FAILED
+        }
+        for user_id in written_user_ids:
+            review_written(user_id)
+
+    return statuses
+
+
+def _flush_adds(cursor, adds, statuses, redelivered=False):
+    # the first add of a (user, book) pair wins, like it would one by one
+    unique = {}
+    for position, write in adds:
+        key = (write["user_id"], write["book_id"])
+        if key in unique:
+            statuses[position] = _failed(
+                400, {"non_field_errors": [REVIEW_EXISTS_ERROR]}
+            )
+        else:
+            unique[key] = (position, write["rating"])
+
+    if not unique:
+        return []
+
+    cursor.execute(
+        """
+        WITH input (user_id, book_id, rating) AS (
+            SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::int[])
+        ),
+        inserted AS (
+            INSERT INTO book_review (user_id, book_id, rating)
+            SELECT i.user_id, i.book_id, i.rating
+            FROM input i
+            JOIN book_book b ON b.id = i.book_id
+            ON CONFLICT (book_id, user_id) DO NOTHING
+            RETURNING id, user_id, book_id
+        )
+        SELECT i.user_id, i.book_id, ins.id,
+            EXISTS (SELECT 1 FROM book_book b WHERE b.id = i.book_id),
+            r.id, r.rating
+        FROM input i
+        LEFT JOIN inserted ins ON ins.user_id = i.user_id AND ins.book_id = i.book_id
+        LEFT JOIN book_review r ON r.user_id = i.user_id AND r.book_id = i.book_id;
+        """,
+        [
+            [user_id for user_id, _ in unique],
+            [book_id for _, book_id in unique],
+            [rating for _, rating in unique.values()],
+        ],
+    )
+
+    changes = []
+    rows = cursor.fetchall()
+    for user_id, book_id, review_id, book_exists, existing_id, existing in rows:
+        position, rating = unique[(user_id, book_id)]
+
+        if not book_exists:
+            statuses[position] = _failed(
+                400, {"book": [REVIEW_BOOK_NOT_FOUND_ERROR.format(book_id)]}
+            )
+        elif review_id is None and redelivered and existing == rating:
+            # written by the delivery that was never acknowledged
+            statuses[position] = {"status": CREATED, "review_id": existing_id}
+        elif review_id is None:
+            statuses[position] = _failed(
+                400, {"non_field_errors": [REVIEW_EXISTS_ERROR]}
+            )
+        else:
+            statuses[position] = {"status": CREATED, "review_id": review_id}
+            changes.append((user_id, book_id, rating, 1))
+
+    return changes
+
+
+def _flush_updates(cursor, updates, statuses):
+    if not updates:
+        return []
+
+    review_ids = list({write["review_id"] for _, write in updates})
+    cursor.execute(
+        "SELECT id, user_id, book_id, rating FROM book_review WHERE id = ANY(%s) FOR UPDATE;",
+        [review_ids],
+    )
+    reviews = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    # the last update of a review wins, like it would one by one, the ratings
+    # were validated by the view
+    latest = {}
+    for position, write in updates:
+        review = reviews.get(write["review_id"])
+        if review is None:
+            statuses[position] = _failed(404, {"message": "Review not found"})
+        elif review[0] != write["user_id"]:
+            statuses[position] = _failed(
+                403, {"message": "You do not have access to change this review"}
+            )
+        else:
+            statuses[position] = {"status": UPDATED, "review_id": write["review_id"]}
+            latest[write["review_id"]] = write["rating"]
+
+    if not latest:
+        return []
+
+    cursor.execute(
+        """
+        UPDATE book_review r
+        SET rating = i.rating
+        FROM unnest(%s::bigint[], %s::int[]) AS i(id, rating)
+        WHERE r.id = i.id;
+        """,
+        [list(latest), list(latest.values())],
+    )
+
+    changes = []
+    for review_id, rating in latest.items():
+        user_id, book_id, old_rating = reviews[review_id]
+        changes.append((user_id, book_id, old_rating, -1))
+        changes.append((user_id, book_id, rating, 1))
+    return changes
+
+
+def _failed(http_status, errors):
+    return {"status": FAILED, "http_status": http_status, "errors": errors}
@@ -1,8 +1,9 @@
 # book/serializers.py
-from django.db import connection
+from django.conf import settings
 from rest_framework import serializers
 
 from .models import Book, Review
+from .services import BookRecommendationServiceFactory
 
 
 class BookSerializer(serializers.ModelSerializer):
@@ -11,48 +12,25 @@ class BookSerializer(serializers.ModelSerializer):
         fields = ["id", "title", "author", "genre", "publish_date"]
 
 
-class ReviewAddSerializer(serializers.ModelSerializer):
+REVIEW_BOOK_NOT_FOUND_ERROR = 'Invalid pk "{}" - object does not exist.'
+REVIEW_EXISTS_ERROR = "User has already reviewed this book"
+REVIEW_RATING_ERROR = "Rating must be between 1 and 5"
 
-    user = serializers.IntegerField(write_only=True)
-
-    class Meta:
-        model = Review
-        fields = ["id", "book", "rating", "user"]
 
-    def validate_book(self, value):
-        book_id = int(value.id)
+class ReviewAddSerializer(serializers.Serializer):
 
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT COUNT(*) FROM book_book WHERE id = %s;", [book_id])
-            count = cursor.fetchone()[0]
-
-        if count == 0:
-            raise serializers.ValidationError("There are no books with this id")
-
-        return value
+    # the book and the uniqueness of the review are not checked here but by
+    # the insert itself, see ReviewAddView.insert_query
+    id = serializers.IntegerField(read_only=True)
+    book = serializers.IntegerField(min_value=1)
+    rating = serializers.IntegerField()
+    user = serializers.IntegerField(write_only=True)
 
     def validate_rating(self, value):
         if value < 1 or value > 5:
-            raise serializers.ValidationError("Rating must be between 1 and 5")
+            raise serializers.ValidationError(REVIEW_RATING_ERROR)
         return value
 
-    def validate(self, data):
-
-        user_id = data.get("user")
-        book_id = data.get("book").id
-
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "SELECT COUNT(*) FROM book_review WHERE (book_id = %s AND user_id = %s);",
-                [book_id, user_id],
-            )
-            count = cursor.fetchone()[0]
-
-        if count > 0:
-            raise serializers.ValidationError("User has already reviewed this book")
-
-        return data
-
 
 class ReviewUpdateSerializer(serializers.ModelSerializer):
 
@@ -64,5 +42,33 @@ class ReviewUpdateSerializer(serializers.ModelSerializer):
 
     def validate_rating(self, value):
         if value < 1 or value > 5:
-            raise serializers.ValidationError("Rating must be between 1 and 5")
+            raise serializers.ValidationError(REVIEW_RATING_ERROR)
         return value
+
+
+class BookSuggestBatchSerializer(serializers.Serializer):
+
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BOOK_SUGGEST_BATCH_MAX_USERS,
+    )
+    services = serializers.ListField(
+        child=serializers.ChoiceField(
+            choices=BookRecommendationServiceFactory.service_types
+        ),
+        required=False,
+    )
+    num_items = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+
+class ReviewBulkAddSerializer(serializers.Serializer):
+
+    # the rows themselves are validated one by one by ingest_reviews, so a
+    # bad row fails alone instead of failing the whole batch
+    reviews = serializers.ListField(
+        child=serializers.JSONField(),
+        allow_empty=False,
+        max_length=settings.REVIEW_BULK_MAX_ROWS,
+    )
+    update_existing = serializers.BooleanField(default=False)
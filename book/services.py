@@ -1,6 +1,11 @@
 from abc import ABC, abstractmethod
 
-from django.db import connection
+from django.conf import settings
+
+from .hydration import get_books, hydrate_books
+from .leaderboards import get_leaderboard_book_ids, get_top_book_ids
+from .popular import get_popular_book_ids
+from .replicas import get_read_connection
 
 
 class BookRecommendationService(ABC):
@@ -8,11 +13,40 @@ class BookRecommendationService(ABC):
     def get_recommended_books(self, user_id, num_items):
         pass
 
+    @abstractmethod
+    def get_recommended_books_batch(self, user_ids, num_items):
+        """
+        Return {user_id: books} for every user of user_ids, using a constant
+        number of queries whatever the number of users is.
+        """
+        pass
+
+    def format_books_batch(self, user_ids, rows):
+        """
+        Group (user_id, book_id) rows by user, the books of every user are
+        hydrated with one metadata lookup.
+        """
+        books = get_books([row[1] for row in rows])
+        books_by_user = {user_id: [] for user_id in user_ids}
+        for user_id, book_id in rows:
+            if book_id in books:
+                books_by_user[user_id].append(books[book_id])
+        return books_by_user
+
 
 class BookRecommendationServiceFactory:
+    service_types = ["genre", "author", "similar_user", "item_similarity", "popular"]
+    engine_services = ["genre", "author", "similar_user"]
+
     @staticmethod
     def create_service(service_type):
 
+        if (
+            settings.BOOK_RECOMMENDATION_BACKEND == "engine"
+            and service_type in BookRecommendationServiceFactory.engine_services
+        ):
+            return EngineBookRecommendationService(service_type)
+
         if service_type == "genre":
             return GenreBookRecommendationService()
 
@@ -22,164 +56,391 @@ class BookRecommendationServiceFactory:
         elif service_type == "similar_user":
             return SimilarUserBookRecommendationService()
 
+        elif service_type == "item_similarity":
+            return ItemSimilarityBookRecommendationService()
+
+        elif service_type == "popular":
+            return PopularBookRecommendationService()
+
         raise ValueError(f"Unknown service type: {service_type}")
 
 
 class GenreBookRecommendationService(BookRecommendationService):
+    """
+    Answers from the genre leaderboards of book/leaderboards.py: the best
+    rated books of the favorite genres of the user, the genres ranked by
+    the average rating the user gave them, read from the taste profile the
+    review writes keep up to date.
+    """
+
+    favorite_genres_query = """
+        SELECT genre, rating_sum::float / review_count as avg_rating
+        FROM book_usergenretaste
+        WHERE user_id = %s AND review_count > 0
+        ORDER BY avg_rating DESC, genre;
+        """
+
+    favorite_genres_batch_query = """
+        SELECT user_id, genre, rating_sum::float / review_count as avg_rating
+        FROM book_usergenretaste
+        WHERE user_id = ANY(%s) AND review_count > 0
+        ORDER BY user_id, avg_rating DESC, genre;
+        """
 
     def get_recommended_books(self, user_id, num_items):
+        connection = get_read_connection(user_id)
         # Step 1: Fetch the favorite genres ranked by their average rating
         with connection.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT book_book.genre, AVG(book_review.rating) as avg_rating
-                FROM book_review
-                JOIN book_book ON book_review.book_id = book_book.id
-                WHERE book_review.user_id = %s
-                GROUP BY book_book.genre
-                ORDER BY avg_rating DESC;
-                """,
-                [user_id],
-            )
+            cursor.execute(self.favorite_genres_query, [user_id])
             genres = cursor.fetchall()
 
         if not genres:
             return []
 
-        # Prepare to collect books from the favorite genres
-        genre_list = [genre[0] for genre in genres]
-        genre_placeholders = ", ".join(["%s"] * len(genre_list))
+        # Step 2: Take the best rated books of the ranked genres from Redis
+        book_ids = get_top_book_ids("genre", [genre[0] for genre in genres], num_items)
+
+        # Hydrate the book ids with their title, author and genre
+        return hydrate_books(book_ids)
 
-        # Step 2: Fetch books from the favorite genres ordered by the ranked genres
+    def get_recommended_books_batch(self, user_ids, num_items):
+        connection = get_read_connection(*user_ids)
         with connection.cursor() as cursor:
-            cursor.execute(
-                f"""
-                SELECT book_book.*
-                FROM book_book
-                JOIN (
-                    SELECT genre, AVG(rating) as avg_rating
-                    FROM book_review
-                    JOIN book_book ON book_review.book_id = book_book.id
-                    WHERE book_review.user_id = %s
-                    GROUP BY genre
-                ) as ranked_genres
-                ON book_book.genre = ranked_genres.genre
-                WHERE book_book.genre IN ({genre_placeholders})
-                ORDER BY ranked_genres.avg_rating DESC, book_book.genre, book_book.title
-                LIMIT %s;
-                """,
-                (user_id, *genre_list, num_items),
-            )
-            books = cursor.fetchall()
+            cursor.execute(self.favorite_genres_batch_query, [user_ids])
+            ranked_genres = cursor.fetchall()
+
+        # one ZREVRANGE per genre shared by all the users
+        boards = get_leaderboard_book_ids(
+            "genre", [row[1] for row in ranked_genres], num_items
+        )
 
-        # Format the books data
-        return [
-            {"id": row[0], "title": row[1], "author": row[2], "genre": row[3]}
-            for row in books
+        book_ids = {user_id: [] for user_id in user_ids}
+        for user_id, genre, _ in ranked_genres:
+            book_ids[user_id].extend(boards[genre])
+
+        rows = [
+            (user_id, book_id)
+            for user_id in user_ids
+            for book_id in book_ids[user_id][:num_items]
         ]
+        return self.format_books_batch(user_ids, rows)
 
 
 class AuthorBookRecommendationService(BookRecommendationService):
+    """
+    Answers from the author leaderboards of book/leaderboards.py: the best
+    rated books of the favorite authors of the user, the authors ranked by
+    the average rating the user gave them, read from the taste profile the
+    review writes keep up to date.
+    """
+
+    favorite_authors_query = """
+        SELECT author, rating_sum::float / review_count as avg_rating
+        FROM book_userauthortaste
+        WHERE user_id = %s AND review_count > 0
+        ORDER BY avg_rating DESC, author;
+        """
+
+    favorite_authors_batch_query = """
+        SELECT user_id, author, rating_sum::float / review_count as avg_rating
+        FROM book_userauthortaste
+        WHERE user_id = ANY(%s) AND review_count > 0
+        ORDER BY user_id, avg_rating DESC, author;
+        """
 
     def get_recommended_books(self, user_id, num_items):
+        connection = get_read_connection(user_id)
         # Step 1: Fetch the favorite authors ranked by their average rating
         with connection.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT book_book.author, AVG(book_review.rating) as avg_rating
-                FROM book_review
-                JOIN book_book ON book_review.book_id = book_book.id
-                WHERE book_review.user_id = %s
-                GROUP BY book_book.author
-                ORDER BY avg_rating DESC;
-                """,
-                [user_id],
-            )
+            cursor.execute(self.favorite_authors_query, [user_id])
             authors = cursor.fetchall()
 
         if not authors:
             return []
 
-        # Prepare to collect books from the favorite authors
-        author_list = [author[0] for author in authors]
-        author_placeholders = ", ".join(["%s"] * len(author_list))
+        # Step 2: Take the best rated books of the ranked authors from Redis
+        book_ids = get_top_book_ids(
+            "author", [author[0] for author in authors], num_items
+        )
+
+        # Hydrate the book ids with their title, author and genre
+        return hydrate_books(book_ids)
 
-        # Step 2: Fetch books from the favorite authors ordered by the ranked authors
+    def get_recommended_books_batch(self, user_ids, num_items):
+        connection = get_read_connection(*user_ids)
         with connection.cursor() as cursor:
-            cursor.execute(
-                f"""
-                SELECT book_book.*
-                FROM book_book
-                JOIN (
-                    SELECT author, AVG(rating) as avg_rating
-                    FROM book_review
-                    JOIN book_book ON book_review.book_id = book_book.id
-                    WHERE book_review.user_id = %s
-                    GROUP BY author
-                ) as ranked_authors
-                ON book_book.author = ranked_authors.author
-                WHERE book_book.author IN ({author_placeholders})
-                ORDER BY ranked_authors.avg_rating DESC, book_book.author, book_book.title
-                LIMIT %s;
-                """,
-                (user_id, *author_list, num_items),
-            )
-            books = cursor.fetchall()
+            cursor.execute(self.favorite_authors_batch_query, [user_ids])
+            ranked_authors = cursor.fetchall()
+
+        # one ZREVRANGE per author shared by all the users
+        boards = get_leaderboard_book_ids(
+            "author", [row[1] for row in ranked_authors], num_items
+        )
 
-        # Format the books data
-        return [
-            {"id": row[0], "title": row[1], "author": row[2], "genre": row[3]}
-            for row in books
+        book_ids = {user_id: [] for user_id in user_ids}
+        for user_id, author, _ in ranked_authors:
+            book_ids[user_id].extend(boards[author])
+
+        rows = [
+            (user_id, book_id)
+            for user_id in user_ids
+            for book_id in book_ids[user_id][:num_items]
         ]
+        return self.format_books_batch(user_ids, rows)
 
 
 class SimilarUserBookRecommendationService(BookRecommendationService):
 
-    def get_recommended_books(self, user_id, num_items):
-        # Step 1: Find users with similar ratings
-        with connection.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT br2.user_id, COUNT(*) AS similarity
+    similar_users_query = """
+        SELECT br2.user_id, COUNT(*) AS similarity
+        FROM book_review br1
+        JOIN book_review br2 ON br1.book_id = br2.book_id AND br1.rating = br2.rating
+        WHERE br1.user_id = %s AND br2.user_id != %s
+        GROUP BY br2.user_id
+        ORDER BY similarity DESC, br2.user_id
+        LIMIT 10;  -- Limiting to top 10 similar users for performance
+        """
+
+    books_query = """
+        SELECT br.book_id, AVG(br.rating) as avg_rating
+        FROM book_review br
+        WHERE br.user_id = ANY(%s)
+          AND br.rating >= 4  -- Considering highly rated books (rating 4 or 5)
+          AND br.book_id NOT IN (
+              SELECT book_id FROM book_review WHERE user_id = %s
+          )
+        GROUP BY br.book_id
+        ORDER BY avg_rating DESC, br.book_id
+        LIMIT %s;
+        """
+
+    books_batch_query = """
+        SELECT users.user_id, books.book_id
+        FROM unnest(%s::bigint[]) AS users(user_id)
+        CROSS JOIN LATERAL (
+            SELECT br.book_id, AVG(br.rating) as avg_rating
+            FROM book_review br
+            WHERE br.user_id IN (
+                SELECT br2.user_id
                 FROM book_review br1
                 JOIN book_review br2 ON br1.book_id = br2.book_id AND br1.rating = br2.rating
-                WHERE br1.user_id = %s AND br2.user_id != %s
+                WHERE br1.user_id = users.user_id AND br2.user_id != users.user_id
                 GROUP BY br2.user_id
-                ORDER BY similarity DESC
-                LIMIT 10;  -- Limiting to top 10 similar users for performance
-                """,
-                [user_id, user_id],
+                ORDER BY COUNT(*) DESC, br2.user_id
+                LIMIT 10
             )
+              AND br.rating >= 4
+              AND NOT EXISTS (
+                  SELECT 1 FROM book_review own
+                  WHERE own.user_id = users.user_id AND own.book_id = br.book_id
+              )
+            GROUP BY br.book_id
+            ORDER BY avg_rating DESC, br.book_id
+            LIMIT %s
+        ) AS books
+        ORDER BY users.user_id, books.avg_rating DESC, books.book_id;
+        """
+
+    def get_recommended_books(self, user_id, num_items):
+        connection = get_read_connection(user_id)
+        # Step 1: Find users with similar ratings
+        with connection.cursor() as cursor:
+            cursor.execute(self.similar_users_query, [user_id, user_id])
             similar_users = cursor.fetchall()
 
         if not similar_users:
-            return []
+            # No overlap with anyone, fall back to the popular books
+            return PopularBookRecommendationService().get_recommended_books(
+                user_id, num_items
+            )
 
         similar_user_ids = [user[0] for user in similar_users]
-        similar_user_placeholders = ", ".join(["%s"] * len(similar_user_ids))
 
         # Step 2: Find books rated highly by similar users that the current user has not read
         with connection.cursor() as cursor:
-            cursor.execute(
-                f"""
-                SELECT bb.id, bb.title, bb.author, bb.genre, AVG(br.rating) as avg_rating
-                FROM book_review br
-                JOIN book_book bb ON br.book_id = bb.id
-                WHERE br.user_id IN ({similar_user_placeholders})
-                  AND br.rating >= 4  -- Considering highly rated books (rating 4 or 5)
-                  AND bb.id NOT IN (
-                      SELECT book_id FROM book_review WHERE user_id = %s
-                  )
-                GROUP BY bb.id, bb.title, bb.author, bb.genre
-                ORDER BY avg_rating DESC
-                LIMIT %s;
-                """,
-                (*similar_user_ids, user_id, num_items),
+            cursor.execute(self.books_query, [similar_user_ids, user_id, num_items])
+            books = cursor.fetchall()
+
+        if not books:
+            return PopularBookRecommendationService().get_recommended_books(
+                user_id, num_items
             )
+
+        # Hydrate the book ids with their title, author and genre
+        return hydrate_books([row[0] for row in books])
+
+    def get_recommended_books_batch(self, user_ids, num_items):
+        connection = get_read_connection(*user_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(self.books_batch_query, [user_ids, num_items])
+            rows = cursor.fetchall()
+
+        return with_popular_fallback(self.format_books_batch(user_ids, rows), num_items)
+
+
+class ItemSimilarityBookRecommendationService(BookRecommendationService):
+    """
+    Answers from the precomputed item-item model in book_booksimilarity
+    (built by the build_item_similarity task): the neighbours of the books
+    the user reviewed are scored by similarity times how much the user liked
+    the reviewed book, 3 being neutral.
+    """
+
+    books_query = """
+        SELECT bs.neighbor_id, SUM(bs.score * (br.rating - 3)) AS weight
+        FROM book_review br
+        JOIN book_booksimilarity bs ON bs.book_id = br.book_id
+        WHERE br.user_id = %s
+          AND bs.neighbor_id NOT IN (
+              SELECT book_id FROM book_review WHERE user_id = %s
+          )
+        GROUP BY bs.neighbor_id
+        HAVING SUM(bs.score * (br.rating - 3)) > 0
+        ORDER BY weight DESC, bs.neighbor_id
+        LIMIT %s;
+        """
+
+    books_batch_query = """
+        SELECT users.user_id, ranked.neighbor_id
+        FROM unnest(%s::bigint[]) AS users(user_id)
+        CROSS JOIN LATERAL (
+            SELECT bs.neighbor_id, SUM(bs.score * (br.rating - 3)) AS weight
+            FROM book_review br
+            JOIN book_booksimilarity bs ON bs.book_id = br.book_id
+            WHERE br.user_id = users.user_id
+              AND NOT EXISTS (
+                  SELECT 1 FROM book_review own
+                  WHERE own.user_id = users.user_id AND own.book_id = bs.neighbor_id
+              )
+            GROUP BY bs.neighbor_id
+            HAVING SUM(bs.score * (br.rating - 3)) > 0
+            ORDER BY weight DESC, bs.neighbor_id
+            LIMIT %s
+        ) AS ranked
+        ORDER BY users.user_id, ranked.weight DESC, ranked.neighbor_id;
+        """
+
+    def get_recommended_books(self, user_id, num_items):
+        connection = get_read_connection(user_id)
+        with connection.cursor() as cursor:
+            cursor.execute(self.books_query, [user_id, user_id, num_items])
             books = cursor.fetchall()
 
-        # Format the books data
-        return [
-            {"id": row[0], "title": row[1], "author": row[2], "genre": row[3]}
-            for row in books
-        ]
+        return hydrate_books([row[0] for row in books])
+
+    def get_recommended_books_batch(self, user_ids, num_items):
+        connection = get_read_connection(*user_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(self.books_batch_query, [user_ids, num_items])
+            rows = cursor.fetchall()
+
+        return self.format_books_batch(user_ids, rows)
+
+
+class EngineBookRecommendationService(BookRecommendationService):
+    """
+    Answers the genre, author and similar_user services from the in-memory
+    engine of book/engine.py instead of Postgres.
+    """
+
+    def __init__(self, service_type):
+        self.service_type = service_type
+
+    def get_recommended_books(self, user_id, num_items):
+        from .engine import get_engine
+
+        books = get_engine().recommend(self.service_type, user_id, num_items)
+        if not books and self.service_type == "similar_user":
+            return PopularBookRecommendationService().get_recommended_books(
+                user_id, num_items
+            )
+        return books
+
+    def get_recommended_books_batch(self, user_ids, num_items):
+        from .engine import get_engine
+
+        engine = get_engine()
+        books = {
+            user_id: engine.recommend(self.service_type, user_id, num_items)
+            for user_id in user_ids
+        }
+        if self.service_type == "similar_user":
+            return with_popular_fallback(books, num_items)
+        return books
+
+
+class PopularBookRecommendationService(BookRecommendationService):
+    """
+    Answers from the Bayesian averaged top POPULAR_BOOKS_TOP_N list kept in
+    Redis by the refresh_popular_books task, the books the user already
+    reviewed being left out with one indexed lookup. It serves the users
+    with no reviews and the similar_user service when nobody overlaps with
+    the user.
+    """
+
+    reviewed_query = """
+        SELECT book_id FROM book_review
+        WHERE user_id = %s AND book_id = ANY(%s);
+        """
+
+    reviewed_batch_query = """
+        SELECT user_id, book_id FROM book_review
+        WHERE user_id = ANY(%s) AND book_id = ANY(%s);
+        """
+
+    def get_recommended_books(self, user_id, num_items):
+        book_ids = get_popular_book_ids(settings.POPULAR_BOOKS_TOP_N)
+        if not book_ids:
+            return []
+
+        connection = get_read_connection(user_id)
+        with connection.cursor() as cursor:
+            cursor.execute(self.reviewed_query, [user_id, book_ids])
+            reviewed = {row[0] for row in cursor.fetchall()}
+
+        book_ids = [book_id for book_id in book_ids if book_id not in reviewed]
+        return hydrate_books(book_ids[:num_items])
+
+    def get_recommended_books_batch(self, user_ids, num_items):
+        book_ids = get_popular_book_ids(settings.POPULAR_BOOKS_TOP_N)
+        if not book_ids or not user_ids:
+            return {user_id: [] for user_id in user_ids}
+
+        connection = get_read_connection(*user_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(self.reviewed_batch_query, [list(user_ids), book_ids])
+            reviewed = set(cursor.fetchall())
+
+        rows = []
+        for user_id in user_ids:
+            unreviewed = [
+                book_id for book_id in book_ids if (user_id, book_id) not in reviewed
+            ]
+            rows.extend((user_id, book_id) for book_id in unreviewed[:num_items])
+
+        return self.format_books_batch(user_ids, rows)
+
+
+def with_popular_fallback(books_by_user, num_items):
+    """Fill the empty lists of {user_id: books} with the popular books."""
+    empty = [user_id for user_id, books in books_by_user.items() if not books]
+    if empty:
+        service = PopularBookRecommendationService()
+        books_by_user.update(service.get_recommended_books_batch(empty, num_items))
+    return books_by_user
+
+
+def get_recommended_books_batch(service_types, user_ids, num_items):
+    """
+    Return {user_id: {service_type: books}} for many users with one batch
+    call per service.
+    """
+    suggestions = {user_id: {} for user_id in user_ids}
+
+    for service_type in service_types:
+        service = BookRecommendationServiceFactory.create_service(service_type)
+        books = service.get_recommended_books_batch(user_ids, num_items)
+        for user_id in user_ids:
+            suggestions[user_id][service_type] = books[user_id]
+
+    return suggestions
@@ -0,0 +1,127 @@
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .aggregates import apply_rating_deltas, rebuild_taste_profiles
+from .catalog import catalog_changed
+from .hydration import forget_books
+from .leaderboards import book_moved, books_changed
+from .models import Book, Review
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def book_changed(instance, signal, created=False, **kwargs):
+    # bulk_create() and update() send no signal, their callers bump it
+    catalog_changed()
+    # the id of a deleted instance is cleared before the commit
+    book_id = instance.id
+    transaction.on_commit(lambda: forget_books([book_id]), robust=True)
+
+    if created or signal is post_delete:
+        books_changed(
+            [(book_id, instance.genre, instance.author)],
+            deleted=signal is post_delete,
+        )
+    elif getattr(instance, "_old_tastes", None):
+        book_moved(book_id, instance._old_tastes, (instance.genre, instance.author))
+
+
+# ----------------------------------------------------------------
+#  the taste profiles count the reviews of a book under its genre and
+#  author, the profiles of its reviewers are rebuilt when they change
+# ----------------------------------------------------------------
+
+
+@receiver(pre_save, sender=Book)
+def remember_book_tastes(instance, **kwargs):
+    # the old genre and author also tell book_changed the boards to leave
+    instance._reviewer_ids = None
+    instance._old_tastes = None
+    if instance._state.adding:
+        return
+
+    # read from the primary, a lagging replica would give stale values
+    old = (
+        Book.objects.using(DEFAULT_DB_ALIAS)
+        .filter(pk=instance.pk)
+        .values_list("genre", "author")
+        .first()
+    )
+    if old is not None and old != (instance.genre, instance.author):
+        instance._old_tastes = old
+        instance._reviewer_ids = get_reviewer_ids(instance.pk)
+
+
+@receiver(pre_delete, sender=Book)
+def remember_book_reviewers(instance, **kwargs):
+    # the reviews are deleted before the book
+    instance._reviewer_ids = get_reviewer_ids(instance.pk)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def rebuild_reviewer_tastes(instance, **kwargs):
+    if getattr(instance, "_reviewer_ids", None):
+        with transaction.atomic(), connection.cursor() as cursor:
+            rebuild_taste_profiles(cursor, instance._reviewer_ids)
+
+
+def get_reviewer_ids(book_id):
+    return list(
+        Review.objects.using(DEFAULT_DB_ALIAS)
+        .filter(book_id=book_id)
+        .values_list("user_id", flat=True)
+    )
+
+
+# ----------------------------------------------------------------
+#  the API writes reviews with SQL and keep the rating aggregates and the
+#  taste profiles in step themselves, the ORM writes (the admin, the
+#  reviews cascade deleted with their user or book) do it here
+# ----------------------------------------------------------------
+
+
+@receiver(pre_save, sender=Review)
+def remember_review_rating(instance, raw=False, **kwargs):
+    instance._old_rating = None
+    if raw or instance._state.adding:
+        return
+
+    instance._old_rating = (
+        Review.objects.using(DEFAULT_DB_ALIAS)
+        .filter(pk=instance.pk)
+        .values_list("user_id", "book_id", "rating")
+        .first()
+    )
+
+
+@receiver(post_save, sender=Review)
+def review_saved(instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    changes = []
+    if instance._old_rating is not None:
+        changes.append((*instance._old_rating, -1))
+    changes.append((instance.user_id, instance.book_id, instance.rating, 1))
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        apply_rating_deltas(cursor, changes)
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(instance, origin=None, **kwargs):
+    # origin is the instance or queryset delete() was called on
+    origin_model = getattr(origin, "model", type(origin))
+    if origin_model is Book:
+        # the book signals rebuild the taste profiles of its reviewers
+        return
+
+    # the taste profiles of a deleted user are deleted with them
+    with transaction.atomic(), connection.cursor() as cursor:
+        apply_rating_deltas(
+            cursor,
+            [(instance.user_id, instance.book_id, instance.rating, -1)],
+            tastes=origin_model is Review,
+        )
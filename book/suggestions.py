@@ -0,0 +1,354 @@
+import logging
+import struct
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from .hydration import get_books
+from .metrics import SERVICE_EMPTY_RESULTS, SERVICE_LATENCY, SERVICE_REQUESTS
+from .replicas import get_read_alias, use_read_alias
+from .services import BookRecommendationServiceFactory
+
+logger = logging.getLogger(__name__)
+
+SUGGESTION_SERVICES = ["genre", "author", "similar_user"]
+
+# suggestion lists are kept for 3 days
+SUGGESTION_TIMEOUT = 86400 * 3
+
+# times a suggestion list written concurrently is read and refreshed again
+SUGGESTION_REFRESH_ATTEMPTS = 3
+
+# ids of the users whose service weights need to be recomputed
+DIRTY_USERS_KEY = "RecommendationDirtyUsers"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_suggestion_cache_key(user_id):
+    return f"RecommendationPreference_{user_id}"
+
+
+# ----------------------------------------------------------------
+# -------------------     PACKED LISTS         -------------------
+# ----------------------------------------------------------------
+
+# a cached suggestion list is the ids of the books of each service only:
+# format version, number of services, (service index, number of ids) per
+# service and then the int32 ids, the books are hydrated from the shared
+# metadata cache of book/hydration.py
+PACKED_FORMAT_VERSION = 1
+PACKED_HEADER = struct.Struct("<BB")
+PACKED_SERVICE = struct.Struct("<BH")
+
+
+def pack_suggestions(recom_perf):
+    """Pack {service_name: books or book ids} into bytes."""
+    service_types = BookRecommendationServiceFactory.service_types
+    ids = {
+        service_name: [book if isinstance(book, int) else book["id"] for book in books]
+        for service_name, books in recom_perf.items()
+    }
+
+    parts = [PACKED_HEADER.pack(PACKED_FORMAT_VERSION, len(ids))]
+    for service_name, book_ids in ids.items():
+        parts.append(
+            PACKED_SERVICE.pack(service_types.index(service_name), len(book_ids))
+        )
+    for book_ids in ids.values():
+        parts.append(struct.pack(f"<{len(book_ids)}i", *book_ids))
+    return b"".join(parts)
+
+
+def unpack_suggestions(packed):
+    """
+    Unpack a cached suggestion list into {service_name: book ids}, lists
+    cached as book dicts by older versions are read too.
+    """
+    if isinstance(packed, dict):
+        return {
+            service_name: [book["id"] for book in books]
+            for service_name, books in packed.items()
+        }
+
+    service_types = BookRecommendationServiceFactory.service_types
+    _, num_services = PACKED_HEADER.unpack_from(packed)
+    offset = PACKED_HEADER.size
+
+    counts = []
+    for _ in range(num_services):
+        service_index, count = PACKED_SERVICE.unpack_from(packed, offset)
+        counts.append((service_types[service_index], count))
+        offset += PACKED_SERVICE.size
+
+    recom_ids = {}
+    for service_name, count in counts:
+        recom_ids[service_name] = list(struct.unpack_from(f"<{count}i", packed, offset))
+        offset += 4 * count
+    return recom_ids
+
+
+def hydrate_suggestions(recom_ids):
+    """Turn {service_name: book ids} into {service_name: books} with one lookup."""
+    books = get_books([book_id for ids in recom_ids.values() for book_id in ids])
+    return {
+        service_name: [books[book_id] for book_id in ids if book_id in books]
+        for service_name, ids in recom_ids.items()
+    }
+
+
+def mark_users_dirty(user_ids):
+    if user_ids:
+        get_redis_connection("default").sadd(DIRTY_USERS_KEY, *user_ids)
+
+
+def unmark_users_dirty(user_ids):
+    if user_ids:
+        get_redis_connection("default").srem(DIRTY_USERS_KEY, *user_ids)
+
+
+def pop_dirty_users(count):
+    user_ids = get_redis_connection("default").spop(DIRTY_USERS_KEY, count)
+    return [int(user_id) for user_id in user_ids]
+
+
+def get_service_books(service_name, user_id, num_items):
+    """Run a suggestion service for one user, recording its latency."""
+    service = BookRecommendationServiceFactory.create_service(service_name)
+
+    started = time.perf_counter()
+    books = service.get_recommended_books(user_id, num_items)
+    SERVICE_LATENCY.observe(time.perf_counter() - started, service=service_name)
+
+    SERVICE_REQUESTS.inc(service=service_name)
+    if not books:
+        SERVICE_EMPTY_RESULTS.inc(service=service_name)
+
+    return books
+
+
+def get_num_items(preference, service_name):
+    """
+    The number of books a service suggests to a user: 10 without a
+    preference, else the weight (0 - 100) of the service divided by 10.
+    """
+    if not preference:
+        return 10
+    return int(preference[service_name] / 10)
+
+
+def fetch_suggestions_parallel(user_id, preference):
+    """
+    Run the suggestion services of a user concurrently, each one in a pool
+    thread with its own database connection.
+
+    A service that fails or does not answer within BOOK_SUGGEST_SERVICE_TIMEOUT
+    seconds gives an empty list, its statement is cancelled by the same
+    statement_timeout on the database side.
+
+    Returns:
+    •  tuple: (recom_perf, complete) complete being False if a service was dropped.
+    """
+    timeout = settings.BOOK_SUGGEST_SERVICE_TIMEOUT
+    futures = {
+        service_name: _get_executor().submit(
+            _fetch_books,
+            service_name,
+            user_id,
+            get_num_items(preference, service_name),
+            timeout,
+        )
+        for service_name in SUGGESTION_SERVICES
+    }
+    wait(futures.values(), timeout=timeout)
+
+    recom_perf = {}
+    complete = True
+    for service_name, future in futures.items():
+        if future.done() and future.exception() is None:
+            recom_perf[service_name] = future.result()
+            continue
+
+        complete = False
+        recom_perf[service_name] = []
+        if not future.cancel() and future.done():
+            logger.error(
+                "suggestion service %s failed: %s", service_name, future.exception()
+            )
+        else:
+            logger.warning(
+                "suggestion service %s timed out after %ss", service_name, timeout
+            )
+
+    return recom_perf, complete
+
+
+def _fetch_books(service_name, user_id, num_items, timeout):
+    # the services read from the replica, or the primary after a write of the
+    # user, the alias is chosen once so the service runs on the connection
+    # the statement_timeout is set on. Pool threads keep their connection
+    # between jobs like a request would, so close it when it is broken or
+    # older than CONN_MAX_AGE
+    with use_read_alias(get_read_alias(user_id)) as read_connection:
+        read_connection.close_if_unusable_or_obsolete()
+        try:
+            with read_connection.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s;", [int(timeout * 1000)])
+
+            return get_service_books(service_name, user_id, num_items)
+        finally:
+            read_connection.close_if_unusable_or_obsolete()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BOOK_SUGGEST_MAX_WORKERS,
+                thread_name_prefix="book-suggest",
+            )
+    return _executor
+
+
+def get_user_preferences(user_ids):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT user_id, genre_weight, author_weight, similar_user_weight
+            FROM book_userrecommendationpreference
+            WHERE user_id = ANY(%s);
+            """,
+            [list(user_ids)],
+        )
+        rows = cursor.fetchall()
+
+    return {
+        row[0]: {"genre": row[1], "author": row[2], "similar_user": row[3]}
+        for row in rows
+    }
+
+
+def build_suggestions_batch(user_ids):
+    """
+    Build the suggestion lists ({service_name: books}) of many users. Users
+    are grouped by the number of books each service gives them, so every
+    service runs one batch query per distinct preference.
+    """
+    preferences = get_user_preferences(user_ids)
+    recom_perfs = {user_id: {} for user_id in user_ids}
+
+    for service_name in SUGGESTION_SERVICES:
+        service = BookRecommendationServiceFactory.create_service(service_name)
+
+        groups = defaultdict(list)
+        for user_id in user_ids:
+            num_items = get_num_items(preferences.get(user_id), service_name)
+            groups[num_items].append(user_id)
+
+        for num_items, group in groups.items():
+            books = service.get_recommended_books_batch(group, num_items)
+            for user_id in group:
+                recom_perfs[user_id][service_name] = books[user_id]
+
+    return recom_perfs
+
+
+def refresh_suggestion_slices(user_id, service_names):
+    """
+    Recompute only the given service slices of the cached suggestion list of
+    a user, keeping the other slices. A user without a cached list is left
+    alone, their next request builds it from scratch anyway.
+
+    The list is replaced only if nobody wrote it since it was read (WATCH),
+    else it is read and refreshed again, at most SUGGESTION_REFRESH_ATTEMPTS
+    times. The list keeps its remaining time to live, so a user writing
+    reviews all the time still gets the expensive slices rebuilt when it
+    expires.
+    """
+    key = cache.client.make_key(get_suggestion_cache_key(user_id))
+    preference = get_user_preferences([user_id]).get(user_id)
+
+    with get_redis_connection("default").pipeline() as pipe:
+        for _ in range(SUGGESTION_REFRESH_ATTEMPTS):
+            try:
+                pipe.watch(key)
+                packed = pipe.get(key)
+                if not packed:
+                    return False
+
+                recom_ids = unpack_suggestions(cache.client.decode(packed))
+                for service_name in service_names:
+                    recom_ids[service_name] = get_service_books(
+                        service_name, user_id, get_num_items(preference, service_name)
+                    )
+
+                pipe.multi()
+                pipe.set(
+                    key, cache.client.encode(pack_suggestions(recom_ids)), keepttl=True
+                )
+                pipe.execute()
+                break
+            except WatchError:
+                continue
+        else:
+            return False
+
+    # written around the cache client, drop the copies of its local tier
+    if hasattr(cache.client, "invalidate"):
+        cache.client.invalidate([key])
+    return True
+
+
+def save_suggestions_many(recom_perfs):
+    cache.set_many(
+        {
+            get_suggestion_cache_key(user_id): pack_suggestions(recom_perf)
+            for user_id, recom_perf in recom_perfs.items()
+        },
+        SUGGESTION_TIMEOUT,
+    )
+
+
+def iter_active_user_ids(chunk_size, active_days=None):
+    """
+    Yield chunks of ids of the active users that have at least one review,
+    only those that logged in during the last active_days days if given.
+    """
+    last_login_filter = ""
+    params = []
+    if active_days is not None:
+        last_login_filter = "AND u.last_login >= NOW() - make_interval(days => %s)"
+        params.append(active_days)
+
+    last_user_id = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT u.id
+                FROM accounts_user u
+                WHERE u.is_active
+                  AND u.id > %s
+                  AND EXISTS (SELECT 1 FROM book_review r WHERE r.user_id = u.id)
+                  {last_login_filter}
+                ORDER BY u.id
+                LIMIT %s;
+                """,
+                [last_user_id, *params, chunk_size],
+            )
+            user_ids = [row[0] for row in cursor.fetchall()]
+
+        if not user_ids:
+            return
+
+        yield user_ids
+        last_user_id = user_ids[-1]
@@ -1,104 +1,283 @@
+import logging
+import time
+
 from celery import shared_task
+from django.conf import settings
 from django.core.cache import cache
-from django.db import connection
-from django_redis import get_redis_connection
+from django.db import connection, transaction
+
+from .metrics import WEIGHT_UPDATE_USERS
+from .suggestions import (
+    build_suggestions_batch,
+    get_suggestion_cache_key,
+    iter_active_user_ids,
+    mark_users_dirty,
+    pop_dirty_users,
+    refresh_suggestion_slices,
+    save_suggestions_many,
+    unmark_users_dirty,
+    unpack_suggestions,
+)
+
+logger = logging.getLogger(__name__)
 
-from utils import get_keys_with_pattern
+# the top ITEM_SIMILARITY_TOP_K neighbours by cosine similarity of the books
+# of one id range, params: range start, range end, min support, top k
+ITEM_SIMILARITY_BATCH_QUERY = """
+    SELECT book_id, neighbor_id, score
+    FROM (
+        SELECT pairs.book_id, pairs.neighbor_id, scored.score,
+            ROW_NUMBER() OVER (
+                PARTITION BY pairs.book_id
+                ORDER BY scored.score DESC, pairs.neighbor_id
+            ) AS rank
+        FROM (
+            SELECT a.book_id, b.book_id AS neighbor_id,
+                SUM(a.rating * b.rating) AS dot
+            FROM book_review a
+            JOIN book_review b
+                ON a.user_id = b.user_id AND a.book_id != b.book_id
+            WHERE a.book_id >= %s AND a.book_id < %s
+            GROUP BY a.book_id, b.book_id
+            HAVING COUNT(*) >= %s
+        ) AS pairs
+        JOIN book_norm na ON na.book_id = pairs.book_id
+        JOIN book_norm nb ON nb.book_id = pairs.neighbor_id
+        CROSS JOIN LATERAL (
+            SELECT pairs.dot / (na.norm * nb.norm) AS score
+        ) AS scored
+    ) AS ranked
+    WHERE rank <= %s;
+    """
 
 
 @shared_task
 def update_recommendation_weights():
-    pattern = "*RecommendationPreference_*"
-    redis_keys = get_keys_with_pattern(pattern)
+    """
+    Recompute the service weights of the users marked dirty by the suggest
+    and review endpoints, draining the dirty set RECOMMENDATION_WEIGHTS_BATCH_SIZE
+    users at a time with one statement per batch.
+
+    Returns the number of users drained.
+    """
+    batch_size = settings.RECOMMENDATION_WEIGHTS_BATCH_SIZE
+    users = 0
+
+    while True:
+        user_ids = pop_dirty_users(batch_size)
+        if not user_ids:
+            break
+
+        try:
+            update_weights_batch(user_ids)
+        except Exception:
+            mark_users_dirty(user_ids)
+            raise
+
+        users += len(user_ids)
+
+    WEIGHT_UPDATE_USERS.observe(users)
+    return users
+
+
+def update_weights_batch(user_ids):
+    """
+    The weight of a service is the share of the books it suggested to the
+    user (in their cached suggestion list) that the user then reviewed.
+    """
+    packed_lists = cache.get_many(
+        [get_suggestion_cache_key(user_id) for user_id in user_ids]
+    )
+
+    # ----------------------------------------------------------------
+    #  flatten the suggestion lists into (user, service, book) columns
+    # ----------------------------------------------------------------
+    suggested = set()
+    for user_id in user_ids:
+        packed = packed_lists.get(get_suggestion_cache_key(user_id))
+        if not packed:
+            continue
+        for service_name, book_ids in unpack_suggestions(packed).items():
+            for book_id in book_ids:
+                suggested.add((user_id, service_name, book_id))
+
+    if not suggested:
+        return
+
+    suggested_user_ids, service_names, book_ids = (
+        list(column) for column in zip(*suggested)
+    )
 
     # ----------------------------------------------------------------
-    #  check redis keys for this case
+    #  count the reviewed suggestions and upsert the weights at once
     # ----------------------------------------------------------------
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            WITH suggested (user_id, service, book_id) AS (
+                SELECT * FROM unnest(%s::bigint[], %s::text[], %s::bigint[])
+            ),
+            counts AS (
+                SELECT s.user_id,
+                    COUNT(*) FILTER (WHERE s.service = 'genre') AS genre_count,
+                    COUNT(*) FILTER (WHERE s.service = 'author') AS author_count,
+                    COUNT(*) FILTER (WHERE s.service = 'similar_user') AS similar_user_count,
+                    COUNT(*) AS total_count
+                FROM suggested s
+                JOIN book_review r ON r.user_id = s.user_id AND r.book_id = s.book_id
+                GROUP BY s.user_id
+            )
+            INSERT INTO book_userrecommendationpreference
+            (user_id, genre_weight, author_weight, similar_user_weight)
+            SELECT user_id,
+                genre_count * 100.0 / total_count,
+                author_count * 100.0 / total_count,
+                similar_user_count * 100.0 / total_count
+            FROM counts
+            ON CONFLICT (user_id) DO UPDATE SET
+                genre_weight = EXCLUDED.genre_weight,
+                author_weight = EXCLUDED.author_weight,
+                similar_user_weight = EXCLUDED.similar_user_weight;
+            """,
+            [suggested_user_ids, service_names, book_ids],
+        )
+
+
+def create_book_norm(cursor):
+    """
+    Create the book_norm temporary table of the rating vector norm of every
+    reviewed book, dropped at the end of the transaction, or replaced when
+    the transaction already made one.
+    """
+    cursor.execute("DROP TABLE IF EXISTS pg_temp.book_norm;")
+    cursor.execute(
+        """
+        CREATE TEMPORARY TABLE book_norm ON COMMIT DROP AS
+        SELECT book_id, SQRT(SUM(rating * rating)) AS norm
+        FROM book_review
+        GROUP BY book_id;
+        """
+    )
+    cursor.execute("ALTER TABLE book_norm ADD PRIMARY KEY (book_id);")
+
+
+@shared_task
+def build_item_similarity():
+    """
+    Rebuild the item-item cosine similarity model in book_booksimilarity,
+    keeping the top ITEM_SIMILARITY_TOP_K neighbours of every book.
+
+    The co-rating self join is done for ITEM_SIMILARITY_BATCH_SIZE books at a
+    time and the whole rebuild runs in one transaction, so readers keep
+    seeing the previous model until the new one is committed.
+    """
+    batch_size = settings.ITEM_SIMILARITY_BATCH_SIZE
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        create_book_norm(cursor)
+        cursor.execute("DELETE FROM book_booksimilarity;")
+
+        cursor.execute("SELECT MIN(book_id), MAX(book_id) FROM book_norm;")
+        min_book_id, max_book_id = cursor.fetchone()
+
+        total = 0
+        if min_book_id is None:
+            return total
+
+        for start in range(min_book_id, max_book_id + 1, batch_size):
+            cursor.execute(
+                "INSERT INTO book_booksimilarity (book_id, neighbor_id, score) "
+                + ITEM_SIMILARITY_BATCH_QUERY,
+                [
+                    start,
+                    start + batch_size,
+                    settings.ITEM_SIMILARITY_MIN_SUPPORT,
+                    settings.ITEM_SIMILARITY_TOP_K,
+                ],
+            )
+            total += cursor.rowcount
+
+    return total
+
+
+@shared_task
+def precompute_suggestions(active_days=None):
+    """
+    Precompute the suggestion lists of every active user (or of the users
+    active during the last active_days days) into the cache, in chunks of
+    SUGGESTION_PRECOMPUTE_CHUNK_SIZE users served by the batch services.
+
+    Returns the throughput of the run.
+    """
+    started = time.monotonic()
+    users = 0
+    chunks = 0
+
+    for user_ids in iter_active_user_ids(
+        settings.SUGGESTION_PRECOMPUTE_CHUNK_SIZE, active_days
+    ):
+        save_suggestions_many(build_suggestions_batch(user_ids))
+        users += len(user_ids)
+        chunks += 1
+
+    seconds = time.monotonic() - started
+    result = {
+        "users": users,
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "users_per_second": round(users / seconds, 1) if seconds else 0,
+    }
+    logger.info("precompute_suggestions: %s", result)
+
+    return result
+
+
+@shared_task
+def refresh_user_suggestions(user_id):
+    """
+    Refresh the genre and author slices of the cached suggestion list of a
+    user after one of their reviews changed. The similar_user slice is left
+    to the nightly precomputation since it is the expensive one.
+
+    The weights of the user are computed first, from the list the reviewed
+    book was suggested in, and the user is taken out of the dirty set so
+    update_recommendation_weights does not recompute them from the
+    refreshed list.
+    """
+    update_weights_batch([user_id])
+    unmark_users_dirty([user_id])
+    return refresh_suggestion_slices(user_id, ["genre", "author"])
+
+
+@shared_task
+def rebuild_leaderboards():
+    """
+    Rebuild the genre and author leaderboards of the genre and author
+    services from the catalog and the rating aggregates.
+    """
+    from .leaderboards import rebuild_leaderboards
+
+    return rebuild_leaderboards()
+
+
+@shared_task
+def refresh_popular_books():
+    """
+    Rebuild the global and per genre popular book lists of the "popular"
+    service from the rating aggregates.
+    """
+    from .popular import refresh_popular_books
+
+    return refresh_popular_books()
+
+
+@shared_task
+def flush_review_writes():
+    """
+    Flush the review writes accepted in write-behind mode (REVIEW_WRITE_BEHIND)
+    to the database in micro-batches.
+    """
+    # review_writes schedules tasks of this module through review_events
+    from .review_writes import flush_review_writes
 
-    for redis_key in redis_keys:
-        # ----------------------------------------------------------------
-        #  clean redis key get data of books and recommendations
-        # ----------------------------------------------------------------
-        cleaned_key = redis_key.decode("utf-8")
-        key = cleaned_key.strip(":1:")
-        user_id = key.strip("RecommendationPreference_")
-        data = cache.get(key)
-
-        if data:
-            genre_count = 0
-            author_count = 0
-            similar_user_count = 0
-
-            for service_name in data:
-
-                # ----------------------------------------------------------------
-                #  check the reviews that user had been added last days
-                # ----------------------------------------------------------------
-
-                list_book_ids = extract_values_list_dicts(data[service_name], "id")
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        "SELECT COUNT(*) FROM book_review WHERE book_id = ANY(%s) AND user_id = %s;",
-                        [list_book_ids, user_id],
-                    )
-                    count = cursor.fetchone()[0]
-                # ----------------------------------------------------------------
-                #  total_count and percentage of each services
-                # ----------------------------------------------------------------
-                if service_name == "genre":
-                    genre_count += count
-                elif service_name == "author":
-                    author_count += count
-                elif service_name == "similar_user":
-                    similar_user_count += count
-
-                total_count = genre_count + author_count + similar_user_count
-
-                if total_count > 0:
-                    genre_weight = (genre_count / total_count) * 100
-                    author_weight = (author_count / total_count) * 100
-                    similar_user_weight = (similar_user_count / total_count) * 100
-
-                    # ----------------------------------------------------------------
-                    #  check preference is existing and update or create it
-                    # ----------------------------------------------------------------
-                    with connection.cursor() as cursor:
-                        cursor.execute(
-                            "SELECT COUNT(*) FROM book_userrecommendationpreference WHERE user_id = %s ;",
-                            [user_id],
-                        )
-                        count = cursor.fetchone()[0]
-
-                    if count == 1:
-                        with connection.cursor() as cursor:
-                            cursor.execute(
-                                """
-                                UPDATE book_userrecommendationpreference
-                                SET genre_weight = %s,
-                                author_weight = %s,
-                                similar_user_weight =  %s
-                                WHERE user_id =  %s;
-                                """,
-                                [
-                                    genre_weight,
-                                    author_weight,
-                                    similar_user_weight,
-                                    user_id,
-                                ],
-                            )
-
-                    elif count == 0:
-                        with connection.cursor() as cursor:
-                            cursor.execute(
-                                """
-                                INSERT INTO book_userrecommendationpreference 
-                                (genre_weight ,author_weight ,similar_user_weight , user_id)
-                                VALUES (%s , %s , %s , %s );
-                                """,
-                                [
-                                    genre_weight,
-                                    author_weight,
-                                    similar_user_weight,
-                                    user_id,
-                                ],
-                            )
+    return flush_review_writes()
@@ -1,3 +1,2210 @@
-from django.test import TestCase
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from itertools import count
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from book_recommendation import cache as cache_module
+from book_recommendation import settings as settings_module
+from book_recommendation.cache import INVALIDATION_CHANNEL, LocalLRUCache
+
+from . import engine, leaderboards, review_writes
+from .aggregates import TASTE_LOCK_NAMESPACE, rebuild_taste_profiles
+from .benchmarks import compare_reports, get_dataset_size, load_report, seed_dataset
+from .catalog import (
+    CATALOG_VERSION_KEY,
+    bump_catalog_version,
+    get_catalog_cache_key,
+    get_catalog_state,
+)
+from .hydration import get_books, hydrate_books
+from .ingestion import CREATED, FAILED, UNCHANGED, UPDATED, ingest_reviews
+from .leaderboards import (
+    LEADERBOARD_CHANGES_KEY,
+    LEADERBOARDS_KEY,
+    get_leaderboard_book_ids,
+    get_leaderboard_key,
+    get_top_book_ids,
+    rebuild_leaderboards,
+)
+from .models import (
+    Book,
+    BookRatingAggregate,
+    BookSimilarity,
+    Review,
+    UserAuthorTaste,
+    UserGenreTaste,
+    UserRecommendationPreference,
+)
+from .popular import (
+    POPULAR_BOOKS_KEY,
+    POPULAR_GENRES_KEY,
+    get_popular_book_ids,
+    get_popular_books_key,
+    refresh_popular_books,
+)
+from .replicas import (
+    ReplicaRouter,
+    get_read_alias,
+    get_read_your_writes_key,
+    pin_to_primary,
+    use_read_alias,
+)
+from .review_writes import (
+    ADD,
+    REVIEW_WRITES_DEAD_LETTER_STREAM,
+    REVIEW_WRITES_STREAM,
+    enqueue_review_write,
+    flush_review_writes,
+    get_write_status,
+)
+from .services import (
+    AuthorBookRecommendationService,
+    BookRecommendationServiceFactory,
+    GenreBookRecommendationService,
+    ItemSimilarityBookRecommendationService,
+    PopularBookRecommendationService,
+)
+from .suggestions import (
+    DIRTY_USERS_KEY,
+    PACKED_HEADER,
+    PACKED_SERVICE,
+    SUGGESTION_SERVICES,
+    fetch_suggestions_parallel,
+    get_suggestion_cache_key,
+    pack_suggestions,
+    refresh_suggestion_slices,
+    unpack_suggestions,
+)
+from .tasks import (
+    build_item_similarity,
+    precompute_suggestions,
+    refresh_user_suggestions,
+)
+
+_ids = count(1)
+
+
+def create_user():
+    n = next(_ids)
+    return User.objects.create_user(
+        f"0912{n:07d}", f"user{n}@example.com", f"user{n}", "password"
+    )
+
+
+def create_book(genre="fantasy", author="author"):
+    n = next(_ids)
+    return Book.objects.create(title=f"title{n}", author=author, genre=genre)
+
+
+def get_client(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+# ----------------------------------------------------------------
+# -------------------     RATING AGGREGATES      -----------------
+# ----------------------------------------------------------------
+
+
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = get_client(self.user)
+        self.book = create_book()
+
+    def get_aggregate(self):
+        aggregate = BookRatingAggregate.objects.get(book=self.book)
+        return {
+            "review_count": aggregate.review_count,
+            "rating_sum": aggregate.rating_sum,
+            "average_rating": aggregate.average_rating,
+            "counts": [
+                aggregate.rating_1_count,
+                aggregate.rating_2_count,
+                aggregate.rating_3_count,
+                aggregate.rating_4_count,
+                aggregate.rating_5_count,
+            ],
+        }
+
+    def add_review(self, rating, user=None):
+        client = get_client(user) if user else self.client
+        response = client.post(
+            reverse("book:review-add"),
+            {"book": self.book.id, "rating": rating},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return Review.objects.get(book=self.book, user=user or self.user)
+
+    def test_add(self):
+        self.add_review(4)
+        self.add_review(2, user=create_user())
+
+        self.assertEqual(
+            self.get_aggregate(),
+            {
+                "review_count": 2,
+                "rating_sum": 6,
+                "average_rating": 3.0,
+                "counts": [0, 1, 0, 1, 0],
+            },
+        )
+
+    def test_update(self):
+        review = self.add_review(4)
+
+        response = self.client.patch(
+            reverse("book:review-update", args=[review.id]),
+            {"rating": 1},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.get_aggregate(),
+            {
+                "review_count": 1,
+                "rating_sum": 1,
+                "average_rating": 1.0,
+                "counts": [1, 0, 0, 0, 0],
+            },
+        )
+
+    def test_delete(self):
+        other = create_user()
+        self.add_review(5, user=other)
+        review = self.add_review(3)
+
+        response = self.client.delete(reverse("book:review-delete", args=[review.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.get_aggregate(),
+            {
+                "review_count": 1,
+                "rating_sum": 5,
+                "average_rating": 5.0,
+                "counts": [0, 0, 0, 0, 1],
+            },
+        )
+
+    def test_delete_last_review_clears_the_average(self):
+        review = self.add_review(3)
+
+        self.client.delete(reverse("book:review-delete", args=[review.id]))
+
+        self.assertEqual(
+            self.get_aggregate(),
+            {
+                "review_count": 0,
+                "rating_sum": 0,
+                "average_rating": None,
+                "counts": [0, 0, 0, 0, 0],
+            },
+        )
+
+    def test_orm_update_and_delete(self):
+        # the admin writes through the ORM
+        review = self.add_review(4)
+
+        review.rating = 2
+        review.save()
+
+        self.assertEqual(
+            self.get_aggregate(),
+            {
+                "review_count": 1,
+                "rating_sum": 2,
+                "average_rating": 2.0,
+                "counts": [0, 1, 0, 0, 0],
+            },
+        )
+        self.assertEqual(UserGenreTaste.objects.get(user=self.user).rating_sum, 2)
+
+        review.delete()
+
+        self.assertEqual(
+            self.get_aggregate(),
+            {
+                "review_count": 0,
+                "rating_sum": 0,
+                "average_rating": None,
+                "counts": [0, 0, 0, 0, 0],
+            },
+        )
+        self.assertEqual(UserGenreTaste.objects.get(user=self.user).review_count, 0)
+
+    def test_reviews_deleted_with_their_user(self):
+        other = create_user()
+        self.add_review(5, user=other)
+        self.add_review(3)
+
+        other_id = other.id
+        other.delete()
+
+        self.assertEqual(
+            self.get_aggregate(),
+            {
+                "review_count": 1,
+                "rating_sum": 3,
+                "average_rating": 3.0,
+                "counts": [0, 0, 1, 0, 0],
+            },
+        )
+        self.assertFalse(UserGenreTaste.objects.filter(user_id=other_id).exists())
+
+
+# ----------------------------------------------------------------
+# -------------------     TASTE PROFILES         -----------------
+# ----------------------------------------------------------------
+
+
+class TasteProfileTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = get_client(self.user)
+        self.books = [
+            create_book(genre="fantasy", author="tolkien"),
+            create_book(genre="fantasy", author="martin"),
+        ]
+
+    def get_tastes(self):
+        return {
+            "genres": {
+                taste.genre: (taste.rating_sum, taste.review_count)
+                for taste in UserGenreTaste.objects.filter(user=self.user)
+            },
+            "authors": {
+                taste.author: (taste.rating_sum, taste.review_count)
+                for taste in UserAuthorTaste.objects.filter(user=self.user)
+            },
+        }
+
+    def add_review(self, book, rating):
+        response = self.client.post(
+            reverse("book:review-add"),
+            {"book": book.id, "rating": rating},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return Review.objects.get(book=book, user=self.user)
+
+    def test_add(self):
+        self.add_review(self.books[0], 4)
+        self.add_review(self.books[1], 2)
+
+        self.assertEqual(
+            self.get_tastes(),
+            {
+                "genres": {"fantasy": (6, 2)},
+                "authors": {"tolkien": (4, 1), "martin": (2, 1)},
+            },
+        )
+
+    def test_update(self):
+        review = self.add_review(self.books[0], 4)
+        self.add_review(self.books[1], 2)
+
+        response = self.client.patch(
+            reverse("book:review-update", args=[review.id]),
+            {"rating": 1},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.get_tastes(),
+            {
+                "genres": {"fantasy": (3, 2)},
+                "authors": {"tolkien": (1, 1), "martin": (2, 1)},
+            },
+        )
+
+    def test_delete(self):
+        review = self.add_review(self.books[0], 4)
+        self.add_review(self.books[1], 2)
+
+        response = self.client.delete(reverse("book:review-delete", args=[review.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.get_tastes(),
+            {
+                "genres": {"fantasy": (2, 1)},
+                "authors": {"tolkien": (0, 0), "martin": (2, 1)},
+            },
+        )
+
+    def test_book_genre_and_author_change_rebuild_the_profiles(self):
+        self.add_review(self.books[0], 4)
+        self.add_review(self.books[1], 2)
+
+        book = self.books[0]
+        book.genre = "horror"
+        book.author = "king"
+        book.save()
+
+        self.assertEqual(
+            self.get_tastes(),
+            {
+                "genres": {"fantasy": (2, 1), "horror": (4, 1)},
+                "authors": {"king": (4, 1), "martin": (2, 1)},
+            },
+        )
+
+    def test_book_delete_rebuilds_the_profiles(self):
+        self.add_review(self.books[0], 4)
+        self.add_review(self.books[1], 2)
+
+        self.books[0].delete()
+
+        self.assertEqual(
+            self.get_tastes(),
+            {"genres": {"fantasy": (2, 1)}, "authors": {"martin": (2, 1)}},
+        )
+
+    def test_services_ignore_the_emptied_profiles(self):
+        review = self.add_review(self.books[0], 4)
+        self.add_review(self.books[1], 2)
+        self.client.delete(reverse("book:review-delete", args=[review.id]))
+
+        with mock.patch(
+            "book.services.get_top_book_ids", return_value=[]
+        ) as get_top_book_ids:
+            AuthorBookRecommendationService().get_recommended_books(self.user.id, 5)
+        get_top_book_ids.assert_called_once_with("author", ["martin"], 5)
+
+        with mock.patch(
+            "book.services.get_leaderboard_book_ids", return_value={"martin": []}
+        ) as get_leaderboard_book_ids:
+            AuthorBookRecommendationService().get_recommended_books_batch(
+                [self.user.id], 5
+            )
+        get_leaderboard_book_ids.assert_called_once_with("author", ["martin"], 5)
+
+    def test_ranking_matches_the_reviews(self):
+        # the genres and authors of a user ranked from the profiles, against
+        # the GROUP BY over the reviews the services ran before them
+        books = self.books + [
+            create_book(genre=genre, author=author)
+            for genre, author in (
+                ("horror", "king"),
+                ("horror", "martin"),
+                ("poetry", "rumi"),
+                ("poetry", "king"),
+            )
+        ]
+        reviews = [
+            self.add_review(book, rating)
+            for book, rating in zip(books, (5, 2, 4, 3, 1, 4))
+        ]
+        self.client.patch(
+            reverse("book:review-update", args=[reviews[2].id]),
+            {"rating": 1},
+            format="json",
+        )
+        self.client.delete(reverse("book:review-delete", args=[reviews[0].id]))
+        books[4].genre = "fantasy"
+        books[4].save()
+
+        for column, service in (
+            ("genre", GenreBookRecommendationService),
+            ("author", AuthorBookRecommendationService),
+        ):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT book_book.{column}, AVG(book_review.rating) as avg_rating
+                    FROM book_review
+                    JOIN book_book ON book_review.book_id = book_book.id
+                    WHERE book_review.user_id = %s
+                    GROUP BY book_book.{column}
+                    ORDER BY avg_rating DESC, book_book.{column};
+                    """,
+                    [self.user.id],
+                )
+                expected = [
+                    (value, round(float(avg), 9)) for value, avg in cursor.fetchall()
+                ]
+
+                cursor.execute(
+                    getattr(service, f"favorite_{column}s_query"), [self.user.id]
+                )
+                ranked = [(value, round(avg, 9)) for value, avg in cursor.fetchall()]
+
+            self.assertEqual(ranked, expected)
+            self.assertEqual(len(ranked), 3)
+
+    def get_taste_locks(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT objid FROM pg_locks
+                WHERE locktype = 'advisory' AND classid = %s
+                    AND pid = pg_backend_pid();
+                """,
+                [TASTE_LOCK_NAMESPACE],
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def test_rebuild_locks_the_profiles(self):
+        other = create_user()
+
+        with connection.cursor() as cursor:
+            rebuild_taste_profiles(cursor, [other.id, self.user.id])
+
+        # held until the transaction ends, the review writes wait for them
+        self.assertEqual(self.get_taste_locks(), {self.user.id, other.id})
+
+    def test_review_writes_lock_the_profiles(self):
+        self.add_review(self.books[0], 4)
+
+        self.assertEqual(self.get_taste_locks(), {self.user.id})
+
+    def test_services_ignore_the_profiles_with_no_review(self):
+        UserGenreTaste.objects.create(
+            user=self.user, genre="horror", rating_sum=0, review_count=0
+        )
+
+        with mock.patch("book.services.get_top_book_ids") as get_top_book_ids:
+            books = GenreBookRecommendationService().get_recommended_books(
+                self.user.id, 5
+            )
+
+        self.assertEqual(books, [])
+        get_top_book_ids.assert_not_called()
+
+
+# ----------------------------------------------------------------
+# -------------------     REVIEW ADD             -----------------
+# ----------------------------------------------------------------
+
+
+class ReviewAddViewTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = get_client(self.user)
+        self.book = create_book()
+
+    def add_review(self, book_id, rating):
+        return self.client.post(
+            reverse("book:review-add"),
+            {"book": book_id, "rating": rating},
+            format="json",
+        )
+
+    def test_created(self):
+        response = self.add_review(self.book.id, 4)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {"message": "Review added successfully"})
+        self.assertEqual(Review.objects.get(user=self.user).rating, 4)
+
+    def test_duplicate_review(self):
+        self.add_review(self.book.id, 4)
+
+        response = self.add_review(self.book.id, 2)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data,
+            {"non_field_errors": ["User has already reviewed this book"]},
+        )
+        self.assertEqual(Review.objects.get(user=self.user).rating, 4)
+
+    def test_missing_book(self):
+        missing_id = self.book.id + 1000
+
+        response = self.add_review(missing_id, 4)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data,
+            {"book": [f'Invalid pk "{missing_id}" - object does not exist.']},
+        )
+        self.assertFalse(Review.objects.exists())
+
+    def test_rating_out_of_range(self):
+        response = self.add_review(self.book.id, 6)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {"rating": ["Rating must be between 1 and 5"]})
+        self.assertFalse(Review.objects.exists())
+
+    def test_rating_out_of_range_rejected_by_the_database(self):
+        # the rating_range constraint answers like the serializer would
+        with mock.patch(
+            "book.serializers.ReviewAddSerializer.validate_rating",
+            side_effect=lambda value: value,
+        ):
+            response = self.add_review(self.book.id, 0)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {"rating": ["Rating must be between 1 and 5"]})
+        self.assertFalse(Review.objects.exists())
+
+
+# ----------------------------------------------------------------
+# -------------------     BULK INGESTION         -----------------
+# ----------------------------------------------------------------
+
+
+class IngestReviewsTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.books = [create_book() for _ in range(3)]
+
+    def get_ratings(self):
+        return dict(
+            Review.objects.filter(user=self.user).values_list("book_id", "rating")
+        )
+
+    def test_created(self):
+        results = ingest_reviews(
+            self.user.id,
+            [
+                {"book": self.books[0].id, "rating": 4},
+                {"book": self.books[1].id, "rating": "2"},
+            ],
+        )
+
+        self.assertEqual([result["status"] for result in results], [CREATED, CREATED])
+        self.assertEqual(self.get_ratings(), {self.books[0].id: 4, self.books[1].id: 2})
+        self.assertEqual(
+            BookRatingAggregate.objects.get(book=self.books[0]).rating_sum, 4
+        )
+
+    def test_existing_review_fails_without_update_existing(self):
+        ingest_reviews(self.user.id, [{"book": self.books[0].id, "rating": 4}])
+
+        results = ingest_reviews(
+            self.user.id, [{"book": self.books[0].id, "rating": 2}]
+        )
+
+        self.assertEqual(results[0]["status"], FAILED)
+        self.assertEqual(results[0]["errors"], ["User has already reviewed this book"])
+        self.assertEqual(self.get_ratings(), {self.books[0].id: 4})
+
+    def test_update_existing(self):
+        ingest_reviews(
+            self.user.id,
+            [
+                {"book": self.books[0].id, "rating": 4},
+                {"book": self.books[1].id, "rating": 3},
+            ],
+        )
+
+        results = ingest_reviews(
+            self.user.id,
+            [
+                {"book": self.books[0].id, "rating": 1},
+                {"book": self.books[1].id, "rating": 3},
+                {"book": self.books[2].id, "rating": 5},
+            ],
+            update_existing=True,
+        )
+
+        self.assertEqual(
+            [result["status"] for result in results], [UPDATED, UNCHANGED, CREATED]
+        )
+        self.assertEqual(
+            self.get_ratings(),
+            {self.books[0].id: 1, self.books[1].id: 3, self.books[2].id: 5},
+        )
+        aggregate = BookRatingAggregate.objects.get(book=self.books[0])
+        self.assertEqual((aggregate.review_count, aggregate.rating_sum), (1, 1))
+
+    def test_invalid_rows(self):
+        results = ingest_reviews(
+            self.user.id,
+            [
+                {"book": self.books[0].id, "rating": 6},
+                {"book": "x", "rating": 3},
+                {"book": self.books[1].id, "rating": 2.5},
+                "not a row",
+                {"book": self.books[2].id, "rating": 3},
+                {"book": self.books[2].id, "rating": 4},
+            ],
+        )
+
+        self.assertEqual(
+            [result["status"] for result in results],
+            [FAILED, FAILED, FAILED, FAILED, CREATED, FAILED],
+        )
+        self.assertEqual(results[0]["errors"], ["Rating must be between 1 and 5"])
+        self.assertEqual(results[1]["errors"], ["A valid book id is required"])
+        self.assertEqual(results[2]["errors"], ["A valid integer rating is required"])
+        self.assertEqual(
+            results[3]["errors"], ["Each review must be an object with book and rating"]
+        )
+        self.assertEqual(
+            results[5]["errors"], ["This book appears more than once in the batch"]
+        )
+        self.assertEqual(self.get_ratings(), {self.books[2].id: 3})
+
+    def test_missing_book(self):
+        missing_id = self.books[-1].id + 1000
+
+        results = ingest_reviews(
+            self.user.id,
+            [
+                {"book": missing_id, "rating": 3},
+                {"book": self.books[0].id, "rating": 3},
+            ],
+        )
+
+        self.assertEqual([result["status"] for result in results], [FAILED, CREATED])
+        self.assertEqual(results[0]["errors"], ["There are no books with this id"])
+
+
+class ReviewBulkAddViewTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = get_client(self.user)
+        self.book = create_book()
+
+    def test_summary(self):
+        response = self.client.post(
+            reverse("book:review-bulk-add"),
+            {
+                "reviews": [
+                    {"book": self.book.id, "rating": 5},
+                    {"book": 0, "rating": 5},
+                ]
+            },
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {key: response.data[key] for key in (CREATED, UPDATED, UNCHANGED, FAILED)},
+            {CREATED: 1, UPDATED: 0, UNCHANGED: 0, FAILED: 1},
+        )
+
+    def test_too_many_rows(self):
+        rows = [{"book": self.book.id, "rating": 5}] * (
+            settings.REVIEW_BULK_MAX_ROWS + 1
+        )
+
+        response = self.client.post(
+            reverse("book:review-bulk-add"), {"reviews": rows}, format="json"
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("reviews", response.data)
+        self.assertFalse(Review.objects.exists())
+
+
+class ImportReviewsCommandTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.books = [create_book() for _ in range(3)]
+
+    def import_csv(self, content, *args):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as file:
+            file.write(content)
+            file.flush()
+            stdout, stderr = StringIO(), StringIO()
+            call_command(
+                "import_reviews",
+                file.name,
+                "--user-id",
+                str(self.user.id),
+                *args,
+                stdout=stdout,
+                stderr=stderr,
+            )
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import(self):
+        content = "book,rating\n{},4\n{},9\n{},2\n".format(
+            *[book.id for book in self.books]
+        )
+
+        stdout, stderr = self.import_csv(content, "--batch-size", "2")
+
+        self.assertIn("'created': 2", stdout)
+        self.assertIn("'failed': 1", stdout)
+        self.assertIn("line 3: Rating must be between 1 and 5", stderr)
+        self.assertEqual(
+            dict(Review.objects.values_list("book_id", "rating")),
+            {self.books[0].id: 4, self.books[2].id: 2},
+        )
+
+    def test_update_existing(self):
+        self.import_csv(f"book,rating\n{self.books[0].id},4\n")
+
+        stdout, _ = self.import_csv(
+            f"book,rating\n{self.books[0].id},1\n", "--update-existing"
+        )
+
+        self.assertIn("'updated': 1", stdout)
+        self.assertEqual(Review.objects.get(book=self.books[0]).rating, 1)
+
+    def test_missing_columns(self):
+        with self.assertRaises(CommandError):
+            self.import_csv("book,score\n1,4\n")
+
+
+# ----------------------------------------------------------------
+# -------------------     WRITE-BEHIND           -----------------
+# ----------------------------------------------------------------
+
+
+@override_settings(REVIEW_WRITE_CLAIM_IDLE=0, REVIEW_WRITE_MAX_DELIVERIES=3)
+class FlushReviewWritesTests(TestCase):
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self.redis.delete(REVIEW_WRITES_STREAM, REVIEW_WRITES_DEAD_LETTER_STREAM)
+        self.addCleanup(
+            self.redis.delete, REVIEW_WRITES_STREAM, REVIEW_WRITES_DEAD_LETTER_STREAM
+        )
+        self.user = create_user()
+        self.books = [create_book() for _ in range(2)]
+
+    def enqueue_poison_write(self):
+        # no rating, flush_review_batch fails on it whatever the batch is
+        write = {"write_id": "poison", "operation": ADD, "user_id": self.user.id}
+        write["book_id"] = self.books[1].id
+        self.redis.xadd(REVIEW_WRITES_STREAM, {"data": json.dumps(write)})
+
+    def test_flush(self):
+        write_id = enqueue_review_write(
+            ADD, self.user.id, book_id=self.books[0].id, rating=4
+        )
+
+        self.assertEqual(flush_review_writes(), 1)
+
+        self.assertEqual(get_write_status(write_id)["status"], "created")
+        self.assertEqual(Review.objects.get(user=self.user).rating, 4)
+        self.assertEqual(self.redis.xlen(REVIEW_WRITES_STREAM), 0)
+
+    def test_redelivered_committed_add_is_created(self):
+        write_id = enqueue_review_write(
+            ADD, self.user.id, book_id=self.books[0].id, rating=4
+        )
+
+        # the consumer dies between the commit and the acknowledgement
+        with mock.patch.object(
+            review_writes, "_acknowledge", side_effect=ConnectionError
+        ):
+            with self.assertLogs("book.review_writes", "ERROR"):
+                with self.assertRaises(ConnectionError):
+                    flush_review_writes()
+        self.assertEqual(get_write_status(write_id)["status"], "pending")
+
+        self.assertEqual(flush_review_writes(), 1)
+
+        review = Review.objects.get(user=self.user)
+        self.assertEqual(
+            get_write_status(write_id),
+            {"status": "created", "review_id": review.id, "user_id": self.user.id},
+        )
+        self.assertEqual(
+            BookRatingAggregate.objects.get(book=self.books[0]).review_count, 1
+        )
+
+    def test_fresh_duplicate_add_fails(self):
+        Review.objects.create(user=self.user, book=self.books[0], rating=4)
+        write_id = enqueue_review_write(
+            ADD, self.user.id, book_id=self.books[0].id, rating=4
+        )
+
+        self.assertEqual(flush_review_writes(), 1)
+
+        self.assertEqual(get_write_status(write_id)["status"], "failed")
+
+    def test_poison_batch(self):
+        write_id = enqueue_review_write(
+            ADD, self.user.id, book_id=self.books[0].id, rating=4
+        )
+        self.enqueue_poison_write()
+
+        # the whole batch is retried until it was delivered 3 times
+        for _ in range(2):
+            with self.assertLogs("book.review_writes", "ERROR"):
+                with self.assertRaises(KeyError):
+                    flush_review_writes()
+            self.assertEqual(get_write_status(write_id)["status"], "pending")
+
+        with self.assertLogs("book.review_writes", "ERROR") as logs:
+            self.assertEqual(flush_review_writes(), 2)
+        self.assertIn("moved to the dead letter stream", logs.output[-1])
+
+        self.assertEqual(get_write_status(write_id)["status"], "created")
+        self.assertEqual(Review.objects.get(user=self.user).rating, 4)
+
+        poison_status = get_write_status("poison")
+        self.assertEqual(poison_status["status"], "failed")
+        self.assertEqual(poison_status["http_status"], 500)
+
+        dead_letters = self.redis.xrange(REVIEW_WRITES_DEAD_LETTER_STREAM)
+        self.assertEqual(len(dead_letters), 1)
+        self.assertEqual(json.loads(dead_letters[0][1][b"data"])["write_id"], "poison")
+
+        self.assertEqual(self.redis.xlen(REVIEW_WRITES_STREAM), 0)
+        self.assertEqual(flush_review_writes(), 0)
+
+
+# ----------------------------------------------------------------
+# -------------------     LEADERBOARDS           -----------------
+# ----------------------------------------------------------------
+
+
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self.delete_boards()
+        self.addCleanup(self.delete_boards)
+
+    def delete_boards(self):
+        keys = self.redis.smembers(LEADERBOARDS_KEY)
+        self.redis.delete(LEADERBOARDS_KEY, LEADERBOARD_CHANGES_KEY, *keys)
+
+    def get_board(self, kind, value):
+        return {
+            int(book_id): score
+            for book_id, score in self.redis.zrange(
+                get_leaderboard_key(kind, value), 0, -1, withscores=True
+            )
+        }
+
+    @mock.patch("book.leaderboards.LEADERBOARD_READ_CHUNK_SIZE", 2)
+    def test_top_book_ids(self):
+        for value, book_ids in (("a", [1, 2]), ("b", [3]), ("c", [4, 5]), ("d", [6])):
+            key = get_leaderboard_key("genre", value)
+            self.redis.zadd(key, {book_id: 10 - book_id for book_id in book_ids})
+            self.redis.sadd(LEADERBOARDS_KEY, key)
+
+        with mock.patch(
+            "book.leaderboards.get_leaderboard_book_ids",
+            wraps=get_leaderboard_book_ids,
+        ) as read_boards:
+            book_ids = get_top_book_ids("genre", ["a", "b", "c", "a", "d", "e"], 4)
+
+        self.assertEqual(book_ids, [1, 2, 3, 4])
+        # the second chunk asks for the missing id only, e is never read
+        self.assertEqual(
+            read_boards.call_args_list,
+            [mock.call("genre", ["a", "b"], 4), mock.call("genre", ["c", "d"], 1)],
+        )
+
+    def test_top_book_ids_of_short_boards(self):
+        key = get_leaderboard_key("genre", "a")
+        self.redis.zadd(key, {1: 1})
+        self.redis.sadd(LEADERBOARDS_KEY, key)
+
+        self.assertEqual(get_top_book_ids("genre", ["a", "missing"], 4), [1])
+        self.assertEqual(get_top_book_ids("genre", [], 4), [])
+
+    def test_edited_book_moves_to_its_new_boards(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            book = create_book(genre="fantasy", author="tolkien")
+        BookRatingAggregate.objects.create(
+            book=book, review_count=1, rating_sum=4, average_rating=4.0
+        )
+
+        book.genre = "horror"
+        with self.captureOnCommitCallbacks(execute=True):
+            book.save()
+
+        self.assertEqual(self.get_board("genre", "fantasy"), {})
+        self.assertEqual(self.get_board("genre", "horror"), {book.id: 4.0})
+        self.assertEqual(self.get_board("author", "tolkien"), {book.id: 0.0})
+
+        book.author = "king"
+        with self.captureOnCommitCallbacks(execute=True):
+            book.save()
+
+        self.assertEqual(self.get_board("author", "tolkien"), {})
+        self.assertEqual(self.get_board("author", "king"), {book.id: 4.0})
+        self.assertEqual(self.get_board("genre", "horror"), {book.id: 4.0})
+
+    @mock.patch("book.leaderboards.LEADERBOARD_REBUILD_CHUNK_SIZE", 1)
+    def test_rebuild(self):
+        books = [
+            create_book(genre="fantasy", author="tolkien"),
+            create_book(genre="fantasy", author="martin"),
+        ]
+        BookRatingAggregate.objects.create(
+            book=books[0], review_count=1, rating_sum=4, average_rating=4.0
+        )
+        stale_key = get_leaderboard_key("genre", "horror")
+        self.redis.zadd(stale_key, {books[1].id: 1})
+        self.redis.sadd(LEADERBOARDS_KEY, stale_key)
+
+        self.assertEqual(rebuild_leaderboards(), 2)
+
+        self.assertEqual(
+            self.get_board("genre", "fantasy"), {books[0].id: 4.0, books[1].id: 0.0}
+        )
+        self.assertEqual(self.get_board("author", "tolkien"), {books[0].id: 4.0})
+        self.assertEqual(self.get_board("author", "martin"), {books[1].id: 0.0})
+        self.assertFalse(self.redis.exists(stale_key))
+        self.assertEqual(
+            {key.decode() for key in self.redis.smembers(LEADERBOARDS_KEY)},
+            {
+                get_leaderboard_key("genre", "fantasy"),
+                get_leaderboard_key("author", "tolkien"),
+                get_leaderboard_key("author", "martin"),
+            },
+        )
+
+    def test_rebuild_keeps_the_changes_made_while_it_runs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            books = [
+                create_book(genre="fantasy", author="tolkien"),
+                create_book(genre="fantasy", author="martin"),
+            ]
+        build_boards = leaderboards._build_boards
+
+        def build_then_write(*args):
+            built = build_boards(*args)
+
+            BookRatingAggregate.objects.create(
+                book=books[0], review_count=1, rating_sum=5, average_rating=5.0
+            )
+            leaderboards.update_leaderboards({books[0].id: 5.0})
+            books[1].genre = "horror"
+            with self.captureOnCommitCallbacks(execute=True):
+                books[1].save()
+                self.new_book = create_book(genre="poetry", author="rumi")
+
+            return built
+
+        with mock.patch.object(
+            leaderboards, "_build_boards", side_effect=build_then_write
+        ):
+            self.assertEqual(rebuild_leaderboards(), 2)
+
+        self.assertEqual(self.get_board("genre", "fantasy"), {books[0].id: 5.0})
+        self.assertEqual(self.get_board("genre", "horror"), {books[1].id: 0.0})
+        self.assertEqual(self.get_board("genre", "poetry"), {self.new_book.id: 0.0})
+        self.assertEqual(self.get_board("author", "tolkien"), {books[0].id: 5.0})
+
+
+# ----------------------------------------------------------------
+# -------------------     READ REPLICA           -----------------
+# ----------------------------------------------------------------
+
+
+@override_settings(DB_READ_ALIAS="replica")
+class ReadRoutingTests(TestCase):
+    # the test database is never replicated, the routing decisions are
+    # checked instead and a read sent to the missing "replica" alias fails
+
+    def setUp(self):
+        self.user = create_user()
+        self.addCleanup(cache.delete, get_read_your_writes_key(self.user.id))
+
+    def outside_primary_transaction(self):
+        # every TestCase runs in a transaction of the primary
+        return mock.patch("book.replicas.in_primary_transaction", return_value=False)
+
+    def test_reads_go_to_the_replica(self):
+        router = ReplicaRouter()
+
+        with self.outside_primary_transaction():
+            self.assertEqual(get_read_alias(self.user.id), "replica")
+            self.assertEqual(router.db_for_read(Book), "replica")
+
+        self.assertEqual(router.db_for_read(User), "default")
+        self.assertEqual(router.db_for_write(Book), "default")
+
+    def test_reads_in_a_transaction_of_the_primary_go_to_the_primary(self):
+        self.assertEqual(get_read_alias(self.user.id), "default")
+        self.assertEqual(ReplicaRouter().db_for_read(Book), "default")
+
+    def test_pin_to_primary_after_a_write(self):
+        other = create_user()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pin_to_primary(self.user.id)
+
+        with self.outside_primary_transaction():
+            self.assertEqual(get_read_alias(self.user.id), "default")
+            self.assertEqual(get_read_alias(other.id, self.user.id), "default")
+            self.assertEqual(get_read_alias(other.id), "replica")
+
+    def test_use_read_alias(self):
+        with self.outside_primary_transaction():
+            with use_read_alias("default") as read_connection:
+                self.assertEqual(read_connection.alias, "default")
+                self.assertEqual(get_read_alias(self.user.id), "default")
+                self.assertEqual(ReplicaRouter().db_for_read(Book), "default")
+
+            self.assertEqual(get_read_alias(self.user.id), "replica")
+
+    def test_book_signals_read_the_primary(self):
+        book = create_book(genre="fantasy", author="tolkien")
+        Review.objects.create(user=self.user, book=book, rating=4)
+
+        book.genre = "horror"
+        with self.outside_primary_transaction():
+            book.save()
+
+        self.assertEqual(
+            list(
+                UserGenreTaste.objects.filter(user=self.user).values_list(
+                    "genre", "rating_sum", "review_count"
+                )
+            ),
+            [("horror", 4, 1)],
+        )
+
+
+# ----------------------------------------------------------------
+# -------------------     SUGGESTION LISTS       -----------------
+# ----------------------------------------------------------------
+
+
+class PackedSuggestionsTests(SimpleTestCase):
+    def test_round_trip(self):
+        recom_ids = {"genre": [3, 1, 2], "author": [], "similar_user": [2**31 - 1]}
+
+        self.assertEqual(unpack_suggestions(pack_suggestions(recom_ids)), recom_ids)
+
+    def test_packs_the_ids_of_books(self):
+        packed = pack_suggestions({"genre": [{"id": 5, "title": "book"}, 6]})
+
+        self.assertEqual(unpack_suggestions(packed), {"genre": [5, 6]})
+
+    def test_empty_lists(self):
+        self.assertEqual(unpack_suggestions(pack_suggestions({})), {})
+        self.assertEqual(
+            unpack_suggestions(pack_suggestions({"genre": [], "author": []})),
+            {"genre": [], "author": []},
+        )
+
+    def test_services_are_packed_by_their_factory_index(self):
+        service_types = BookRecommendationServiceFactory.service_types
+        recom_ids = {
+            service_name: [index]
+            for index, service_name in reversed(list(enumerate(service_types)))
+        }
+
+        packed = pack_suggestions(recom_ids)
+
+        offsets = range(
+            PACKED_HEADER.size,
+            PACKED_HEADER.size + PACKED_SERVICE.size * len(service_types),
+            PACKED_SERVICE.size,
+        )
+        self.assertEqual(
+            [PACKED_SERVICE.unpack_from(packed, offset)[0] for offset in offsets],
+            list(reversed(range(len(service_types)))),
+        )
+        self.assertEqual(unpack_suggestions(packed), recom_ids)
+
+    def test_reads_the_legacy_book_dicts(self):
+        legacy = {"genre": [{"id": 1, "title": "a"}, {"id": 2}], "author": []}
+
+        self.assertEqual(unpack_suggestions(legacy), {"genre": [1, 2], "author": []})
+
+
+class RefreshSuggestionSlicesTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.key = get_suggestion_cache_key(self.user.id)
+        self.addCleanup(cache.delete, self.key)
+
+    def test_keeps_the_other_slices_and_the_ttl(self):
+        cache.set(self.key, pack_suggestions({"genre": [1], "similar_user": [3]}), 100)
+
+        with mock.patch("book.suggestions.get_service_books", return_value=[7, 8]):
+            self.assertTrue(refresh_suggestion_slices(self.user.id, ["genre"]))
+
+        self.assertEqual(
+            unpack_suggestions(cache.get(self.key)),
+            {"genre": [7, 8], "similar_user": [3]},
+        )
+        self.assertTrue(0 < cache.ttl(self.key) <= 100)
+
+    def test_retries_on_a_concurrent_write(self):
+        cache.set(self.key, pack_suggestions({"genre": [1], "similar_user": [3]}), 100)
+
+        def write_once(service_name, user_id, num_items):
+            if write_once.calls == 0:
+                cache.set(
+                    self.key,
+                    pack_suggestions({"genre": [], "similar_user": [9]}),
+                    100,
+                )
+            write_once.calls += 1
+            return [7]
+
+        write_once.calls = 0
+        with mock.patch("book.suggestions.get_service_books", write_once):
+            self.assertTrue(refresh_suggestion_slices(self.user.id, ["genre"]))
+
+        self.assertEqual(write_once.calls, 2)
+        self.assertEqual(
+            unpack_suggestions(cache.get(self.key)),
+            {"genre": [7], "similar_user": [9]},
+        )
+
+    def test_leaves_a_missing_list_alone(self):
+        with mock.patch("book.suggestions.get_service_books") as get_service_books:
+            self.assertFalse(refresh_suggestion_slices(self.user.id, ["genre"]))
+
+        get_service_books.assert_not_called()
+        self.assertIsNone(cache.get(self.key))
+
+
+class RefreshUserSuggestionsTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.key = get_suggestion_cache_key(self.user.id)
+        self.addCleanup(cache.delete, self.key)
+        self.redis = get_redis_connection("default")
+        self.addCleanup(self.redis.srem, DIRTY_USERS_KEY, self.user.id)
+
+    def test_weights_count_the_review_before_the_refresh(self):
+        books = [create_book() for _ in range(3)]
+        cache.set(
+            self.key,
+            pack_suggestions(
+                {"genre": [books[0].id], "author": [books[1].id], "similar_user": []}
+            ),
+            100,
+        )
+        Review.objects.create(user=self.user, book=books[0], rating=5)
+        self.redis.sadd(DIRTY_USERS_KEY, self.user.id)
+
+        with mock.patch(
+            "book.suggestions.get_service_books", return_value=[books[2].id]
+        ):
+            self.assertTrue(refresh_user_suggestions(self.user.id))
+
+        preference = UserRecommendationPreference.objects.get(user=self.user)
+        self.assertEqual(preference.genre_weight, 100)
+        self.assertEqual(preference.author_weight, 0)
+        self.assertFalse(self.redis.sismember(DIRTY_USERS_KEY, self.user.id))
+        self.assertEqual(
+            unpack_suggestions(cache.get(self.key)),
+            {"genre": [books[2].id], "author": [books[2].id], "similar_user": []},
+        )
+
+
+@override_settings(SUGGESTION_PRECOMPUTE_CHUNK_SIZE=2)
+class PrecomputeSuggestionsTests(TestCase):
+    def setUp(self):
+        redis = get_redis_connection("default")
+        self.addCleanup(
+            lambda: redis.delete(LEADERBOARDS_KEY, *redis.smembers(LEADERBOARDS_KEY))
+        )
+
+        books = [
+            create_book(genre=genre, author=author)
+            for genre, author in (
+                ("fantasy", "tolkien"),
+                ("fantasy", "martin"),
+                ("horror", "king"),
+                ("horror", "martin"),
+            )
+        ]
+        self.users = [create_user() for _ in range(4)]
+        for user, ratings in zip(
+            self.users, ((5, None, 3, None), (2, 4, 5, 1), (5, 4, None, 2), ())
+        ):
+            for book, rating in zip(books, ratings):
+                if rating is not None:
+                    Review.objects.create(user=user, book=book, rating=rating)
+        for user in self.users:
+            self.addCleanup(cache.delete, get_suggestion_cache_key(user.id))
+
+        # two books per service for the first user, ten for the others
+        UserRecommendationPreference.objects.update_or_create(
+            user=self.users[0],
+            defaults={
+                "genre_weight": 20,
+                "author_weight": 20,
+                "similar_user_weight": 20,
+            },
+        )
+        User.objects.filter(id=self.users[2].id).update(
+            last_login=timezone.now() - timedelta(days=30)
+        )
+        User.objects.exclude(id=self.users[2].id).update(last_login=timezone.now())
+        rebuild_leaderboards()
+
+    def get_cached_ids(self, user):
+        packed = cache.get(get_suggestion_cache_key(user.id))
+        return None if packed is None else unpack_suggestions(packed)
+
+    def test_caches_the_lists_of_the_reviewers(self):
+        result = precompute_suggestions()
+
+        self.assertEqual(result["users"], 3)
+        self.assertEqual(result["chunks"], 2)
+        for user, num_items in zip(self.users[:3], (2, 10, 10)):
+            self.assertEqual(
+                self.get_cached_ids(user),
+                {
+                    service_name: [
+                        book["id"]
+                        for book in BookRecommendationServiceFactory.create_service(
+                            service_name
+                        ).get_recommended_books(user.id, num_items)
+                    ]
+                    for service_name in SUGGESTION_SERVICES
+                },
+            )
+        self.assertIsNone(self.get_cached_ids(self.users[3]))
+
+    def test_active_days(self):
+        result = precompute_suggestions(active_days=7)
+
+        self.assertEqual(result["users"], 2)
+        self.assertIsNone(self.get_cached_ids(self.users[2]))
+        self.assertIsNotNone(self.get_cached_ids(self.users[1]))
+
+
+@override_settings(BOOK_SUGGEST_SERVICE_TIMEOUT=0.2)
+class FetchSuggestionsParallelTests(SimpleTestCase):
+    def fetch(self, fetch_books):
+        with mock.patch("book.suggestions._fetch_books", fetch_books):
+            return fetch_suggestions_parallel(
+                1, {"genre": 20, "author": 30, "similar_user": 50}
+            )
+
+    def test_runs_every_service_with_its_num_items(self):
+        recom_perf, complete = self.fetch(
+            lambda service_name, user_id, num_items, timeout: [num_items]
+        )
+
+        self.assertTrue(complete)
+        self.assertEqual(recom_perf, {"genre": [2], "author": [3], "similar_user": [5]})
+
+    def test_drops_a_failed_and_a_slow_service(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def fetch_books(service_name, user_id, num_items, timeout):
+            if service_name == "author":
+                raise RuntimeError("boom")
+            if service_name == "similar_user":
+                release.wait(5)
+            return [num_items]
+
+        with self.assertLogs("book.suggestions") as logs:
+            recom_perf, complete = self.fetch(fetch_books)
+
+        self.assertFalse(complete)
+        self.assertEqual(recom_perf, {"genre": [2], "author": [], "similar_user": []})
+        self.assertIn("failed: boom", logs.output[0])
+        self.assertIn("timed out", logs.output[1])
+
+
+@override_settings(BOOK_SUGGEST_PARALLEL=True)
+class BookSuggestViewParallelTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.book = create_book()
+        Review.objects.create(user=self.user, book=create_book(), rating=5)
+        self.key = get_suggestion_cache_key(self.user.id)
+        cache.delete(self.key)
+        self.addCleanup(cache.delete, self.key)
+
+    def suggest(self, recom_perf, complete):
+        with mock.patch(
+            "book.views.fetch_suggestions_parallel",
+            return_value=(recom_perf, complete),
+        ):
+            return get_client(self.user).get(reverse("book:book-suggest"))
+
+    def test_caches_a_complete_list(self):
+        book = {"id": self.book.id, "title": "t", "author": "a", "genre": "g"}
+
+        response = self.suggest(
+            {"genre": [book], "author": [], "similar_user": []}, True
+        )
+
+        self.assertEqual(response.data, [book])
+        self.assertEqual(
+            unpack_suggestions(cache.get(self.key)),
+            {"genre": [self.book.id], "author": [], "similar_user": []},
+        )
+
+    def test_does_not_cache_a_partial_list(self):
+        book = {"id": self.book.id, "title": "t", "author": "a", "genre": "g"}
+
+        response = self.suggest(
+            {"genre": [book], "author": [], "similar_user": []}, False
+        )
+
+        self.assertEqual(response.data, [book])
+        self.assertIsNone(cache.get(self.key))
+
+
+# ----------------------------------------------------------------
+# -------------------     BATCH SUGGESTIONS      -----------------
+# ----------------------------------------------------------------
+
+
+class BatchSuggestionsTests(TestCase):
+    def setUp(self):
+        redis = get_redis_connection("default")
+        self.addCleanup(
+            lambda: redis.delete(
+                LEADERBOARDS_KEY,
+                POPULAR_BOOKS_KEY,
+                POPULAR_GENRES_KEY,
+                *redis.smembers(LEADERBOARDS_KEY),
+                *[
+                    get_popular_books_key(genre.decode())
+                    for genre in redis.smembers(POPULAR_GENRES_KEY)
+                ],
+            )
+        )
+
+        books = [
+            create_book(genre=genre, author=author)
+            for genre, author in (
+                ("fantasy", "tolkien"),
+                ("fantasy", "tolkien"),
+                ("fantasy", "martin"),
+                ("horror", "king"),
+                ("horror", "king"),
+                ("horror", "martin"),
+            )
+        ]
+        self.users = [create_user() for _ in range(4)]
+        for user, ratings in zip(
+            self.users,
+            (
+                (5, None, None, 3, None, 4),
+                (2, 4, 5, 1, 3, 5),
+                (5, 4, None, None, 2, None),
+                # the last user has no review and gets the fallbacks
+                (),
+            ),
+        ):
+            for book, rating in zip(books, ratings):
+                if rating is not None:
+                    Review.objects.create(user=user, book=book, rating=rating)
+
+        rebuild_leaderboards()
+        refresh_popular_books()
+        build_item_similarity()
+
+    def test_batch_matches_the_single_user_services(self):
+        user_ids = [user.id for user in self.users]
+
+        for service_type in BookRecommendationServiceFactory.service_types:
+            service = BookRecommendationServiceFactory.create_service(service_type)
+            for num_items in (1, 3, 10):
+                batch = service.get_recommended_books_batch(user_ids, num_items)
+                for user_id in user_ids:
+                    self.assertEqual(
+                        [book["id"] for book in batch[user_id]],
+                        [
+                            book["id"]
+                            for book in service.get_recommended_books(
+                                user_id, num_items
+                            )
+                        ],
+                        (service_type, num_items, user_id),
+                    )
+
+    def test_view(self):
+        admin = create_user()
+        admin.is_admin = True
+        admin.save()
+        user_id = self.users[0].id
+
+        response = get_client(admin).post(
+            reverse("book:book-suggest-batch"),
+            {"user_ids": [user_id, user_id], "services": ["genre"], "num_items": 2},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.data,
+            {
+                user_id: {
+                    "genre": GenreBookRecommendationService().get_recommended_books(
+                        user_id, 2
+                    )
+                }
+            },
+        )
+
+    def test_view_is_admin_only(self):
+        response = get_client(self.users[0]).post(
+            reverse("book:book-suggest-batch"),
+            {"user_ids": [self.users[0].id]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 403)
+
+
+# ----------------------------------------------------------------
+# -------------------     POPULAR BOOKS          -----------------
+# ----------------------------------------------------------------
+
+
+@override_settings(POPULAR_BOOKS_TOP_N=2, POPULAR_BOOKS_PRIOR_COUNT=None)
+class PopularBooksTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [create_user() for _ in range(6)]
+        # one 5 against many 4s and 5s
+        cls.lucky = create_book(genre="fantasy")
+        cls.loved = create_book(genre="fantasy")
+        cls.liked = create_book(genre="horror")
+        cls.unreviewed = create_book(genre="horror")
+        Review.objects.create(user=cls.users[0], book=cls.lucky, rating=5)
+        for user, rating in zip(cls.users, (5, 5, 5, 5, 5, 4)):
+            Review.objects.create(user=user, book=cls.loved, rating=rating)
+        for user in cls.users[:4]:
+            Review.objects.create(user=user, book=cls.liked, rating=4)
+
+    def setUp(self):
+        redis = get_redis_connection("default")
+        self.addCleanup(
+            lambda: redis.delete(
+                POPULAR_BOOKS_KEY,
+                POPULAR_GENRES_KEY,
+                *[
+                    get_popular_books_key(genre.decode())
+                    for genre in redis.smembers(POPULAR_GENRES_KEY)
+                ],
+            )
+        )
+
+    def test_bayesian_average(self):
+        self.assertEqual(refresh_popular_books(), 3)
+
+        # the prior is the mean rating weighing as much as the mean number of
+        # reviews of a reviewed book
+        ratings = {
+            book_id: list(
+                Review.objects.filter(book_id=book_id).values_list("rating", flat=True)
+            )
+            for book_id in (self.lucky.id, self.loved.id, self.liked.id)
+        }
+        prior_count = sum(map(len, ratings.values())) / len(ratings)
+        mean = sum(map(sum, ratings.values())) / sum(map(len, ratings.values()))
+        scores = {
+            book_id: (prior_count * mean + sum(values)) / (prior_count + len(values))
+            for book_id, values in ratings.items()
+        }
+        expected = sorted(scores, key=scores.get, reverse=True)[:2]
+        self.assertEqual(expected, [self.loved.id, self.lucky.id])
+        self.assertEqual(get_popular_book_ids(10), expected)
+        self.assertEqual(get_popular_book_ids(1), expected[:1])
+        self.assertEqual(
+            get_popular_book_ids(10, "fantasy"), [self.loved.id, self.lucky.id]
+        )
+        self.assertEqual(get_popular_book_ids(10, "horror"), [self.liked.id])
+
+    @override_settings(POPULAR_BOOKS_PRIOR_COUNT=0)
+    def test_no_prior_ranks_by_plain_average(self):
+        refresh_popular_books()
+
+        self.assertEqual(get_popular_book_ids(10), [self.lucky.id, self.loved.id])
+
+    def test_refresh_drops_the_emptied_genres(self):
+        refresh_popular_books()
+        Review.objects.filter(book=self.liked).delete()
+
+        refresh_popular_books()
+
+        self.assertEqual(get_popular_book_ids(10, "horror"), [])
+        self.assertNotIn(
+            b"horror", get_redis_connection("default").smembers(POPULAR_GENRES_KEY)
+        )
+
+    def test_service_leaves_out_the_reviewed_books(self):
+        refresh_popular_books()
+
+        books = PopularBookRecommendationService().get_recommended_books(
+            self.users[5].id, 10
+        )
+
+        self.assertEqual([book["id"] for book in books], [self.lucky.id])
+
+    def test_cold_start_suggestions(self):
+        refresh_popular_books()
+
+        response = get_client(create_user()).get(reverse("book:book-suggest"))
+
+        self.assertEqual(
+            [book["id"] for book in response.data], [self.loved.id, self.lucky.id]
+        )
+
+
+# ----------------------------------------------------------------
+# -------------------     ENGINE                 -----------------
+# ----------------------------------------------------------------
+
+
+class GetEngineTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(engine, "_engine", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_loads_the_first_engine(self):
+        first = mock.Mock(**{"is_expired.return_value": False})
+        with mock.patch.object(
+            engine.RecommendationEngine, "load", return_value=first
+        ) as load:
+            self.assertIs(engine.get_engine(), first)
+            self.assertIs(engine.get_engine(), first)
+
+        load.assert_called_once_with()
+
+    def test_serves_the_old_engine_while_reloading(self):
+        old = mock.Mock(**{"is_expired.return_value": True})
+        new = mock.Mock(**{"is_expired.return_value": False})
+        engine._engine = old
+        loading = threading.Event()
+
+        def load():
+            loading.wait(5)
+            return new
+
+        with mock.patch.object(engine.RecommendationEngine, "load", side_effect=load):
+            # one reload at a time, the requests are answered meanwhile
+            self.assertIs(engine.get_engine(), old)
+            self.assertIs(engine.get_engine(), old)
+
+            loading.set()
+            self.assertTrue(engine._reload_lock.acquire(timeout=5))
+            engine._reload_lock.release()
+
+        self.assertIs(engine.get_engine(), new)
+
+
+class EngineParityTests(TestCase):
+    def setUp(self):
+        redis = get_redis_connection("default")
+        self.addCleanup(
+            lambda: redis.delete(LEADERBOARDS_KEY, *redis.smembers(LEADERBOARDS_KEY))
+        )
+        self.user = create_user()
+
+        books = [
+            create_book(genre=genre, author=author)
+            for genre, author in (
+                ("fantasy", "tolkien"),
+                ("fantasy", "tolkien"),
+                ("fantasy", "martin"),
+                ("horror", "king"),
+                ("horror", "king"),
+                ("horror", "martin"),
+            )
+        ]
+        self.review(self.user, books[0], 5)
+        self.review(self.user, books[3], 3)
+        self.review(self.user, books[5], 4)
+        other = create_user()
+        for book, rating in zip(books, (2, 4, 5, 1, 3, 5)):
+            if not Review.objects.filter(book=book, user=other).exists():
+                self.review(other, book, rating)
+
+    def review(self, user, book, rating):
+        response = get_client(user).post(
+            reverse("book:review-add"),
+            {"book": book.id, "rating": rating},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+
+    def test_engine_ranks_like_the_leaderboard_services(self):
+        rebuild_leaderboards()
+        loaded = engine.RecommendationEngine.load()
+
+        for service_type, service in (
+            ("genre", GenreBookRecommendationService()),
+            ("author", AuthorBookRecommendationService()),
+        ):
+            for num_items in (1, 4, 10):
+                engine_books = loaded.recommend(service_type, self.user.id, num_items)
+                service_books = service.get_recommended_books(self.user.id, num_items)
+                self.assertEqual(
+                    [book["id"] for book in engine_books],
+                    [book["id"] for book in service_books],
+                )
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        # a version no key of a previous run can have
+        cache.delete(CATALOG_VERSION_KEY)
+        self.client = get_client(create_user())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book = create_book(genre="fantasy")
+
+    def get_genres(self):
+        return sorted(self.client.get(reverse("book:book-list-genre")).data)
+
+    def get_genre_page(self, genre):
+        response = self.client.get(reverse("book:book-filter", args=[genre]))
+        return [book["id"] for book in response.data["results"]]
+
+    def test_pages_are_cached_under_the_version(self):
+        self.assertEqual(self.get_genres(), ["fantasy"])
+        self.assertEqual(self.get_genre_page("fantasy"), [self.book.id])
+
+        # written around the signals, the cached pages are still served
+        Book.objects.bulk_create([Book(title="hidden", author="a", genre="horror")])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_genres(), ["fantasy"])
+            self.assertEqual(self.get_genre_page("fantasy"), [self.book.id])
+
+    def test_book_change_moves_to_a_new_version(self):
+        self.get_genres()
+        self.get_genre_page("fantasy")
+        version = cache.get(CATALOG_VERSION_KEY)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            book = create_book(genre="horror")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.genre = "horror"
+            self.book.save()
+
+        self.assertGreater(cache.get(CATALOG_VERSION_KEY), version)
+        self.assertEqual(self.get_genres(), ["horror"])
+        self.assertEqual(self.get_genre_page("fantasy"), [])
+        self.assertEqual(self.get_genre_page("horror"), [self.book.id, book.id])
+
+    def test_evicted_version(self):
+        version, _ = get_catalog_state()
+        cache.delete(CATALOG_VERSION_KEY)
+
+        # what incr raises for a missing key with Redis, the test server runs
+        # no Lua scripts
+        with mock.patch.object(cache, "incr", side_effect=ValueError):
+            bump_catalog_version()
+
+        self.assertGreater(cache.get(CATALOG_VERSION_KEY), version)
+        self.assertNotEqual(
+            get_catalog_cache_key(version, "genres"),
+            get_catalog_cache_key(cache.get(CATALOG_VERSION_KEY), "genres"),
+        )
+
+
+class HydrationTests(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books = [create_book(author=f"author{i}") for i in range(3)]
+        self.book_ids = [book.id for book in self.books]
+
+    def test_misses_are_read_with_one_query_and_cached(self):
+        with self.assertNumQueries(1):
+            books = hydrate_books(self.book_ids[::-1])
+
+        self.assertEqual([book["id"] for book in books], self.book_ids[::-1])
+        self.assertEqual(books[0]["author"], "author2")
+
+        with self.assertNumQueries(0), mock.patch.object(
+            cache, "get_many", wraps=cache.get_many
+        ) as get_many:
+            self.assertEqual(hydrate_books(self.book_ids[::-1]), books)
+        get_many.assert_called_once()
+
+    def test_partial_hit(self):
+        hydrate_books(self.book_ids[:1])
+
+        with CaptureQueriesContext(connection) as queries:
+            books = get_books(self.book_ids)
+
+        self.assertEqual(set(books), set(self.book_ids))
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn(str(self.book_ids[0]), queries[0]["sql"])
+
+    def test_changed_and_deleted_books_are_forgotten(self):
+        hydrate_books(self.book_ids)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books[0].title = "renamed"
+            self.books[0].save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books[1].delete()
+
+        books = hydrate_books(self.book_ids)
+
+        self.assertEqual(
+            [book["id"] for book in books], [self.book_ids[0], self.book_ids[2]]
+        )
+        self.assertEqual(books[0]["title"], "renamed")
+
+
+# ----------------------------------------------------------------
+# -------------------     TWO-TIER CACHE         -----------------
+# ----------------------------------------------------------------
+
+
+class LocalLRUCacheTests(SimpleTestCase):
+    def test_bounded_by_entries_and_bytes(self):
+        local = LocalLRUCache(max_entries=2, max_bytes=10, ttl=60)
+        local.set("a", 1, 4, local.generation)
+        local.set("b", 2, 4, local.generation)
+        local.get("a")
+        local.set("c", 3, 4, local.generation)
+
+        # b was the least recently used
+        self.assertEqual([local.get(key) for key in "ac"], [1, 3])
+        self.assertIs(local.get("b"), cache_module._missing)
+
+        local.set("d", 4, 6, local.generation)
+        self.assertEqual(list(local.entries), ["c", "d"])
+        local.set("e", 5, 11, local.generation)
+        self.assertIs(local.get("e"), cache_module._missing)
+
+    def test_ttl(self):
+        local = LocalLRUCache(max_entries=2, max_bytes=10, ttl=0)
+        local.set("a", 1, 1, local.generation)
+
+        self.assertIs(local.get("a"), cache_module._missing)
+        self.assertEqual(local.size, 0)
+
+    def test_value_read_before_an_invalidation_is_not_stored(self):
+        local = LocalLRUCache(max_entries=2, max_bytes=10, ttl=60)
+        generation = local.generation
+        local.delete_many(["a"])
+
+        local.set("a", "old", 3, generation)
+
+        self.assertIs(local.get("a"), cache_module._missing)
+
+
+class TwoTierCacheTests(SimpleTestCase):
+    key = "Catalog_two_tier_test"
+
+    def setUp(self):
+        if not hasattr(cache.client, "local_tier"):
+            self.skipTest("CACHE_LOCAL is off")
+        self.tier = cache.client.local_tier
+        self.assertTrue(self.tier.subscribed.wait(5))
+        self.redis = get_redis_connection("default")
+        self.made_key = cache.make_key(self.key)
+        self.addCleanup(cache.delete, self.key)
+
+    def publish_from_other_process(self, keys):
+        self.redis.publish(
+            INVALIDATION_CHANNEL, json.dumps({"sender": "other", "keys": keys})
+        )
+
+    def wait_until_dropped(self):
+        for _ in range(50):
+            if self.tier.cache.get(self.made_key) is cache_module._missing:
+                return
+            time.sleep(0.05)
+        self.fail("the local copy was not dropped")
+
+    def test_local_copy_until_invalidated(self):
+        cache.set(self.key, "old")
+        self.assertEqual(cache.get(self.key), "old")
+
+        # written around the client, the local copy is served
+        self.redis.set(self.made_key, cache.client.encode("new"))
+        self.assertEqual(cache.get(self.key), "old")
+
+        self.publish_from_other_process([self.made_key])
+        self.wait_until_dropped()
+        self.assertEqual(cache.get(self.key), "new")
+
+    def test_invalidate_all(self):
+        cache.set(self.key, "old")
+        cache.get(self.key)
+
+        self.publish_from_other_process(None)
+
+        self.wait_until_dropped()
+
+    def test_writes_drop_the_local_copy(self):
+        cache.set(self.key, 1)
+        cache.get(self.key)
+
+        cache.set(self.key, 2)
+        self.assertEqual(cache.get(self.key), 2)
+
+        cache.delete(self.key)
+        self.assertIsNone(cache.get(self.key))
+
+    def test_other_keys_stay_in_redis_only(self):
+        cache.set("two_tier_remote_test", 1)
+        self.addCleanup(cache.delete, "two_tier_remote_test")
+        cache.get("two_tier_remote_test")
+
+        self.assertIs(
+            self.tier.cache.get(cache.make_key("two_tier_remote_test")),
+            cache_module._missing,
+        )
+
+
+# ----------------------------------------------------------------
+# -------------------     ITEM SIMILARITY        -----------------
+# ----------------------------------------------------------------
+
+
+@override_settings(
+    ITEM_SIMILARITY_TOP_K=2, ITEM_SIMILARITY_MIN_SUPPORT=2, ITEM_SIMILARITY_BATCH_SIZE=2
+)
+class ItemSimilarityTests(TestCase):
+    ratings = [
+        [5, 4, 1, None, 2],
+        [4, 5, None, 2, 1],
+        [1, None, 5, 4, 5],
+        [5, 5, 2, 1, None],
+    ]
+
+    def setUp(self):
+        self.users = [create_user() for _ in self.ratings]
+        self.books = [create_book() for _ in self.ratings[0]]
+        for user, ratings in zip(self.users, self.ratings):
+            for book, rating in zip(self.books, ratings):
+                if rating is not None:
+                    Review.objects.create(user=user, book=book, rating=rating)
+
+    def get_expected_neighbors(self):
+        columns = {
+            book.id: [ratings[i] for ratings in self.ratings]
+            for i, book in enumerate(self.books)
+        }
+        norms = {
+            book_id: sum(r * r for r in column if r is not None) ** 0.5
+            for book_id, column in columns.items()
+        }
+
+        expected = {}
+        for book_id, column in columns.items():
+            scores = []
+            for neighbor_id, other in columns.items():
+                pairs = [
+                    (a, b)
+                    for a, b in zip(column, other)
+                    if a is not None and b is not None
+                ]
+                if neighbor_id == book_id or len(pairs) < 2:
+                    continue
+                dot = sum(a * b for a, b in pairs)
+                scores.append(
+                    (-dot / (norms[book_id] * norms[neighbor_id]), neighbor_id)
+                )
+            expected[book_id] = [
+                (neighbor_id, round(-score, 9))
+                for score, neighbor_id in sorted(scores)[:2]
+            ]
+        return expected
+
+    def test_build_keeps_the_top_k_neighbors(self):
+        build_item_similarity()
+
+        neighbors = {}
+        for book_id, neighbor_id, score in BookSimilarity.objects.order_by(
+            "book_id", "-score", "neighbor_id"
+        ).values_list("book_id", "neighbor_id", "score"):
+            neighbors.setdefault(book_id, []).append((neighbor_id, round(score, 9)))
+
+        self.assertEqual(neighbors, self.get_expected_neighbors())
+
+    def test_rebuild_replaces_the_model(self):
+        build_item_similarity()
+        Review.objects.filter(book=self.books[0]).delete()
+
+        build_item_similarity()
+
+        self.assertFalse(
+            BookSimilarity.objects.filter(book=self.books[0]).exists()
+            or BookSimilarity.objects.filter(neighbor=self.books[0]).exists()
+        )
+
+    def test_service_scores_the_neighbors_of_the_reviewed_books(self):
+        build_item_similarity()
+        user = create_user()
+        Review.objects.create(user=user, book=self.books[0], rating=5)
+
+        books = ItemSimilarityBookRecommendationService().get_recommended_books(
+            user.id, 10
+        )
+
+        expected = self.get_expected_neighbors()[self.books[0].id]
+        self.assertEqual(
+            [book["id"] for book in books], [neighbor_id for neighbor_id, _ in expected]
+        )
+
+
+# ----------------------------------------------------------------
+# -------------------     CATALOG PAGES          -----------------
+# ----------------------------------------------------------------
+
+
+@override_settings(BOOK_MAX_PAGE_SIZE=3, BOOK_STREAM_CHUNK_SIZE=2)
+class BookListPaginationTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.books = [create_book() for _ in range(4)]
+        self.client = get_client(self.user)
+
+    def get_page(self, **params):
+        return self.client.get(reverse("book:book-list"), params)
+
+    def test_pages_follow_the_cursor(self):
+        ids = []
+        after = 0
+        while after is not None:
+            response = self.get_page(after=after, page_size=3)
+            self.assertEqual(response.status_code, 200)
+            ids += [book["id"] for book in response.data["results"]]
+            after = response.data["next_cursor"]
+
+        self.assertEqual(ids, [book.id for book in self.books])
+
+    def test_last_full_page_has_no_next_cursor(self):
+        response = self.get_page(after=self.books[1].id, page_size=2)
+
+        self.assertEqual(
+            [book["id"] for book in response.data["results"]],
+            [book.id for book in self.books[2:]],
+        )
+        self.assertIsNone(response.data["next_cursor"])
+
+    def test_cursor_after_the_last_book(self):
+        response = self.get_page(after=self.books[-1].id)
+
+        self.assertEqual(response.data, {"results": [], "next_cursor": None})
+
+    def test_page_size_is_capped(self):
+        response = self.get_page(page_size=100)
+
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertEqual(response.data["next_cursor"], self.books[2].id)
+
+    def test_invalid_params(self):
+        for params in [{"after": -1}, {"after": "x"}, {"page_size": 0}]:
+            response = self.get_page(**params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_stream(self):
+        Review.objects.create(user=self.user, book=self.books[2], rating=5)
+
+        response = self.get_page(after=self.books[0].id, stream="true")
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        books = [json.loads(line) for line in lines]
+        self.assertEqual(
+            [book["id"] for book in books], [book.id for book in self.books[1:]]
+        )
+        self.assertEqual(books[1]["user_rating"], 5)
+        self.assertEqual(books[1]["average_rating"], 5)
+        self.assertIsNone(books[0]["user_rating"])
+
+
+# ----------------------------------------------------------------
+# -------------------     BENCHMARKS             -----------------
+# ----------------------------------------------------------------
+
+
+class BenchmarkCommandTests(TestCase):
+    def setUp(self):
+        # the runner sends the request signals, keep the test transaction open
+        # like the test client does
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        redis = get_redis_connection("default")
+        self.addCleanup(
+            lambda: redis.delete(LEADERBOARDS_KEY, *redis.smembers(LEADERBOARDS_KEY))
+        )
+
+    def test_seed_run_and_flush(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            call_command(
+                "benchmark",
+                "--seed-data",
+                *("--users", "5", "--books", "20", "--reviews", "40"),
+                *("--scenario", "book_list", "--scenario", "review_add"),
+                *("--requests", "3", "--warmup", "1", "--output", output.name),
+                stdout=StringIO(),
+            )
+            report = load_report(output.name)
+
+        self.assertEqual(get_dataset_size(), {"users": 5, "books": 20, "reviews": 40})
+        self.assertEqual(report["dataset"]["reviews"], 40)
+        self.assertEqual(set(report["scenarios"]), {"book_list", "review_add"})
+        for result in report["scenarios"].values():
+            self.assertEqual(result["requests"], 3)
+            self.assertEqual(result["errors"], 0)
+            self.assertGreater(result["queries_per_request"], 0)
+        # the reviews added by the runs are rolled back
+        self.assertEqual(Review.objects.count(), 40)
+
+        call_command("benchmark", "--flush", stdout=StringIO())
+
+        self.assertEqual(get_dataset_size(), {"users": 0, "books": 0, "reviews": 0})
+
+    def test_max_regression(self):
+        seed_dataset(3, 5, 10)
+        baseline = {
+            "scenarios": {"book_list": {"p50_ms": 1e-6, "p95_ms": 1e-6, "p99_ms": 1e-6}}
+        }
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+            json.dump(baseline, file)
+            file.flush()
+            with self.assertRaisesMessage(CommandError, "book_list p50_ms"):
+                call_command(
+                    "benchmark",
+                    *("--scenario", "book_list", "--requests", "2", "--warmup", "0"),
+                    *("--baseline", file.name, "--max-regression", "2"),
+                    stdout=StringIO(),
+                )
+
+
+class ConnectionSettingsTests(SimpleTestCase):
+    def load_settings(self, **environ):
+        """Evaluate a fresh copy of the settings module with environ set."""
+        spec = importlib.util.spec_from_file_location(
+            "connection_settings", settings_module.__file__
+        )
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(os.environ, environ):
+            spec.loader.exec_module(module)
+        return module
+
+    def test_persistent_connections(self):
+        module = self.load_settings(DB_CONN_MAX_AGE="None", DB_POOL="False")
+
+        self.assertIsNone(module.DATABASES["default"]["CONN_MAX_AGE"])
+        self.assertTrue(module.DATABASES["default"]["CONN_HEALTH_CHECKS"])
+        self.assertNotIn("pool", module.DATABASES["default"]["OPTIONS"])
+
+    def test_pool(self):
+        with mock.patch("django.VERSION", (5, 1, 0, "final", 0)), mock.patch(
+            "importlib.util.find_spec", return_value=object()
+        ):
+            module = self.load_settings(
+                DB_CONN_MAX_AGE="60", DB_POOL="True", DB_POOL_MAX_SIZE="4"
+            )
+
+        self.assertEqual(module.DATABASES["default"]["CONN_MAX_AGE"], 0)
+        self.assertEqual(
+            module.DATABASES["default"]["OPTIONS"]["pool"],
+            {"min_size": 2, "max_size": 4, "timeout": 10.0},
+        )
+
+    def test_pool_falls_back_to_persistent_connections(self):
+        with mock.patch("importlib.util.find_spec", return_value=None):
+            module = self.load_settings(DB_CONN_MAX_AGE="60", DB_POOL="True")
+
+        self.assertEqual(module.DATABASES["default"]["CONN_MAX_AGE"], 60)
+        self.assertNotIn("pool", module.DATABASES["default"]["OPTIONS"])
+
+
+class CompareConnectionsTests(SimpleTestCase):
+    def test_runs_the_endpoints_per_connection_mode(self):
+        result = {
+            "requests": 1,
+            "errors": 0,
+            "p50_ms": 1.0,
+            "p95_ms": 2.0,
+            "p99_ms": 3.0,
+            "queries_per_request": 1.0,
+            "peak_rss_mb": 1.0,
+        }
+        runner = mock.Mock()
+        runner.run.side_effect = lambda scenarios: {name: result for name in scenarios}
+
+        with mock.patch(
+            "book.management.commands.benchmark.BenchmarkRunner", return_value=runner
+        ), mock.patch(
+            "book.management.commands.benchmark.get_dataset_size", return_value={}
+        ), mock.patch(
+            "book.management.commands.benchmark.set_conn_max_age"
+        ) as set_conn_max_age:
+            stdout = StringIO()
+            call_command(
+                "benchmark",
+                "--compare-connections",
+                *("--scenario", "book_list", "--scenario", "service_genre"),
+                stdout=stdout,
+            )
+
+        configured = connection.settings_dict["CONN_MAX_AGE"]
+        self.assertEqual(
+            [call.args[0] for call in set_conn_max_age.call_args_list],
+            [0, configured or 600, configured],
+        )
+        runner.run.assert_called_with(["book_list"])
+        self.assertIn("book_list@per-request", stdout.getvalue())
+        self.assertIn("book_list@persistent", stdout.getvalue())
+
+
+class CompareReportsTests(SimpleTestCase):
+    def test_ratios(self):
+        report = {
+            "scenarios": {
+                "book_list": {"p50_ms": 2.0, "queries_per_request": 3},
+                "review_add": {"p50_ms": 5.0, "queries_per_request": 4},
+            }
+        }
+        baseline = {
+            "scenarios": {"book_list": {"p50_ms": 4.0, "queries_per_request": 3}}
+        }
+
+        self.assertEqual(
+            compare_reports(report, baseline, metrics=("p50_ms",)),
+            [
+                ("book_list", "p50_ms", 4.0, 2.0, 0.5),
+                ("book_list", "queries_per_request", 3, 3, 1.0),
+                ("review_add", "p50_ms", None, 5.0, None),
+                ("review_add", "queries_per_request", None, 4, None),
+            ],
+        )
+
+
+# ----------------------------------------------------------------
+# -------------------     QUERY PLANS            -----------------
+# ----------------------------------------------------------------
+
+
+class ExplainQueriesCommandTests(TestCase):
+    def test_explains_the_batch_popular_and_item_similarity_queries(self):
+        users = [create_user() for _ in range(3)]
+        books = [create_book() for _ in range(3)]
+        for user in users:
+            for book in books:
+                Review.objects.create(user=user, book=book, rating=4)
+
+        stdout = StringIO()
+        call_command("explain_queries", "--user-id", str(users[0].id), stdout=stdout)
+
+        for label in [
+            "similar_user: books batch",
+            "item_similarity: books batch",
+            "item_similarity: build batch",
+            "popular: ranking",
+            "popular: reviewed batch",
+        ]:
+            self.assertIn(f"{label}: ", stdout.getvalue())
+        self.assertIn("No sequential scans found.", stdout.getvalue())
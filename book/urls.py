@@ -19,13 +19,24 @@ book_urls = [
 # ----------------------------------------------------------------
 review_urls = [
     path("add/", views.ReviewAddView.as_view(), name="review-add"),
+    path("bulk/", views.ReviewBulkAddView.as_view(), name="review-bulk-add"),
     path("update/<int:pk>/", views.ReviewUpdateView.as_view(), name="review-update"),
     path("delete/<int:pk>/", views.ReviewDeleteView.as_view(), name="review-delete"),
     path("list/", views.ReviewListView.as_view(), name="review-list"),
+    path(
+        "writes/<str:write_id>/",
+        views.ReviewWriteStatusView.as_view(),
+        name="review-write-status",
+    ),
 ]
 
 urlpatterns = [
     path("book/", include(book_urls)),
     path("review/", include(review_urls)),
     path("suggest/", views.BookSuggestView.as_view(), name="book-suggest"),
+    path(
+        "suggest/batch/",
+        views.BookSuggestBatchView.as_view(),
+        name="book-suggest-batch",
+    ),
 ]
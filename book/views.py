@@ -1,5 +1,6 @@
+from django.conf import settings
 from django.core.cache import cache
-from django.db import connection
+from django.db import IntegrityError, connection, connections, transaction
 from rest_framework import generics, status
 from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
@@ -9,13 +10,45 @@ from rest_framework.views import APIView
 from utils import (
     combine_dict_items,
     extract_values_list_dicts,
+    get_constraint_name,
     get_keys_with_pattern,
     remove_duplicates,
 )
 
+from .aggregates import apply_rating_change
+from .catalog import get_catalog_cache_key, get_catalog_state
+from .hydration import get_books
+from .ingestion import ingest_reviews, summarize_results
+from .metrics import SUGGESTION_CACHE_LOOKUPS
 from .models import Book, Review
-from .serializers import BookSerializer, ReviewAddSerializer, ReviewUpdateSerializer
-from .services import BookRecommendationServiceFactory
+from .pagination import get_page_params, is_stream_request, paginate_rows, stream_rows
+from .popular import get_popular_books
+from .replicas import get_read_alias, get_read_connection
+from .review_events import review_written
+from .review_writes import ADD, UPDATE, enqueue_review_write, get_write_status
+from .serializers import (
+    REVIEW_BOOK_NOT_FOUND_ERROR,
+    REVIEW_EXISTS_ERROR,
+    REVIEW_RATING_ERROR,
+    BookSerializer,
+    BookSuggestBatchSerializer,
+    ReviewAddSerializer,
+    ReviewBulkAddSerializer,
+    ReviewUpdateSerializer,
+)
+from .services import get_recommended_books_batch
+from .suggestions import (
+    SUGGESTION_SERVICES,
+    SUGGESTION_TIMEOUT,
+    fetch_suggestions_parallel,
+    get_num_items,
+    get_service_books,
+    get_suggestion_cache_key,
+    hydrate_suggestions,
+    mark_users_dirty,
+    pack_suggestions,
+    unpack_suggestions,
+)
 
 
 class BookListView(APIView):
@@ -48,12 +81,22 @@ class BookListView(APIView):
     Parameters:
     •  request: The HTTP request object.
 
+    •  after (query): The id of the last book of the previous page (default 0).
+
+    •  page_size (query): The number of books of the page (default BOOK_PAGE_SIZE).
+
+    •  stream (query): If true, streams all books after the cursor as NDJSON.
+
 
     Returns:
-    •  Response: A JSON response containing the list of books with their details and ratings.
+    •  Response: A JSON page with the books in "results" and the cursor of the next page in "next_cursor".
+
+    •  StreamingHttpResponse: One JSON book per line if stream is requested.
 
     •  HTTP 200 OK: If the request is successful.
 
+    •  HTTP 400 Bad Request: If the pagination parameters are invalid.
+
 
     format_book(book):
     Formats the book data into a dictionary.
@@ -68,28 +111,36 @@ class BookListView(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    list_query = """
+        SELECT b.id, b.title, b.author, b.genre, r.rating as user_rating, agg.average_rating
+        FROM book_book b
+        LEFT JOIN book_review r ON b.id = r.book_id AND r.user_id = %s
+        LEFT JOIN book_bookratingaggregate agg ON b.id = agg.book_id
+        WHERE b.id > %s
+        ORDER BY b.id
+        """
 
     def get(self, request):
         user_id = request.user.id
-        with connection.cursor() as cursor:
+        after, page_size = get_page_params(request)
+
+        using = get_read_alias(user_id)
+
+        if is_stream_request(request):
+            return stream_rows(
+                self.list_query, [user_id, after], self.format_book, using=using
+            )
+
+        with connections[using].cursor() as cursor:
             cursor.execute(
-                """
-                SELECT b.id, b.title, b.author, b.genre, r.rating as user_rating, avg_r.avg_rating
-                FROM book_book b
-                LEFT JOIN book_review r ON b.id = r.book_id AND r.user_id = %s
-                LEFT JOIN (
-                    SELECT book_id, AVG(rating) as avg_rating
-                    FROM book_review
-                    GROUP BY book_id
-                ) avg_r ON b.id = avg_r.book_id
-                """,
-                [user_id],
+                self.list_query + "LIMIT %s",
+                [user_id, after, page_size + 1],
             )
             books = cursor.fetchall()
 
-        books_list = [self.format_book(book) for book in books]
+        page = paginate_rows(books, page_size, self.format_book)
 
-        return Response(books_list, status=status.HTTP_200_OK)
+        return Response(page, status=status.HTTP_200_OK)
 
     def format_book(self, book):
         return {
@@ -111,7 +162,8 @@ class BookFilterView(APIView):
 
 
     get(request, *args, **kwargs):
-    Retrieves a list of books that match the specified genre.
+    Retrieves a list of books that match the specified genre. The pages are
+    cached under the catalog version, bumped whenever a book changes.
 
     Parameters:
     •  request: The HTTP request object.
@@ -122,12 +174,22 @@ class BookFilterView(APIView):
 
     •  genre: The genre to filter books by.
 
+    •  after (query): The id of the last book of the previous page (default 0).
+
+    •  page_size (query): The number of books of the page (default BOOK_PAGE_SIZE).
+
+    •  stream (query): If true, streams all books of the genre after the cursor as NDJSON.
+
 
     Returns:
-    •  Response: A JSON response containing the list of filtered books.
+    •  Response: A JSON page with the filtered books in "results" and the cursor of the next page in "next_cursor".
+
+    •  StreamingHttpResponse: One JSON book per line if stream is requested.
 
     •  HTTP 200 OK: If the request is successful.
 
+    •  HTTP 400 Bad Request: If the pagination parameters are invalid.
+
 
     format_book(book):
     Formats the book data into a dictionary.
@@ -141,16 +203,45 @@ class BookFilterView(APIView):
 
     """
 
+    filter_query = """
+        SELECT id, title, author, genre
+        FROM book_book
+        WHERE genre = %s AND id > %s
+        ORDER BY id
+        """
+
     def get(self, request, *args, **kwargs):
         genre = kwargs.get("genre")
+        after, page_size = get_page_params(request)
+
+        if is_stream_request(request):
+            return stream_rows(
+                self.filter_query,
+                [genre, after],
+                self.format_book,
+                using=get_read_alias(),
+            )
 
-        with connection.cursor() as cursor:
-            cursor.execute("""SELECT * FROM book_book WHERE genre=%s""", [genre])
-            books = cursor.fetchall()
+        # ----------------------------------------------------------------
+        # pages are cached under the catalog version, a change of the books
+        # moves every page to new keys
+        # ----------------------------------------------------------------
+        version, using = get_catalog_state()
+        cache_key = get_catalog_cache_key(version, "genre", genre, after, page_size)
+        page = cache.get(cache_key)
 
-        books_list = [self.format_book(book) for book in books]
+        if page is None:
+            with connections[using].cursor() as cursor:
+                cursor.execute(
+                    self.filter_query + "LIMIT %s",
+                    [genre, after, page_size + 1],
+                )
+                books = cursor.fetchall()
+
+            page = paginate_rows(books, page_size, self.format_book)
+            cache.set(cache_key, page, settings.CATALOG_CACHE_TIMEOUT)
 
-        return Response(books_list, status=status.HTTP_200_OK)
+        return Response(page, status=status.HTTP_200_OK)
 
     def format_book(self, book):
         return {
@@ -170,7 +261,8 @@ class BookGenreListView(APIView):
 
 
     get(request, *args, **kwargs):
-    Retrieves a list of distinct genres from the books.
+    Retrieves a list of distinct genres from the books, cached under the
+    catalog version, bumped whenever a book changes.
 
     Parameters:
     •  request: The HTTP request object.
@@ -187,14 +279,21 @@ class BookGenreListView(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    genres_query = "SELECT DISTINCT genre FROM book_book"
 
     def get(self, request, *args, **kwargs):
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT DISTINCT genre FROM book_book")
-            genres = cursor.fetchall()
+        version, using = get_catalog_state()
+        cache_key = get_catalog_cache_key(version, "genres")
+        genre_list = cache.get(cache_key)
+
+        if genre_list is None:
+            with connections[using].cursor() as cursor:
+                cursor.execute(self.genres_query)
+                genres = cursor.fetchall()
 
-        # Flatten the list of tuples into a single list
-        genre_list = [genre[0] for genre in genres]
+            # Flatten the list of tuples into a single list
+            genre_list = [genre[0] for genre in genres]
+            cache.set(cache_key, genre_list, settings.CATALOG_CACHE_TIMEOUT)
 
         return Response(genre_list, status=status.HTTP_200_OK)
 
@@ -274,20 +373,68 @@ class ReviewAddView(APIView):
     serializer_class = ReviewAddSerializer
     permission_classes = [IsAuthenticated]
 
+    # inserts the review only if the book exists, skips it on the
+    # (book_id, user_id) unique constraint and tells which case happened,
+    # all in one round trip (the foreign keys are checked at commit only)
+    insert_query = """
+        WITH inserted AS (
+            INSERT INTO book_review (book_id, user_id, rating)
+            SELECT id, %s, %s FROM book_book WHERE id = %s
+            ON CONFLICT (book_id, user_id) DO NOTHING
+            RETURNING id
+        )
+        SELECT (SELECT id FROM inserted),
+            EXISTS (SELECT 1 FROM book_book WHERE id = %s);
+        """
+
     def post(self, request):
         data = request.data.copy()
         data["user"] = request.user.id
         ser_data = self.serializer_class(data=data)
 
         if ser_data.is_valid():
-            book_id = data.get("book")
-            user_id = data.get("user")
-            rating = data.get("rating")
+            book_id = ser_data.validated_data["book"]
+            user_id = ser_data.validated_data["user"]
+            rating = ser_data.validated_data["rating"]
 
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO book_review (book_id , user_id , rating) VALUES (%s, %s, %s)",
-                    [book_id, user_id, rating],
+            if settings.REVIEW_WRITE_BEHIND:
+                write_id = enqueue_review_write(
+                    ADD, user_id, book_id=book_id, rating=rating
+                )
+                return Response(
+                    {"message": "Review accepted", "write_id": write_id},
+                    status=status.HTTP_202_ACCEPTED,
+                )
+
+            try:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute(
+                        self.insert_query, [user_id, rating, book_id, book_id]
+                    )
+                    review_id, book_exists = cursor.fetchone()
+
+                    if review_id is not None:
+                        apply_rating_change(cursor, user_id, book_id, None, rating)
+                        review_written(user_id)
+
+            except IntegrityError as e:
+                if get_constraint_name(e) != "rating_range":
+                    raise
+                return Response(
+                    {"rating": [REVIEW_RATING_ERROR]},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            if not book_exists:
+                return Response(
+                    {"book": [REVIEW_BOOK_NOT_FOUND_ERROR.format(book_id)]},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            if review_id is None:
+                return Response(
+                    {"non_field_errors": [REVIEW_EXISTS_ERROR]},
+                    status=status.HTTP_400_BAD_REQUEST,
                 )
 
             return Response(
@@ -297,13 +444,68 @@ class ReviewAddView(APIView):
         return Response(ser_data.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ReviewBulkAddView(APIView):
+    """
+    This API view allows authenticated users to add many reviews at once,
+    e.g. to import their rating history from another site.
+
+    Attributes:
+    •  serializer_class: The serializer class used for validating the request data.
+
+    •  permission_classes: The permission classes that restrict access to authenticated users only.
+
+
+    Methods:
+    •  post: Handles POST requests to add the reviews.
+
+
+    post(request):
+    Adds the reviews of the batch with a constant number of queries.
+
+    Parameters:
+    •  reviews: A list of {"book": book_id, "rating": rating} objects
+       (at most REVIEW_BULK_MAX_ROWS).
+
+    •  update_existing: If true, the rating of an already reviewed book is
+       replaced instead of failing (default false).
+
+
+    Returns:
+    •  Response: The number of created, updated, unchanged and failed rows,
+       and the result of every row with its errors if it failed.
+
+    •  HTTP 200 OK: If the batch is processed, even if some rows failed.
+
+    •  HTTP 400 Bad Request: If the request data is invalid.
+
+    """
+
+    serializer_class = ReviewBulkAddSerializer
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        ser_data = self.serializer_class(data=request.data)
+
+        if ser_data.is_valid():
+            results = ingest_reviews(
+                request.user.id,
+                ser_data.validated_data["reviews"],
+                update_existing=ser_data.validated_data["update_existing"],
+            )
+            return Response(
+                {**summarize_results(results), "results": results},
+                status=status.HTTP_200_OK,
+            )
+
+        return Response(ser_data.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class ReviewUpdateView(APIView):
     serializer_class = ReviewUpdateSerializer
     permission_classes = [IsAuthenticated]
 
     def patch(self, request, *args, **kwargs):
         pk = kwargs.get("pk")
-        rating = request.data.get("rating")
         requested_user_id = request.user.id
 
         # ----------------------------------------------------------------
@@ -314,36 +516,55 @@ class ReviewUpdateView(APIView):
         ser_data = self.serializer_class(data=data)
 
         if ser_data.is_valid():
+            rating = ser_data.validated_data["rating"]
 
             # ----------------------------------------------------------------
-            #  check exist
+            #  write-behind mode: existence and ownership are checked when
+            #  the write is flushed, the outcome is in its status
             # ----------------------------------------------------------------
-            user_review = self.get_user_review(pk)
-            if user_review is None:
-                return Response(
-                    {"message": "Review not found"},
-                    status=status.HTTP_404_NOT_FOUND,
+            if settings.REVIEW_WRITE_BEHIND:
+                write_id = enqueue_review_write(
+                    UPDATE, requested_user_id, review_id=pk, rating=rating
                 )
-
-            # ----------------------------------------------------------------
-            #  check user permission manual
-            # ----------------------------------------------------------------
-
-            if user_review != requested_user_id:
                 return Response(
-                    {"message": "You do not have access to change this review"},
-                    status=status.HTTP_403_FORBIDDEN,
+                    {"message": "Review update accepted", "write_id": write_id},
+                    status=status.HTTP_202_ACCEPTED,
                 )
 
-            # ----------------------------------------------------------------
-            #   update data
-            # ----------------------------------------------------------------
-
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "UPDATE book_review SET rating=%s WHERE id=%s",
-                    [rating, pk],
-                )
+            with transaction.atomic():
+
+                # ----------------------------------------------------------------
+                #  check exist
+                # ----------------------------------------------------------------
+                user_review = self.get_user_review(pk)
+                if user_review is None:
+                    return Response(
+                        {"message": "Review not found"},
+                        status=status.HTTP_404_NOT_FOUND,
+                    )
+
+                # ----------------------------------------------------------------
+                #  check user permission manual
+                # ----------------------------------------------------------------
+                user_id, book_id, old_rating = user_review
+
+                if user_id != requested_user_id:
+                    return Response(
+                        {"message": "You do not have access to change this review"},
+                        status=status.HTTP_403_FORBIDDEN,
+                    )
+
+                # ----------------------------------------------------------------
+                #   update data and the rating aggregate of the book
+                # ----------------------------------------------------------------
+
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "UPDATE book_review SET rating=%s WHERE id=%s",
+                        [rating, pk],
+                    )
+                    apply_rating_change(cursor, user_id, book_id, old_rating, rating)
+                    review_written(user_id)
 
             return Response(
                 {"message": "Review updated successfully"}, status=status.HTTP_200_OK
@@ -354,14 +575,48 @@ class ReviewUpdateView(APIView):
     def get_user_review(self, pk):
         with connection.cursor() as cursor:
             cursor.execute(
-                "SELECT user_id FROM book_review WHERE id=%s",
+                "SELECT user_id, book_id, rating FROM book_review WHERE id=%s FOR UPDATE",
                 [pk],
             )
             review = cursor.fetchone()
-            if review is None:
-                return None
-            user_review = review[0]
-        return user_review
+        return review
+
+
+class ReviewWriteStatusView(APIView):
+    """
+    This API view returns the status of a review add / update accepted in
+    write-behind mode (REVIEW_WRITE_BEHIND).
+
+    Permissions:
+    •  Only the author of the write can access its status.
+
+
+    Parameters:
+    •  write_id: The write_id returned by the add / update request.
+
+
+    Returns:
+    •  Response: The status of the write, "pending" until it is flushed then
+       "created", "updated" or "failed" with the http_status and errors the
+       request would have got if it was written synchronously.
+
+    •  HTTP 200 OK: If the write is found.
+
+    •  HTTP 404 Not Found: If the write is unknown, expired or of another user.
+
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, write_id):
+        write_status = get_write_status(write_id)
+        if write_status is None or write_status.pop("user_id") != request.user.id:
+            return Response(
+                {"message": "Review write not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        return Response(write_status, status=status.HTTP_200_OK)
 
 
 class ReviewDeleteView(APIView):
@@ -404,24 +659,29 @@ class ReviewDeleteView(APIView):
         data = request.data.copy()
         data["user"] = request.user.id
 
-        user_review = self.get_user_review(pk)
-        if user_review is None:
-            return Response(
-                {"message": "Review not found"},
-                status=status.HTTP_404_NOT_FOUND,
-            )
+        with transaction.atomic():
+            user_review = self.get_user_review(pk)
+            if user_review is None:
+                return Response(
+                    {"message": "Review not found"},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
 
-        if user_review != requested_user_id:
-            return Response(
-                {"message": "You do not have access to delete this review"},
-                status=status.HTTP_403_FORBIDDEN,
-            )
+            user_id, book_id, old_rating = user_review
 
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM book_review WHERE id=%s",
-                [pk],
-            )
+            if user_id != requested_user_id:
+                return Response(
+                    {"message": "You do not have access to delete this review"},
+                    status=status.HTTP_403_FORBIDDEN,
+                )
+
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM book_review WHERE id=%s",
+                    [pk],
+                )
+                apply_rating_change(cursor, user_id, book_id, old_rating, None)
+                review_written(user_id)
 
         return Response(
             {"message": "Review Deleted successfully"}, status=status.HTTP_200_OK
@@ -430,14 +690,11 @@ class ReviewDeleteView(APIView):
     def get_user_review(self, pk):
         with connection.cursor() as cursor:
             cursor.execute(
-                "SELECT user_id FROM book_review WHERE id=%s",
+                "SELECT user_id, book_id, rating FROM book_review WHERE id=%s FOR UPDATE",
                 [pk],
             )
             review = cursor.fetchone()
-            if review is None:
-                return None
-            user_review = review[0]
-        return user_review
+        return review
 
 
 class ReviewListView(APIView):
@@ -467,12 +724,14 @@ class ReviewListView(APIView):
     •  HTTP 200 OK: If the request is successful.
 
 
-    format_review(review):
+    format_review(review, books):
     Formats the review data into a dictionary.
 
     Parameters:
     •  review: A tuple containing the review details.
 
+    •  books: The books of the reviews by id, from the book metadata cache.
+
 
     Returns:
     •  dict: A dictionary with the formatted review details.
@@ -480,33 +739,33 @@ class ReviewListView(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    list_query = """
+        SELECT  r.id , r.rating , r.book_id
+        FROM book_review as r
+        WHERE (user_id = %s);
+        """
 
     def get(self, request):
         user_id = request.user.id
-        with connection.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT  r.id , r.rating , r.book_id ,b.title , b.author , b.genre
-                FROM book_review as r
-                LEFT JOIN book_book b ON b.id = r.book_id
-                WHERE (user_id = %s);
-                """,
-                [user_id],
-            )
+        with get_read_connection(user_id).cursor() as cursor:
+            cursor.execute(self.list_query, [user_id])
             reviews = cursor.fetchall()
 
-        reviews_list = [self.format_review(review) for review in reviews]
+        # the title, author and genre come from the book metadata cache
+        books = get_books([review[2] for review in reviews])
+        reviews_list = [self.format_review(review, books) for review in reviews]
 
         return Response(reviews_list, status=status.HTTP_200_OK)
 
-    def format_review(self, review):
+    def format_review(self, review, books):
+        book = books.get(review[2], {})
         return {
             "id": review[0],
             "rating": review[1],
             "book_id": review[2],
-            "title": review[3],
-            "author": review[4],
-            "genre": review[5],
+            "title": book.get("title"),
+            "author": book.get("author"),
+            "genre": book.get("genre"),
         }
 
 
@@ -537,6 +796,9 @@ class BookSuggestView(APIView):
     get(request, *args, **kwargs):
     Retrieves book suggestions for the authenticated user.
 
+    With BOOK_SUGGEST_PARALLEL the services run concurrently and a service slower
+    than BOOK_SUGGEST_SERVICE_TIMEOUT is left out of the (then uncached) response.
+
     Parameters:
     •  request: The HTTP request object.
 
@@ -550,6 +812,8 @@ class BookSuggestView(APIView):
 
     •  HTTP 200 OK: If the request is successful.
 
+    •  HTTP 200 OK: The popular books if the user has no reviews yet.
+
     •  HTTP 200 OK: If there is not enough data about the user to provide suggestions.
 
 
@@ -606,7 +870,8 @@ class BookSuggestView(APIView):
 
     permission_classes = [IsAuthenticated]
     serializer_class = ReviewAddSerializer
-    list_services = ["genre", "author", "similar_user"]
+    list_services = SUGGESTION_SERVICES
+    review_count_query = "SELECT COUNT(*) FROM book_review WHERE user_id = %s ;"
 
     def get(self, request, *args, **kwargs):
         user_id = request.user.id
@@ -615,13 +880,15 @@ class BookSuggestView(APIView):
         # check if have not the review raise error
         # ----------------------------------------------------------------
         with connection.cursor() as cursor:
-            cursor.execute(
-                "SELECT COUNT(*) FROM book_review WHERE user_id = %s ;",
-                [user_id],
-            )
+            cursor.execute(self.review_count_query, [user_id])
             count = cursor.fetchone()[0]
 
         if count == 0:
+            # cold start, answer with the popular books read from Redis
+            popular_books = get_popular_books(settings.BOOK_SUGGEST_COLD_START_ITEMS)
+            if popular_books:
+                return Response(popular_books, status=status.HTTP_200_OK)
+
             return Response(
                 {"error": "there is not enough data about you"},
                 status=status.HTTP_200_OK,
@@ -641,25 +908,24 @@ class BookSuggestView(APIView):
         # ----------------------------------------------------------------
         preference = self.get_user_preference(user_id)
 
-        all_books = []
-        recom_perf = {}
-        if not preference:
-            for service_name in self.list_services:
-                books_list = self.fetch_books_from_service(service_name, user_id)
-                recom_perf[service_name] = books_list
-                all_books = all_books + books_list
+        if settings.BOOK_SUGGEST_PARALLEL:
+            recom_perf, complete = fetch_suggestions_parallel(user_id, preference)
         else:
+            recom_perf, complete = {}, True
             for service_name in self.list_services:
-                num_items = int(preference[service_name] / 10)
-                books_list = self.fetch_books_from_service(
+                num_items = get_num_items(preference, service_name)
+                recom_perf[service_name] = self.fetch_books_from_service(
                     service_name, user_id, num_items
                 )
-                recom_perf[service_name] = books_list
-                all_books = all_books + books_list
+
+        all_books = combine_dict_items(recom_perf)
+
         # ----------------------------------------------------------------
-        # save the data of suggestion list in the cache
+        # save the data of suggestion list in the cache, a partial list
+        # (a service timed out) is not cached so the next request retries
         # ----------------------------------------------------------------
-        self.save_list_books(recom_perf, user_id)
+        if complete:
+            self.save_list_books(recom_perf, user_id)
 
         # ----------------------------------------------------------------
         # return unique items of books list
@@ -668,24 +934,27 @@ class BookSuggestView(APIView):
         return Response(unique_all_books, status=status.HTTP_200_OK)
 
     def save_list_books(self, recom_perf, user_id):
-        each_day_seconds = 86400
-
         cache.set(
-            f"RecommendationPreference_{user_id}",
-            recom_perf,
-            each_day_seconds * 3,
+            get_suggestion_cache_key(user_id),
+            pack_suggestions(recom_perf),
+            SUGGESTION_TIMEOUT,
         )
+        # a new list changes the weights computed from it
+        mark_users_dirty([user_id])
 
     def get_list_books_from_cache(self, user_id):
-        recom_perf = cache.get(f"RecommendationPreference_{user_id}")
-        if recom_perf:
+        packed = cache.get(get_suggestion_cache_key(user_id))
+        if packed:
+            SUGGESTION_CACHE_LOOKUPS.inc(result="hit")
+            recom_perf = hydrate_suggestions(unpack_suggestions(packed))
             book_list = combine_dict_items(recom_perf)
             return book_list
+
+        SUGGESTION_CACHE_LOOKUPS.inc(result="miss")
         return None
 
     def fetch_books_from_service(self, service_name, user_id, num_items=10):
-        service = BookRecommendationServiceFactory.create_service(service_name)
-        books_list = service.get_recommended_books(user_id, num_items)
+        books_list = get_service_books(service_name, user_id, num_items)
 
         return books_list
 
@@ -707,3 +976,51 @@ class BookSuggestView(APIView):
             }
             return formatted_preference
         return None
+
+
+class BookSuggestBatchView(APIView):
+    """
+    This API view lets admins fetch book suggestions for many users at once,
+    for jobs like email digests and homepage prewarming.
+
+    Attributes:
+    •  permission_classes: Only admin users can access this view.
+
+    •  serializer_class: The serializer class used for validating the request data.
+
+
+    post(request):
+    Returns the suggestions of every requested user, each service serving all
+    of them in a constant number of queries.
+
+    Parameters:
+    •  user_ids: The ids of the users (at most BOOK_SUGGEST_BATCH_MAX_USERS).
+
+    •  services: The recommendation services to use (default genre, author and similar_user).
+
+    •  num_items: The number of books per service and user (default 10).
+
+
+    Returns:
+    •  Response: A JSON object of {user_id: {service: [books]}}.
+
+    •  HTTP 200 OK: If the request is successful.
+
+    •  HTTP 400 Bad Request: If the request data is invalid.
+    """
+
+    permission_classes = [IsAdminUser]
+    serializer_class = BookSuggestBatchSerializer
+
+    def post(self, request):
+        ser_data = self.serializer_class(data=request.data)
+
+        if ser_data.is_valid():
+            suggestions = get_recommended_books_batch(
+                ser_data.validated_data.get("services", BookSuggestView.list_services),
+                list(dict.fromkeys(ser_data.validated_data["user_ids"])),
+                ser_data.validated_data["num_items"],
+            )
+            return Response(suggestions, status=status.HTTP_200_OK)
+
+        return Response(ser_data.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from redis.client import Pipeline
+
+from metrics.cache import MetricsCacheClient
+from metrics.registry import record_cache
+
+logger = logging.getLogger(__name__)
+
+# channel the cache clients publish the keys they change on
+INVALIDATION_CHANNEL = "cache-invalidation"
+
+_missing = object()
+
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------
+# -------------------     LOCAL TIER         ---------------------
+# ----------------------------------------------------------------
+
+
+class LocalLRUCache:
+    """
+    Least recently used values of the process, bounded by number of entries
+    and by the size of their serialized form, each one kept for at most ttl
+    seconds.
+
+    Every invalidation bumps the generation, a value read from Redis before
+    one is not stored as it may be the old one.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return _missing
+
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._pop(key)
+                return _missing
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size, generation):
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self._pop(key)
+            self.entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def delete_many(self, keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class LocalTier:
+    """
+    The local cache of a process for one Redis server, and the thread that
+    drops its entries changed by the other processes.
+    """
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+        self.sender = uuid.uuid4().hex
+        self.cache = LocalLRUCache(
+            settings.CACHE_LOCAL_MAX_ENTRIES,
+            settings.CACHE_LOCAL_MAX_BYTES,
+            settings.CACHE_LOCAL_TTL,
+        )
+        # the local cache is only used while the invalidations are received
+        self.subscribed = threading.Event()
+        threading.Thread(
+            target=self.listen, name="cache-invalidation", daemon=True
+        ).start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.get_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # the messages published while unsubscribed are lost
+                self.cache.clear()
+                self.subscribed.set()
+
+                for message in pubsub.listen():
+                    invalidation = json.loads(message["data"])
+                    if invalidation["sender"] == self.sender:
+                        continue
+                    if invalidation["keys"] is None:
+                        self.cache.clear()
+                    else:
+                        self.cache.delete_many(invalidation["keys"])
+            except Exception:
+                logger.exception("cache invalidation subscription lost")
+            finally:
+                self.subscribed.clear()
+                self.cache.clear()
+
+            time.sleep(1)
+
+    def publish(self, keys):
+        """Drop the keys, all of them if None, here and in the other processes."""
+        if keys is None:
+            self.cache.clear()
+        else:
+            self.cache.delete_many(keys)
+
+        self.get_client().publish(
+            INVALIDATION_CHANNEL, json.dumps({"sender": self.sender, "keys": keys})
+        )
+
+
+def get_local_tier(server, get_client):
+    # a tier per process, a forked process starts its own
+    tier_key = (os.getpid(), tuple(server))
+    with _tiers_lock:
+        if tier_key not in _tiers:
+            _tiers[tier_key] = LocalTier(get_client)
+        return _tiers[tier_key]
+
+
+# ----------------------------------------------------------------
+# -------------------     CLIENT         -------------------------
+# ----------------------------------------------------------------
+
+
+class TwoTierCacheClient(MetricsCacheClient):
+    """
+    django-redis client serving the keys starting with CACHE_LOCAL_PREFIXES
+    from an in-process LRU in front of Redis.
+
+    Writes go to Redis and publish the changed keys on INVALIDATION_CHANNEL,
+    every process then drops its local copy. CACHE_LOCAL_TTL bounds how long
+    a copy can outlive a lost message.
+
+    The values served locally are shared by the callers of the process, they
+    must not be changed in place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_prefixes = tuple(settings.CACHE_LOCAL_PREFIXES)
+
+    @property
+    def local_tier(self):
+        return get_local_tier(self._server, lambda: self.get_client(write=True))
+
+    def get_size(self, value):
+        # integers are stored as they are, not serialized
+        encoded = self.encode(value)
+        return len(encoded) if isinstance(encoded, bytes) else 8
+
+    def is_local(self, made_key):
+        return self.reverse_key(made_key).startswith(self.local_prefixes)
+
+    def get_usable_tier(self):
+        tier = self.local_tier
+        return tier if tier.subscribed.is_set() else None
+
+    # ----------------------------------------------------------------
+    #  reads
+    # ----------------------------------------------------------------
+
+    def get(self, key, default=None, version=None, client=None):
+        made_key = self.make_key(key, version=version)
+        tier = self.get_usable_tier() if self.is_local(made_key) else None
+        if tier is None:
+            return super().get(key, default=default, version=version, client=client)
+
+        value = tier.cache.get(made_key)
+        if value is not _missing:
+            record_cache(hits=1)
+            return value
+
+        generation = tier.cache.generation
+        value = super().get(made_key, default=_missing, client=client)
+        if value is _missing:
+            return default
+
+        tier.cache.set(made_key, value, self.get_size(value), generation)
+        return value
+
+    def get_many(self, keys, version=None, client=None):
+        made_keys = {self.make_key(key, version=version): key for key in keys}
+        local_keys = [made_key for made_key in made_keys if self.is_local(made_key)]
+        tier = self.get_usable_tier() if local_keys else None
+        if tier is None:
+            return super().get_many(keys, version=version, client=client)
+
+        values = {}
+        for made_key in local_keys:
+            value = tier.cache.get(made_key)
+            if value is not _missing:
+                values[made_keys[made_key]] = value
+        record_cache(hits=len(values))
+
+        generation = tier.cache.generation
+        remote_keys = [key for key in made_keys.values() if key not in values]
+        remote_values = super().get_many(remote_keys, version=version, client=client)
+        for key, value in remote_values.items():
+            made_key = self.make_key(key, version=version)
+            if self.is_local(made_key):
+                tier.cache.set(made_key, value, self.get_size(value), generation)
+
+        # in the order of the keys, like a single MGET
+        values.update(remote_values)
+        return {key: values[key] for key in made_keys.values() if key in values}
+
+    # ----------------------------------------------------------------
+    #  writes, the keys set through a pipeline are published by the
+    #  caller of the pipeline
+    # ----------------------------------------------------------------
+
+    def set(
+        self,
+        key,
+        value,
+        timeout=DEFAULT_TIMEOUT,
+        version=None,
+        client=None,
+        nx=False,
+        xx=False,
+    ):
+        result = super().set(
+            key, value, timeout, version=version, client=client, nx=nx, xx=xx
+        )
+        if not isinstance(client, Pipeline):
+            self.invalidate([self.make_key(key, version=version)])
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        super().set_many(data, timeout, version=version, client=client)
+        self.invalidate([self.make_key(key, version=version) for key in data])
+
+    def delete(self, key, version=None, prefix=None, client=None):
+        result = super().delete(key, version=version, prefix=prefix, client=client)
+        if not isinstance(client, Pipeline):
+            self.invalidate([self.make_key(key, version=version, prefix=prefix)])
+        return result
+
+    def delete_many(self, keys, version=None, client=None):
+        result = super().delete_many(keys, version=version, client=client)
+        self.invalidate([self.make_key(key, version=version) for key in keys])
+        return result
+
+    def delete_pattern(self, *args, **kwargs):
+        result = super().delete_pattern(*args, **kwargs)
+        self.invalidate(None)
+        return result
+
+    def clear(self, client=None):
+        super().clear(client=client)
+        self.invalidate(None)
+
+    def _incr(self, key, delta=1, version=None, client=None, ignore_key_check=False):
+        value = super()._incr(
+            key,
+            delta=delta,
+            version=version,
+            client=client,
+            ignore_key_check=ignore_key_check,
+        )
+        self.invalidate([self.make_key(key, version=version)])
+        return value
+
+    def invalidate(self, made_keys):
+        """Publish the changed keys, None for all of them."""
+        if made_keys is not None:
+            made_keys = [str(key) for key in made_keys if self.is_local(key)]
+            if not made_keys:
+                return
+
+        self.local_tier.publish(made_keys)
@@ -1,7 +1,10 @@
+import importlib.util
 import os
 from datetime import timedelta
 from pathlib import Path
 
+import django
+from celery.schedules import crontab
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -59,10 +62,12 @@ INSTALLED_APPS = [
     "django_celery_beat",
     "accounts.apps.AccountsConfig",
     "book.apps.BookConfig",
+    "metrics.apps.MetricsConfig",
 ]
 
 
 MIDDLEWARE = [
+    "metrics.middleware.QueryMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -99,17 +104,50 @@ REDIS_HOST = os.environ.get("REDIS_HOST")
 REDIS_PORT = os.environ.get("REDIS_PORT")
 REDIS_DB = os.environ.get("REDIS_DB")
 
+# in-process LRU tier in front of Redis for the hot keys starting with
+# CACHE_LOCAL_PREFIXES, invalidated over Redis pub/sub, each entry kept at
+# most CACHE_LOCAL_TTL seconds in case an invalidation is lost
+CACHE_LOCAL = os.environ.get("CACHE_LOCAL", "True") == "True"
+CACHE_LOCAL_PREFIXES = os.environ.get(
+    "CACHE_LOCAL_PREFIXES", "Catalog_,RecommendationPreference_,BookMeta_"
+).split(",")
+CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get("CACHE_LOCAL_MAX_ENTRIES", 10000))
+CACHE_LOCAL_MAX_BYTES = int(os.environ.get("CACHE_LOCAL_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_LOCAL_TTL = int(os.environ.get("CACHE_LOCAL_TTL", 30))
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
         "LOCATION": os.environ.get("redis_location"),
         "OPTIONS": {
-            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # the default client counting the cache hits / misses per request,
+            # with the local tier in front of it
+            "CLIENT_CLASS": (
+                "book_recommendation.cache.TwoTierCacheClient"
+                if CACHE_LOCAL
+                else "metrics.cache.MetricsCacheClient"
+            ),
         },
     }
 }
 
 
+# seconds a connection is kept open across requests (0 closes it at the end
+# of every request, "None" keeps it forever) and if it is checked before reuse
+DB_CONN_MAX_AGE = (
+    None
+    if os.environ.get("DB_CONN_MAX_AGE") == "None"
+    else int(os.environ.get("DB_CONN_MAX_AGE", 60))
+)
+DB_CONN_HEALTH_CHECKS = os.environ.get("DB_CONN_HEALTH_CHECKS", "True") == "True"
+
+# connection pool of the psycopg 3 backend (Django >= 5.1 with psycopg[pool]
+# installed), persistent connections are used instead where it is missing
+DB_POOL = os.environ.get("DB_POOL", "False") == "True"
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -118,9 +156,42 @@ DATABASES = {
         "PASSWORD": os.environ.get("PASSWORD"),
         "HOST": os.environ.get("HOST"),
         "PORT": os.environ.get("PORT"),
+        "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": DB_CONN_HEALTH_CHECKS,
+        "OPTIONS": {},
     }
 }
 
+if DB_POOL and django.VERSION >= (5, 1) and importlib.util.find_spec("psycopg_pool"):
+    # pooled connections are returned to the pool at the end of the request
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+    DATABASES["default"]["OPTIONS"]["pool"] = {
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": DB_POOL_MAX_SIZE,
+        "timeout": DB_POOL_TIMEOUT,
+    }
+
+# read replica of the primary, it is the same database in the tests
+DB_REPLICA_HOST = os.environ.get("DB_REPLICA_HOST")
+if DB_REPLICA_HOST:
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "NAME": os.environ.get("DB_REPLICA_NAME", DATABASES["default"]["NAME"]),
+        "HOST": DB_REPLICA_HOST,
+        "PORT": os.environ.get("DB_REPLICA_PORT", DATABASES["default"]["PORT"]),
+        "OPTIONS": dict(DATABASES["default"]["OPTIONS"]),
+        "TEST": {"MIRROR": "default"},
+    }
+
+# alias the read-only book queries go to, and seconds the reads of a user
+# stay on the primary after a review write of theirs
+DB_READ_ALIAS = os.environ.get(
+    "DB_READ_ALIAS", "replica" if DB_REPLICA_HOST else "default"
+)
+DB_READ_YOUR_WRITES_TIMEOUT = int(os.environ.get("DB_READ_YOUR_WRITES_TIMEOUT", 10))
+
+DATABASE_ROUTERS = ["book.replicas.ReplicaRouter"]
+
 
 # =============================================================================
 #
@@ -270,6 +341,160 @@ AWS_SERVICE_NAME = "s3"
 AWS_S3_FILE_OVERWRITE = False
 
 
+# =============================================================================
+#
+#               BOOK CATALOG AND RECOMMENDATION SETTINGS
+#
+# =============================================================================
+
+# keyset pagination of the catalog endpoints
+BOOK_PAGE_SIZE = int(os.environ.get("BOOK_PAGE_SIZE", 100))
+BOOK_MAX_PAGE_SIZE = int(os.environ.get("BOOK_MAX_PAGE_SIZE", 1000))
+
+# rows fetched per round trip by the server-side cursor of NDJSON streams
+BOOK_STREAM_CHUNK_SIZE = int(os.environ.get("BOOK_STREAM_CHUNK_SIZE", 2000))
+
+# seconds the genre list and the genre pages are cached, they are keyed by
+# the catalog version so a change of the books never serves them stale
+CATALOG_CACHE_TIMEOUT = int(os.environ.get("CATALOG_CACHE_TIMEOUT", 3600))
+
+# "sql" answers the genre, author and similar_user services in Postgres,
+# "engine" answers them from the in-memory sparse matrix of book/engine.py
+BOOK_RECOMMENDATION_BACKEND = os.environ.get("BOOK_RECOMMENDATION_BACKEND", "sql")
+
+# seconds before a process reloads its in-memory recommendation engine
+BOOK_ENGINE_TTL = int(os.environ.get("BOOK_ENGINE_TTL", 600))
+
+# run the suggestion services of BookSuggestView concurrently in a thread
+# pool, each one dropped from the response after BOOK_SUGGEST_SERVICE_TIMEOUT
+BOOK_SUGGEST_PARALLEL = os.environ.get("BOOK_SUGGEST_PARALLEL", "False") == "True"
+BOOK_SUGGEST_SERVICE_TIMEOUT = float(os.environ.get("BOOK_SUGGEST_SERVICE_TIMEOUT", 2))
+BOOK_SUGGEST_MAX_WORKERS = int(os.environ.get("BOOK_SUGGEST_MAX_WORKERS", 12))
+
+# popular books BookSuggestView answers a user with no reviews with
+BOOK_SUGGEST_COLD_START_ITEMS = int(os.environ.get("BOOK_SUGGEST_COLD_START_ITEMS", 30))
+
+# maximum number of users of one admin batch suggestion request
+BOOK_SUGGEST_BATCH_MAX_USERS = int(os.environ.get("BOOK_SUGGEST_BATCH_MAX_USERS", 1000))
+
+# maximum number of reviews of one bulk review request
+REVIEW_BULK_MAX_ROWS = int(os.environ.get("REVIEW_BULK_MAX_ROWS", 5000))
+
+# write-behind mode: review adds / updates are validated, appended to a Redis
+# stream and answered 202, the flush_review_writes task writes them to the
+# database in batches every REVIEW_WRITE_BEHIND_INTERVAL seconds
+REVIEW_WRITE_BEHIND = os.environ.get("REVIEW_WRITE_BEHIND", "False") == "True"
+REVIEW_WRITE_BEHIND_INTERVAL = float(os.environ.get("REVIEW_WRITE_BEHIND_INTERVAL", 1))
+REVIEW_WRITE_BEHIND_BATCH_SIZE = int(
+    os.environ.get("REVIEW_WRITE_BEHIND_BATCH_SIZE", 500)
+)
+# seconds before the writes of a dead consumer are retried by another one
+REVIEW_WRITE_CLAIM_IDLE = int(os.environ.get("REVIEW_WRITE_CLAIM_IDLE", 60))
+# deliveries of a failing batch before its writes are retried one by one,
+# those still failing are moved to the dead letter stream
+REVIEW_WRITE_MAX_DELIVERIES = int(os.environ.get("REVIEW_WRITE_MAX_DELIVERIES", 3))
+# seconds the status of a write is kept for the status endpoint
+REVIEW_WRITE_STATUS_TIMEOUT = int(os.environ.get("REVIEW_WRITE_STATUS_TIMEOUT", 86400))
+
+# users per chunk of the nightly suggestion precomputation, and if set only
+# users that logged in during the last SUGGESTION_PRECOMPUTE_ACTIVE_DAYS days
+SUGGESTION_PRECOMPUTE_CHUNK_SIZE = int(
+    os.environ.get("SUGGESTION_PRECOMPUTE_CHUNK_SIZE", 500)
+)
+SUGGESTION_PRECOMPUTE_ACTIVE_DAYS = (
+    int(os.environ["SUGGESTION_PRECOMPUTE_ACTIVE_DAYS"])
+    if os.environ.get("SUGGESTION_PRECOMPUTE_ACTIVE_DAYS")
+    else None
+)
+
+# users whose service weights are recomputed per statement
+RECOMMENDATION_WEIGHTS_BATCH_SIZE = int(
+    os.environ.get("RECOMMENDATION_WEIGHTS_BATCH_SIZE", 1000)
+)
+
+# offline item-item similarity model of the "item_similarity" service
+ITEM_SIMILARITY_TOP_K = int(os.environ.get("ITEM_SIMILARITY_TOP_K", 50))
+ITEM_SIMILARITY_MIN_SUPPORT = int(os.environ.get("ITEM_SIMILARITY_MIN_SUPPORT", 1))
+ITEM_SIMILARITY_BATCH_SIZE = int(os.environ.get("ITEM_SIMILARITY_BATCH_SIZE", 1000))
+
+# seconds between two full rebuilds of the genre and author leaderboards,
+# kept up to date by the review writes in between
+LEADERBOARDS_REBUILD_INTERVAL = int(
+    os.environ.get("LEADERBOARDS_REBUILD_INTERVAL", 3600)
+)
+
+# Bayesian averaged top books of the "popular" service, refreshed every
+# POPULAR_BOOKS_REFRESH_INTERVAL seconds, the prior weighs as many reviews as
+# POPULAR_BOOKS_PRIOR_COUNT or as the mean reviewed book has if it is not set
+POPULAR_BOOKS_TOP_N = int(os.environ.get("POPULAR_BOOKS_TOP_N", 100))
+POPULAR_BOOKS_REFRESH_INTERVAL = int(
+    os.environ.get("POPULAR_BOOKS_REFRESH_INTERVAL", 600)
+)
+POPULAR_BOOKS_PRIOR_COUNT = (
+    float(os.environ["POPULAR_BOOKS_PRIOR_COUNT"])
+    if os.environ.get("POPULAR_BOOKS_PRIOR_COUNT")
+    else None
+)
+
+
+# =============================================================================
+#
+#               METRICS SETTINGS
+#
+# =============================================================================
+
+# bearer token the scraper of the Prometheus metrics of /api/metrics/ sends,
+# the metrics are not served at all without it
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+# addresses allowed to scrape them, any address if empty
+METRICS_ALLOWED_IPS = [
+    address
+    for address in os.environ.get("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+    if address
+]
+
+
+# =============================================================================
+#
+#               CELERY SETTINGS
+#
+# =============================================================================
+
+CELERY_TIMEZONE = TIME_ZONE
+
+CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+
+CELERY_BEAT_SCHEDULE = {
+    "update-recommendation-weights": {
+        "task": "book.tasks.update_recommendation_weights",
+        "schedule": crontab(minute="*/10"),
+    },
+    "build-item-similarity": {
+        "task": "book.tasks.build_item_similarity",
+        "schedule": crontab(hour=2, minute=0),
+    },
+    "precompute-suggestions": {
+        "task": "book.tasks.precompute_suggestions",
+        "schedule": crontab(hour=3, minute=0),
+        "kwargs": {"active_days": SUGGESTION_PRECOMPUTE_ACTIVE_DAYS},
+    },
+    "rebuild-leaderboards": {
+        "task": "book.tasks.rebuild_leaderboards",
+        "schedule": timedelta(seconds=LEADERBOARDS_REBUILD_INTERVAL),
+    },
+    "refresh-popular-books": {
+        "task": "book.tasks.refresh_popular_books",
+        "schedule": timedelta(seconds=POPULAR_BOOKS_REFRESH_INTERVAL),
+    },
+}
+
+if REVIEW_WRITE_BEHIND:
+    CELERY_BEAT_SCHEDULE["flush-review-writes"] = {
+        "task": "book.tasks.flush_review_writes",
+        "schedule": timedelta(seconds=REVIEW_WRITE_BEHIND_INTERVAL),
+    }
+
+
 # =============================================================================
 #
 #
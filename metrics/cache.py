@@ -0,0 +1,24 @@
+from django_redis.client import DefaultClient
+
+from .registry import record_cache
+
+_missing = object()
+
+
+class MetricsCacheClient(DefaultClient):
+    """django-redis client that counts the hits and misses of each request."""
+
+    def get(self, key, default=None, version=None, client=None):
+        value = super().get(key, default=_missing, version=version, client=client)
+        if value is _missing:
+            record_cache(misses=1)
+            return default
+
+        record_cache(hits=1)
+        return value
+
+    def get_many(self, keys, version=None, client=None):
+        keys = list(keys)
+        values = super().get_many(keys, version=version, client=client)
+        record_cache(hits=len(values), misses=len(keys) - len(values))
+        return values
@@ -0,0 +1,49 @@
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+
+from .registry import RequestMetrics, current_request_metrics, registry
+
+
+class QueryMetricsMiddleware:
+    """
+    Count and time the SQL statements and the cache lookups of every request.
+
+    •  Server-Timing: the response gets the DB time, query count, slowest
+       statement time, cache hits / misses and total time of the request.
+
+    •  registry: the metrics are added to the per-endpoint totals of the
+       process, served to admins by metrics.views.QueryMetricsView.
+
+    Only the statements run by the request thread are seen, not those of the
+    suggestion thread pool nor those of a streamed body once it is returned.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_request_metrics.set(metrics)
+        started = time.perf_counter()
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            current_request_metrics.reset(token)
+
+        duration = time.perf_counter() - started
+        response["Server-Timing"] = metrics.get_server_timing(duration)
+        registry.record(self.get_endpoint(request), metrics, duration)
+
+        return response
+
+    def get_endpoint(self, request):
+        match = request.resolver_match
+        if match is None:
+            return "unresolved"
+        return match.view_name
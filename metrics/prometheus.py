@@ -0,0 +1,158 @@
+import json
+import math
+import threading
+
+from django_redis import get_redis_connection
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+
+
+# ----------------------------------------------------------------
+# -------------------     STORES         -------------------------
+# ----------------------------------------------------------------
+
+
+class LocalStore:
+    """Samples kept in the memory of the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc_many(self, amounts):
+        with self.lock:
+            for key, amount in amounts:
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def items(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+class RedisStore:
+    """
+    Samples kept in a Redis hash, for metrics recorded by the Celery workers
+    that are served by the web processes.
+    """
+
+    def __init__(self, name):
+        self.key = f"metrics:{name}"
+
+    def inc_many(self, amounts):
+        pipe = get_redis_connection("default").pipeline(transaction=False)
+        for key, amount in amounts:
+            pipe.hincrbyfloat(self.key, json.dumps(key), amount)
+        pipe.execute()
+
+    def items(self):
+        items = []
+        for key, value in get_redis_connection("default").hgetall(self.key).items():
+            suffix, labels = json.loads(key)
+            items.append(((suffix, tuple(map(tuple, labels))), float(value)))
+        return items
+
+
+# ----------------------------------------------------------------
+# -------------------     METRICS         ------------------------
+# ----------------------------------------------------------------
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), shared=False):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.store = RedisStore(name) if shared else LocalStore()
+        _metrics.append(self)
+
+    def get_labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def get_header(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+
+    def collect(self):
+        lines = self.get_header()
+        # a key is (sample suffix, labels) with labels ((name, value), ...)
+        for (suffix, labels), value in sorted(self.store.items()):
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        self.store.inc_many([(("_total", self.get_labels(labels)), amount)])
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = (*sorted(buckets), math.inf)
+
+    def observe(self, value, **labels):
+        labels = self.get_labels(labels)
+        amounts = [
+            (("_bucket", (*labels, ("le", format_value(bound)))), 1)
+            for bound in self.buckets
+            if value <= bound
+        ]
+        amounts.append((("_sum", labels), value))
+        amounts.append((("_count", labels), 1))
+        self.store.inc_many(amounts)
+
+    def collect(self):
+        lines = self.get_header()
+
+        # a bucket no observation fell into was never stored, render it as 0
+        samples = dict(self.store.items())
+        series = sorted({labels for (suffix, labels) in samples if suffix == "_count"})
+        for labels in series:
+            for bound in self.buckets:
+                bucket_labels = (*labels, ("le", format_value(bound)))
+                value = samples.get(("_bucket", bucket_labels), 0)
+                lines.append(
+                    f"{self.name}_bucket{format_labels(bucket_labels)} {value}"
+                )
+            for suffix in ("_sum", "_count"):
+                value = samples[(suffix, labels)]
+                lines.append(f"{self.name}{suffix}{format_labels(labels)} {value}")
+        return lines
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def generate_latest():
+    """Render every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,132 @@
+import threading
+import time
+from contextvars import ContextVar
+
+# statements are kept this long in the registry
+SQL_MAX_LENGTH = 500
+
+# metrics of the request being served by the current thread, None outside one
+current_request_metrics = ContextVar("current_request_metrics", default=None)
+
+
+class RequestMetrics:
+    """
+    Query and cache counters of a single request.
+
+    An instance is also a connection.execute_wrapper, so every statement run
+    on a wrapped connection is counted and timed.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_sql = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += elapsed
+            if elapsed >= self.slowest_time:
+                self.slowest_time = elapsed
+                self.slowest_sql = sql
+
+    def record_cache(self, hits, misses):
+        self.cache_hits += hits
+        self.cache_misses += misses
+
+    def get_server_timing(self, duration):
+        """Format the metrics as the value of a Server-Timing header."""
+        return ", ".join(
+            [
+                f'db;dur={self.db_time * 1000:.3f};desc="{self.queries} queries"',
+                f"db-slowest;dur={self.slowest_time * 1000:.3f}",
+                f'cache;desc="{self.cache_hits} hits {self.cache_misses} misses"',
+                f"total;dur={duration * 1000:.3f}",
+            ]
+        )
+
+
+def record_cache(hits=0, misses=0):
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.record_cache(hits, misses)
+
+
+class QueryMetricsRegistry:
+    """
+    Per-endpoint totals of the requests served by this process, aggregated
+    from the RequestMetrics of each request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, metrics, duration):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "requests": 0,
+                    "queries": 0,
+                    "max_queries": 0,
+                    "db_time": 0.0,
+                    "duration": 0.0,
+                    "slowest_time": 0.0,
+                    "slowest_sql": None,
+                    "cache_hits": 0,
+                    "cache_misses": 0,
+                }
+
+            stats["requests"] += 1
+            stats["queries"] += metrics.queries
+            stats["max_queries"] = max(stats["max_queries"], metrics.queries)
+            stats["db_time"] += metrics.db_time
+            stats["duration"] += duration
+            stats["cache_hits"] += metrics.cache_hits
+            stats["cache_misses"] += metrics.cache_misses
+            if metrics.slowest_sql and metrics.slowest_time >= stats["slowest_time"]:
+                stats["slowest_time"] = metrics.slowest_time
+                stats["slowest_sql"] = metrics.slowest_sql[:SQL_MAX_LENGTH]
+
+    def snapshot(self):
+        with self.lock:
+            endpoints = {name: dict(stats) for name, stats in self.endpoints.items()}
+
+        result = {}
+        for name, stats in sorted(endpoints.items()):
+            requests = stats["requests"]
+            lookups = stats["cache_hits"] + stats["cache_misses"]
+            result[name] = {
+                "requests": requests,
+                "queries": stats["queries"],
+                "queries_per_request": round(stats["queries"] / requests, 2),
+                "max_queries": stats["max_queries"],
+                "db_time_ms": round(stats["db_time"] * 1000, 3),
+                "db_time_per_request_ms": round(stats["db_time"] * 1000 / requests, 3),
+                "duration_per_request_ms": round(
+                    stats["duration"] * 1000 / requests, 3
+                ),
+                "slowest_query_ms": round(stats["slowest_time"] * 1000, 3),
+                "slowest_query": stats["slowest_sql"],
+                "cache_hits": stats["cache_hits"],
+                "cache_misses": stats["cache_misses"],
+                "cache_hit_ratio": (
+                    round(stats["cache_hits"] / lookups, 4) if lookups else None
+                ),
+            }
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+
+registry = QueryMetricsRegistry()
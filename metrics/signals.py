@@ -0,0 +1,30 @@
+import time
+
+from celery.signals import task_postrun, task_prerun
+
+from .prometheus import Histogram
+
+TASK_DURATION = Histogram(
+    "celery_task_duration_seconds",
+    "Duration of the Celery tasks, by task and final state.",
+    ["task", "state"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+    shared=True,
+)
+
+# start times of the tasks running in this worker process
+_started = {}
+
+
+@task_prerun.connect
+def task_started(task_id=None, **kwargs):
+    _started[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.observe(
+            time.monotonic() - started, task=task.name, state=state or "UNKNOWN"
+        )
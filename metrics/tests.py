@@ -0,0 +1,132 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from accounts.models import User
+
+from . import prometheus
+from .prometheus import Counter, LocalStore, RedisStore
+from .registry import RequestMetrics, registry
+
+
+def create_user(n, is_admin=False):
+    user = User.objects.create_user(
+        f"0913{n:07d}", f"metrics{n}@example.com", f"metrics{n}", "password"
+    )
+    if is_admin:
+        user.is_admin = True
+        user.save()
+    return user
+
+
+class QueryMetricsMiddlewareTests(TestCase):
+    def setUp(self):
+        registry.reset()
+        self.addCleanup(registry.reset)
+        self.client = APIClient()
+        self.client.force_authenticate(create_user(1))
+
+    def test_server_timing(self):
+        response = self.client.get(reverse("book:book-list"))
+
+        timing = response["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        self.assertIn("total;dur=", timing)
+
+    def test_registry(self):
+        self.client.get(reverse("book:book-list"))
+        self.client.get(reverse("book:book-list"))
+
+        stats = registry.snapshot()["book:book-list"]
+        self.assertEqual(stats["requests"], 2)
+        self.assertGreater(stats["queries"], 0)
+        self.assertIn("book_book", stats["slowest_query"])
+
+    def test_unresolved(self):
+        self.client.get("/no-such-page/")
+
+        self.assertEqual(registry.snapshot()["unresolved"]["requests"], 1)
+
+
+class QueryMetricsViewTests(TestCase):
+    url = reverse("metrics:query-metrics")
+
+    def setUp(self):
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+    def get_client(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def test_admin_only(self):
+        response = self.get_client(create_user(1)).get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_get_and_reset(self):
+        client = self.get_client(create_user(1, is_admin=True))
+        client.get(reverse("book:book-list"))
+
+        self.assertEqual(client.get(self.url).data["book:book-list"]["requests"], 1)
+        self.assertEqual(client.delete(self.url).status_code, 204)
+        self.assertNotIn("book:book-list", registry.snapshot())
+
+
+class RequestMetricsTests(SimpleTestCase):
+    def test_counts_and_keeps_the_slowest_statement(self):
+        metrics = RequestMetrics()
+        for sql in ("SELECT 1", "SELECT 2"):
+            metrics(lambda *args: None, sql, None, False, {})
+        metrics.record_cache(hits=2, misses=1)
+
+        self.assertEqual(metrics.queries, 2)
+        self.assertIn(metrics.slowest_sql, ("SELECT 1", "SELECT 2"))
+        self.assertIn('cache;desc="2 hits 1 misses"', metrics.get_server_timing(0.01))
+
+
+@override_settings(METRICS_TOKEN="secret", METRICS_ALLOWED_IPS=["127.0.0.1"])
+class PrometheusMetricsViewTests(SimpleTestCase):
+    url = reverse("metrics:prometheus-metrics")
+
+    def setUp(self):
+        # the metrics shared through Redis are kept in memory, the view is
+        # tested without a Redis server
+        for metric in prometheus._metrics:
+            if isinstance(metric.store, RedisStore):
+                patcher = mock.patch.object(metric, "store", LocalStore())
+                patcher.start()
+                self.addCleanup(patcher.stop)
+
+    def test_token(self):
+        counter = next(
+            metric for metric in prometheus._metrics if isinstance(metric, Counter)
+        )
+        counter.inc(**{name: "test" for name in counter.labelnames})
+
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer secret")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], prometheus.CONTENT_TYPE)
+        self.assertIn(f"# TYPE {counter.name} counter", response.content.decode())
+
+    def test_no_token(self):
+        # a public request forwarded by a reverse proxy on the same host
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_wrong_token(self):
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer other")
+        self.assertEqual(response.status_code, 403)
+
+    def test_address_not_allowed(self):
+        response = self.client.get(
+            self.url, HTTP_AUTHORIZATION="Bearer secret", REMOTE_ADDR="10.0.0.1"
+        )
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_TOKEN="")
+    def test_no_token_configured(self):
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer ")
+        self.assertEqual(response.status_code, 403)
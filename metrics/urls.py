@@ -0,0 +1,9 @@
+from django.urls import path
+
+from . import views
+
+app_name = "metrics"
+urlpatterns = [
+    path("metrics/", views.PrometheusMetricsView.as_view(), name="prometheus-metrics"),
+    path("metrics/queries/", views.QueryMetricsView.as_view(), name="query-metrics"),
+]
@@ -0,0 +1,69 @@
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from permissions import IsMetricsScraper
+
+from .prometheus import CONTENT_TYPE, generate_latest
+from .registry import registry
+
+
+class QueryMetricsView(APIView):
+    """
+    This API view returns the per-endpoint query and cache metrics recorded by
+    QueryMetricsMiddleware in this process.
+
+    Permissions:
+    •  Only admin users can access this view.
+
+
+    Methods:
+    •  get: Returns the metrics of every endpoint.
+
+    •  delete: Resets the metrics.
+
+
+    Returns:
+    •  Response: {view_name: metrics} with for every endpoint the requests,
+       queries per request, DB time, slowest statement and cache hit ratio.
+
+    •  HTTP 200 OK: For a get request.
+
+    •  HTTP 204 No Content: For a delete request.
+
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(registry.snapshot(), status=status.HTTP_200_OK)
+
+    def delete(self, request):
+        registry.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class PrometheusMetricsView(APIView):
+    """
+    This API view returns the metrics of the process (and those the Celery
+    workers share through Redis) in the Prometheus text exposition format.
+
+    Permissions:
+    •  Only the requests with the METRICS_TOKEN bearer token (and from the
+       addresses of METRICS_ALLOWED_IPS if set) can access this view, with no
+       user authentication nor throttling so a scraper can poll it.
+
+
+    Methods:
+    •  get: Returns the metrics.
+
+    """
+
+    authentication_classes = []
+    permission_classes = [IsMetricsScraper]
+    throttle_classes = []
+
+    def get(self, request):
+        return HttpResponse(generate_latest(), content_type=CONTENT_TYPE)
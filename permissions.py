@@ -1,3 +1,6 @@
+import hmac
+
+from django.conf import settings
 from rest_framework.permissions import SAFE_METHODS, BasePermission
 
 
@@ -15,3 +18,23 @@ class IsOwnerReadOnly(BasePermission):
 class IsOwner(BasePermission):
     def has_object_permission(self, request, view, obj):
         return obj.user == request.user
+
+
+class IsMetricsScraper(BasePermission):
+    message = "metrics are only served with the METRICS_TOKEN bearer token"
+
+    def has_permission(self, request, view):
+        # behind a reverse proxy every request comes from its address, the
+        # address alone does not tell a local scraper from the internet
+        if not settings.METRICS_TOKEN:
+            return False
+        if (
+            settings.METRICS_ALLOWED_IPS
+            and request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS
+        ):
+            return False
+
+        scheme, _, token = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(
+            token.encode(), settings.METRICS_TOKEN.encode()
+        )
@@ -1,6 +1,7 @@
 from .code_generator import code_generator
 from .combine_dict_items import combine_dict_items
 from .extract_values_list_dicts import extract_values_list_dicts
+from .get_constraint_name import get_constraint_name
 from .get_keys_with_pattern import get_keys_with_pattern
 from .redis_client import redis_instance
 from .remove_duplicates import remove_duplicates
@@ -0,0 +1,4 @@
+def get_constraint_name(error):
+    """Return the name of the constraint an IntegrityError violated, if known."""
+    diag = getattr(error.__cause__, "diag", None)
+    return getattr(diag, "constraint_name", None)